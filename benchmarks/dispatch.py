@@ -0,0 +1,140 @@
+"""
+Benchmark the per-message cost of dispatching data to handlers.
+
+This uses the in-memory test harness, so no time is spent in the kernel.
+
+Run this from the repository root:
+    python benchmarks/dispatch.py [messages]
+"""
+import asyncio
+import logging
+import struct
+import sys
+import time
+import types
+
+from bfnet import ButterflyHandler, Net
+from bfnet.packets import PacketHandler, Packet
+from bfnet.testing import connect_pair
+
+
+loop = asyncio.new_event_loop()
+
+
+class ListButterfly(object):
+    """
+    A Butterfly that returns each message from a list, so only the Net's own work is measured.
+    """
+
+    def __init__(self, messages: list):
+        self._messages = iter(messages)
+
+    async def read(self):
+        return next(self._messages, None)
+
+
+def net_dispatch(count: int, generator_style: bool=False) -> float:
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    net = Net("bench", 0, loop=loop)
+    net._set_bf_handler(handler)
+    seen = [0]
+
+    @net.regexp_match("^never")
+    async def never(data, butterfly, handler):
+        pass
+
+    if generator_style:
+        # The same as @asyncio.coroutine, which newer Pythons no longer have.
+        @net.any_data
+        @types.coroutine
+        def on_data(data, butterfly, handler):
+            seen[0] += 1
+            yield from ()
+    else:
+        @net.any_data
+        async def on_data(data, butterfly, handler):
+            seen[0] += 1
+
+    start = time.perf_counter()
+    loop.run_until_complete(net.handle(ListButterfly([b"message"] * count)))
+    assert seen[0] == count
+    return time.perf_counter() - start
+
+
+def packet_read(count: int) -> float:
+    handler = PacketHandler(loop, loglevel=logging.WARNING, buffer_size=1 << 30)
+    handler.on_connection = lambda bf: None
+
+    @handler.add_packet_type
+    class Message(Packet):
+        id = 1
+
+        def unpack(self, data: bytes) -> bool:
+            return True
+
+    server = handler.butterfly_factory()
+    connect_pair(loop, handler.butterfly_factory(), server)
+    frame = b"BF\x04\x01\x00\x01\x00\x00\x00\x04data"
+
+    async def consume():
+        for _ in range(count):
+            await server.read()
+
+    start = time.perf_counter()
+    server.data_received(frame * count)
+    loop.run_until_complete(consume())
+    return time.perf_counter() - start
+
+
+def sample_read(count: int, batch: bool=False) -> float:
+    """
+    Read fixed-layout samples, one packet at a time or in batches, and sum one of their fields.
+    """
+    handler = PacketHandler(loop, loglevel=logging.WARNING, buffer_size=1 << 30)
+    handler.on_connection = lambda bf: None
+
+    class Sample(Packet):
+        id = 1
+        fields = ("tick", "x", "y")
+        layout = "!Iff"
+
+    Sample.batch = batch
+    handler.add_packet_type(Sample)
+    server = handler.butterfly_factory()
+    connect_pair(loop, handler.butterfly_factory(), server)
+    frame = b"BF\x04\x01\x00\x01\x00\x00\x00\x0c" + struct.pack("!Iff", 1, 0.5, 0.25)
+
+    async def consume():
+        total = 0
+        seen = 0
+        while seen < count:
+            pack = await server.read()
+            if batch:
+                total += sum(pack["x"])
+                seen += len(pack)
+            else:
+                total += pack.x
+                seen += 1
+        return total
+
+    start = time.perf_counter()
+    # Deliver the samples in 64KB reads, like a real socket.
+    data = frame * count
+    for i in range(0, len(data), 65536):
+        server.data_received(data[i:i + 65536])
+    assert loop.run_until_complete(consume()) == count * 0.5
+    return time.perf_counter() - start
+
+
+def main(count: int):
+    for name, bench in (("Net dispatch", net_dispatch),
+                        ("Net, generator", lambda count: net_dispatch(count, generator_style=True)),
+                        ("Packet read", packet_read),
+                        ("Sample, single", sample_read),
+                        ("Sample, batched", lambda count: sample_read(count, batch=True))):
+        best = min(bench(count) for _ in range(3))
+        print("{:<16} {:6.2f}us per message".format(name, best / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
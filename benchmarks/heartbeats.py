@@ -0,0 +1,69 @@
+"""
+Benchmark how long heartbeats stall the event loop, with one timer per connection and with the slotted scheduler.
+
+Every connection is in memory, and answers pings. A probe timer fires every millisecond, and records how late
+it was, which is how long anything else on the loop would have had to wait.
+
+Run this from the repository root:
+    python benchmarks/heartbeats.py [connections]
+"""
+import asyncio
+import logging
+import sys
+import time
+
+from bfnet.packets import PacketHandler
+from bfnet.testing import connect
+
+INTERVAL = 0.5
+DURATION = 2.0
+
+
+def run(connections: int, slotted: bool) -> tuple:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = PacketHandler(loop, loglevel=logging.ERROR)
+    # Register connections, without starting a handler for each.
+    handler.on_connection = lambda bf: handler.butterflies.add(bf, None)
+    client_handler = PacketHandler(loop, loglevel=logging.ERROR)
+    client_handler.on_connection = lambda bf: None
+    servers = [connect(handler, client_handler.butterfly_factory())[0] for _ in range(connections)]
+
+    if slotted:
+        handler.enable_heartbeats(INTERVAL, max_missed=None)
+    else:
+        def ping(bf):
+            bf.send_ping()
+            loop.call_later(INTERVAL, ping, bf)
+
+        # Every connection gets its own timer, started when it connected.
+        for bf in servers:
+            loop.call_later(INTERVAL, ping, bf)
+
+    lateness = []
+
+    def probe(expected: float):
+        now = loop.time()
+        lateness.append(now - expected)
+        loop.call_at(now + 0.001, probe, now + 0.001)
+
+    loop.call_soon(probe, loop.time())
+    start = time.process_time()
+    loop.run_until_complete(asyncio.sleep(DURATION))
+    cpu = time.process_time() - start
+    samples = sum(bf.rtt.samples for bf in servers)
+    handler.disable_heartbeats()
+    loop.close()
+    lateness.sort()
+    return lateness[len(lateness) // 2], lateness[int(len(lateness) * 0.99)], lateness[-1], cpu, samples
+
+
+def main(connections: int):
+    for name, slotted in (("timer per connection", False), ("slotted scheduler", True)):
+        p50, p99, worst, cpu, samples = run(connections, slotted)
+        print("{:22} {} pongs, loop stall p50 {:.2f}ms p99 {:.2f}ms max {:.2f}ms, cpu {:.2f}s".format(
+            name, samples, p50 * 1e3, p99 * 1e3, worst * 1e3, cpu))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
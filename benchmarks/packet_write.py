@@ -0,0 +1,59 @@
+"""
+Benchmark the per-write cost of sending the same packet to many clients, with and without the frame cache.
+
+This uses the in-memory test harness, so no time is spent in the kernel.
+
+Run this from the repository root:
+    python benchmarks/packet_write.py [writes]
+"""
+import asyncio
+import logging
+import sys
+import time
+
+from bfnet.packets import PacketHandler, Packet
+from bfnet.testing import connect_pair
+
+
+loop = asyncio.new_event_loop()
+
+
+def write(count: int, cacheable: bool) -> tuple:
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+
+    class Roster(Packet):
+        id = 1
+        fields = ("room", "topic", "members")
+
+        def gen(self) -> bytes:
+            return self.autopack()
+
+    Roster.cacheable = cacheable
+    clients = []
+    for _ in range(100):
+        server = handler.butterfly_factory()
+        # The other end just throws the data away.
+        connect_pair(loop, asyncio.Protocol(), server)
+        clients.append(server)
+    pack = Roster(clients[0])
+    pack.room, pack.topic, pack.members = 12, "General chat", (1, 5, 9, 200, 3000, 40000)
+
+    start = time.perf_counter()
+    for i in range(count):
+        clients[i % 100].write(pack)
+    taken = time.perf_counter() - start
+    # Deliver everything, so the transports don't grow forever.
+    loop.run_until_complete(asyncio.sleep(0))
+    return taken, handler.frame_cache.stats()
+
+
+def main(count: int):
+    for name, cacheable in (("Uncached", False), ("Cached", True)):
+        best, stats = min(write(count, cacheable) for _ in range(3))
+        print("{:<10} {:6.2f}us per write, {} hits, {} misses".format(name, best / count * 1e6, stats["hits"],
+                                                                     stats["misses"]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,121 @@
+"""
+Benchmark the latency of small control packets while bulk packets saturate the connection.
+
+The connection is in memory, and can carry a fixed number of bytes on each iteration of the event loop,
+so bulk data builds up behind it like on a slow link.
+
+Run this from the repository root:
+    python benchmarks/priority_latency.py [heartbeats]
+"""
+import asyncio
+import logging
+import sys
+
+from bfnet.packets import PacketHandler, Packet
+from bfnet.packets.Scheduling import PRIORITY_BULK, PRIORITY_CONTROL, PRIORITY_NORMAL
+from bfnet.testing import connect_pair, VirtualTimeLoop
+
+
+class SlowLink(asyncio.Protocol):
+    """
+    The client end, which reads a limited number of bytes every millisecond.
+    """
+
+    def __init__(self, loop, rate: int):
+        self.loop = loop
+        self.rate = rate
+        self.transport = None
+        self.buffer = bytearray()
+        # The send time of every heartbeat, by sequence number, and their latencies.
+        self.sent = {}
+        self.latencies = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop.call_later(0.001, self.tick)
+
+    def data_received(self, data: bytes):
+        self.buffer.extend(data)
+        self.transport.pause_reading()
+
+    def tick(self):
+        # Parse the frames that made it over the link this millisecond.
+        data, self.buffer = self.buffer, bytearray()
+        link = data[:self.rate]
+        self.buffer.extend(data[self.rate:])
+        offset = 0
+        while offset + 10 <= len(link):
+            size = int.from_bytes(link[offset + 6:offset + 10], "big")
+            if link[offset + 5] == 2 and offset + 14 <= len(link):
+                seq = int.from_bytes(link[offset + 10:offset + 14], "big")
+                self.latencies.append(self.loop.time() - self.sent.pop(seq))
+            offset += 10 + size
+        self.buffer[:0] = link[offset:]
+        if not self.buffer:
+            self.transport.resume_reading()
+        if self.transport._protocol is not None:
+            self.loop.call_later(0.001, self.tick)
+
+
+def run(heartbeats: int, priority: int) -> list:
+    loop = VirtualTimeLoop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+
+    class Bulk(Packet):
+        id = 1
+        priority = PRIORITY_BULK
+
+        def gen(self) -> bytes:
+            return b"x" * 4096
+
+    class Heartbeat(Packet):
+        id = 2
+        fields = ("seq",)
+        layout = "!I"
+
+    Heartbeat.priority = priority
+    server = handler.butterfly_factory()
+    client = SlowLink(loop, rate=64 * 1024)
+    _, transport = connect_pair(loop, client, server)
+    transport.set_write_buffer_limits(high=16 * 1024)
+    server.peer_framed = True
+
+    async def flood():
+        # Send 1MB at a time, then wait for it to drain, like a snapshot being sent.
+        pack = Bulk(server)
+        while True:
+            for _ in range(256):
+                server.write(pack)
+            await server.drain()
+
+    async def beat():
+        for seq in range(heartbeats):
+            pack = Heartbeat(server)
+            pack.seq = seq
+            client.sent[seq] = loop.time()
+            server.write(pack)
+            # Don't line up with the link's ticks.
+            await asyncio.sleep(0.0137)
+        while client.sent:
+            await asyncio.sleep(0.01)
+
+    flooder = loop.create_task(flood())
+    loop.run_until_complete(beat())
+    flooder.cancel()
+    server.stop()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    loop.close()
+    return sorted(client.latencies)
+
+
+def main(heartbeats: int):
+    # With the same priority as the bulk data, heartbeats are sent in order, as they were before priorities.
+    for name, priority in (("FIFO", PRIORITY_BULK), ("Normal", PRIORITY_NORMAL), ("Control", PRIORITY_CONTROL)):
+        latencies = run(heartbeats, priority)
+        print("{:<8} p50 {:7.1f}ms  p99 {:7.1f}ms".format(
+            name, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,45 @@
+"""
+Replay a capture log against a server, and report throughput and latency.
+
+Record a log on a server with `handler.start_capture("traffic.bfcap")`, then run this against a staging build:
+    python benchmarks/replay.py traffic.bfcap 127.0.0.1 8001 [--speed N] [--copies N] [--tls]
+
+A speed of 1 replays at the rate it was recorded, 10 replays ten times faster, and 0 replays as fast as possible.
+Each connection in the log is replayed by --copies simulated clients at once.
+"""
+import argparse
+import asyncio
+import ssl
+
+from bfnet.capture import replay
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a ButterflyNet capture log against a server.")
+    parser.add_argument("path", help="The capture log.")
+    parser.add_argument("host", help="The host of the server.")
+    parser.add_argument("port", type=int, help="The port of the server.")
+    parser.add_argument("--speed", type=float, default=1.0, help="The replay speed, or 0 for as fast as possible.")
+    parser.add_argument("--copies", type=int, default=1, help="The number of clients for each connection.")
+    parser.add_argument("--tls", action="store_true", help="Connect with TLS, without checking the certificate.")
+    args = parser.parse_args()
+
+    context = None
+    if args.tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stats = loop.run_until_complete(replay(args.path, args.host, args.port, args.speed, args.copies, context))
+    loop.close()
+
+    print("{clients} clients, {errors} errors, {writes} writes, {bytes} bytes in {seconds:.2f}s".format(**stats))
+    print("{:.1f} writes/s, {:.2f} MB/s".format(stats["writes_per_second"], stats["bytes_per_second"] / 1e6))
+    print("Latency p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+        stats["latency_p50"] * 1e3, stats["latency_p99"] * 1e3, stats["latency_max"] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Benchmark the fixed cost of starting up: importing ButterflyNet, and creating a handler.
+
+Each measurement runs in a fresh interpreter, so nothing is already imported or cached.
+
+Run this from the repository root:
+    python benchmarks/startup.py [runs]
+"""
+import subprocess
+import sys
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import asyncio
+asyncio_done = time.perf_counter()
+import bfnet, bfnet.packets
+imported = time.perf_counter()
+loop = asyncio.new_event_loop()
+import logging
+created = time.perf_counter()
+bfnet.packets.PacketHandler(loop, loglevel=logging.WARNING)
+bfnet.ButterflyHandler(loop, loglevel=logging.WARNING)
+done = time.perf_counter()
+print(asyncio_done - start, imported - asyncio_done, done - created)
+"""
+
+
+def main(runs: int):
+    results = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, "-c", SCRIPT], cwd=".")
+        results.append([float(value) for value in out.split()])
+    asyncio_time, import_time, handler_time = (min(column) for column in zip(*results))
+    print("import asyncio      {:7.2f}ms".format(asyncio_time * 1e3))
+    print("import bfnet        {:7.2f}ms (on top of asyncio)".format(import_time * 1e3))
+    print("create 2 handlers   {:7.2f}ms".format(handler_time * 1e3))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
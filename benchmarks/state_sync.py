@@ -0,0 +1,87 @@
+"""
+Benchmark replicating a table of entities to many clients, as full snapshots and as deltas.
+
+Full snapshots encode every entity as a packet on every tick, and send the result to every client.
+Deltas use :class:`bfnet.packets.StateSync.StateSync`, with every client acknowledging each tick straight away.
+
+Run this from the repository root:
+    python benchmarks/state_sync.py [entities] [clients]
+"""
+import random
+import sys
+import time
+
+from bfnet.packets import Packet
+from bfnet.packets.StateSync import StateSync
+
+TICKS = 50
+
+
+class Player(Packet):
+    fields = ("x", "y", "z", "yaw", "health", "flags")
+    layout = "!ffffHI"
+
+
+class FakeButterfly(object):
+    """
+    Counts the bytes it is sent.
+    """
+    _closing = False
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_state(self, body: bytes):
+        self.sent += len(body)
+
+
+def full_snapshots(entities: int, clients: list, changes: int) -> float:
+    players = []
+    for i in range(entities):
+        pack = Player(None)
+        pack.x = pack.y = pack.z = pack.yaw = 0.0
+        pack.health, pack.flags = 100, 0
+        players.append(pack)
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        for pack in random.sample(players, changes):
+            pack.x += 1.0
+        body = b"".join([pack.gen() for pack in players])
+        for client in clients:
+            client.send_state(body)
+    return time.perf_counter() - start
+
+
+def deltas(entities: int, clients: list, changes: int) -> float:
+    sync = StateSync(1, Player, resync_every=None)
+    for i in range(entities):
+        sync.update(i, health=100)
+    for client in clients:
+        sync.subscribe(client)
+    sync.tick()
+    for client in clients:
+        sync.ack(client, sync.version)
+        client.sent = 0
+    ids = list(range(entities))
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        for i in random.sample(ids, changes):
+            sync.update(i, x=sync.entities[i][0] + 1.0)
+        sync.tick()
+        for client in clients:
+            sync.ack(client, sync.version)
+    return time.perf_counter() - start
+
+
+def main(entities: int, clients: int):
+    for percent in (1, 10, 100):
+        changes = entities * percent // 100
+        for name, run in (("full snapshots", full_snapshots), ("deltas", deltas)):
+            butterflies = [FakeButterfly() for _ in range(clients)]
+            taken = run(entities, butterflies, changes)
+            print("{:3}% changed, {:15} {:8.2f}ms/tick {:9.0f} bytes/tick/client".format(
+                percent, name, taken / TICKS * 1e3, butterflies[0].sent / TICKS))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,56 @@
+"""
+Benchmark writing to a client from worker threads, waking the loop up for every write or once per batch.
+
+This uses the in-memory test harness, so no time is spent in the kernel.
+
+Run this from the repository root:
+    python benchmarks/threaded_send.py [writes]
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+from bfnet import ButterflyHandler
+from bfnet.testing import open_connection
+
+
+def run(count: int, batched: bool) -> tuple:
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    reader, writer = open_connection(handler, limit=1 << 30)
+    loop.run_until_complete(asyncio.sleep(0))
+    butterfly = list(handler.butterflies.values())[0][0]
+    threads = 4
+
+    def work():
+        for _ in range(count // threads):
+            if batched:
+                handler.send_threadsafe(butterfly, b"result!!")
+            else:
+                loop.call_soon_threadsafe(butterfly.write, b"result!!")
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    loop.run_until_complete(reader.readexactly(count // threads * threads * 8))
+    taken = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    writer.close()
+    butterfly.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    return taken, handler.outbox.wakeups
+
+
+def main(count: int):
+    for name, batched in (("Per write", False), ("Batched", True)):
+        taken, wakeups = min(run(count, batched) for _ in range(3))
+        print("{:<10} {:6.2f}us per write, {} batched wakeups".format(name, taken / count * 1e6, wakeups))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
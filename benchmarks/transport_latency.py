@@ -0,0 +1,100 @@
+"""
+Benchmark the round-trip latency of an echo server over each transport, and over memory with no transport at all.
+
+Run this from the repository root:
+    python benchmarks/transport_latency.py [round trips]
+"""
+import asyncio
+import logging
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+
+from bfnet import ButterflyHandler
+from bfnet.testing import open_connection
+
+
+loop = asyncio.get_event_loop()
+ssl_options = ("keys/test.crt", "keys/test.key", None)
+
+
+def make_handler():
+    # Use a separate handler for every transport, so they each get their own Net.
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING, buffer_size=4096)
+    return handler
+
+
+def add_echo(net):
+    @net.any_data
+    async def echo(data, butterfly, handler):
+        butterfly.write(data)
+
+
+async def round_trips(reader, writer, count: int) -> list:
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(b"ping")
+        await reader.readexactly(4)
+        timings.append(time.perf_counter() - start)
+    writer.close()
+    return timings
+
+
+async def tcp_tls(count: int) -> list:
+    handler = make_handler()
+    net = await handler.create_server(("127.0.0.1", 8021), ssl_options)
+    add_echo(net)
+    client_ssl = ssl.create_default_context()
+    client_ssl.check_hostname = False
+    client_ssl.verify_mode = ssl.CERT_NONE
+    reader, writer = await asyncio.open_connection("127.0.0.1", 8021, ssl=client_ssl)
+    return (await round_trips(reader, writer, count))
+
+
+async def unix_plain(count: int) -> list:
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    handler = make_handler()
+    net = await handler.create_server(path, None)
+    add_echo(net)
+    reader, writer = await asyncio.open_unix_connection(path)
+    return (await round_trips(reader, writer, count))
+
+
+async def pair_plain(count: int) -> list:
+    server_sock, client_sock = socket.socketpair()
+    handler = make_handler()
+    await handler.add_connection(server_sock)
+    add_echo(handler.net)
+    reader, writer = await asyncio.open_connection(sock=client_sock)
+    return (await round_trips(reader, writer, count))
+
+
+async def memory(count: int) -> list:
+    # No kernel at all, so this is the overhead of ButterflyNet and asyncio alone.
+    handler = make_handler()
+    reader, writer = open_connection(handler)
+    add_echo(handler.net)
+    return (await round_trips(reader, writer, count))
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    p50 = timings[len(timings) // 2]
+    p99 = timings[int(len(timings) * 0.99)]
+    print("{:<16} mean {:8.1f}us   p50 {:8.1f}us   p99 {:8.1f}us".format(name, mean * 1e6, p50 * 1e6, p99 * 1e6))
+
+
+async def main(count: int):
+    for name, bench in (("TCP + TLS", tcp_tls), ("Unix socket", unix_plain), ("socketpair", pair_plain),
+                        ("in-memory", memory)):
+        timings = await bench(count)
+        report(name, timings)
+
+
+if __name__ == '__main__':
+    loop.run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
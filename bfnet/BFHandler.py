@@ -15,14 +15,20 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import _ssl
 import asyncio
+import contextlib
 import logging
-import multiprocessing
+import os
+import socket
 import ssl
 import sys
 import types
+import weakref
 from concurrent import futures
+from bfnet import handoff
+from bfnet.sockopts import SocketOptions
+from bfnet.outbox import Outbox
+from bfnet.registry import ConnectionRegistry
 from bfnet.Butterfly import Butterfly
 from bfnet.Net import Net
 
@@ -34,66 +40,76 @@ class ButterflyHandler(object):
     It has several methods that are automatically called at critical stages in the connection:
         - :func:`ButterflyHandler.on_connection`
         - :func:`ButterflyHandler.on_disconnect`
+        - :func:`ButterflyHandler.on_shutdown`
 
     These methods are called at the appropriate time, as their name describes.
     """
     instance = None
 
+    # The handlers with a Net on each event loop, so SIGTERM can reach all of them.
+    _loop_handlers = weakref.WeakKeyDictionary()
+
     def __init__(self, event_loop: asyncio.AbstractEventLoop, ssl_context: ssl.SSLContext=None,
-            loglevel: int=logging.DEBUG, buffer_size: int=asyncio.streams._DEFAULT_LIMIT):
+            loglevel: int=logging.DEBUG, buffer_size: int=asyncio.streams._DEFAULT_LIMIT, name: str=None):
         """
         Create a new ButterflyHandler.
 
-        This class should not be called directly. Instead, use ButterflyHandler.get_handler() to
-        get a reference instead.
+        Every handler is independent, with its own server, Net, Butterflies, executor and SSL context,
+        so several can share one event loop, such as a public TLS server and an internal plaintext one.
+        If you only need one, ButterflyHandler.get_handler() will keep it for you.
 
         :param event_loop: The :class:`asyncio.BaseEventLoop` to use for the server.
         :param ssl_context: The :class:`ssl.SSLContext` to use for the server.
         :param loglevel: The logging level to use.
         :param buffer_size: The buffer size to use.
+        :param name: The name of this handler, used for its logger.
+            Handlers with a name log to "ButterflyNet.<name>", so each can have its own log level.
         """
+        self.name = name
         self._event_loop = event_loop
         self._server = None
-        if not ssl_context:
-            # This looks very similar to the code for create_default_context
-            # That's because it is the code
-            # For some reason, create_default_context doesn't like me and won't work properly
-            self._ssl = ssl.SSLContext(protocol=ssl.PROTOCOL_SSLv23)
-            # SSLv2 considered harmful.
-            self._ssl.options |= ssl.OP_NO_SSLv2
-
-            # SSLv3 has problematic security and is only required for really old
-            # clients such as IE6 on Windows XP
-            self._ssl.options |= ssl.OP_NO_SSLv3
-            self._ssl.load_default_certs(ssl.Purpose.SERVER_AUTH)
-            self._ssl.options |= getattr(_ssl, "OP_NO_COMPRESSION", 0)
-            self._ssl.set_ciphers(ssl._RESTRICTED_SERVER_CIPHERS)
-            self._ssl.options |= getattr(_ssl, "OP_CIPHER_SERVER_PREFERENCE", 0)
-
-        else:
-            self._ssl = ssl_context
+        # The default SSL context is only built when a TLS server is created, as loading the CA certificates is slow.
+        self._ssl = ssl_context or None
 
         self._bufsize = buffer_size
 
         self.default_butterfly = Butterfly
         self.default_net = Net
 
-        self._executor = futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() * 2 + 1)
+        # The executor is only created when async_func() is first called.
+        self._executor = None
 
         self.net = None
         self.log_level = loglevel
-        self.logger = logging.getLogger("ButterflyNet")
+        self.logger = logging.getLogger("ButterflyNet" if name is None else "ButterflyNet.{}".format(name))
         self.logger.setLevel(loglevel)
         if self.logger.level <= logging.DEBUG:
             self._event_loop.set_debug(True)
 
-        self.butterflies = {}
+        # The connected Butterflies. See :class:`bfnet.registry.ConnectionRegistry`.
+        self.butterflies = ConnectionRegistry()
+
+        # Options for a graceful shutdown on SIGTERM, or None to stop immediately.
+        self.shutdown_options = None
+
+        # The bridge used to broadcast to other processes, or None.
+        self.bridge = None
+
+        # The socket options applied to the server and every connection, or None to use the OS defaults.
+        self.socket_options = None
+
+        # Writes queued by other threads. See :func:`send_threadsafe`.
+        self.outbox = Outbox(event_loop, self.logger)
 
-    def stop(self):
+        # The capture log recording what clients send, or None. See :mod:`bfnet.capture`.
+        self.capture = None
+
+    def stop(self, stop_loop: bool=True):
         """
         Stop a Net.
 
         This will kill all handlers, disconnect all butterflies, and unbind the server.
+        :param stop_loop: Should the event loop be stopped afterwards?
         """
         self.logger.info("Stopping server.")
         print("Stopping server.")
@@ -104,11 +120,144 @@ class ButterflyHandler(object):
             bf[1].cancel()
             # Cancel the Butterfly.
             bf[0].stop()
-        self.net.stop()
-        self._event_loop.stop()
+        # Unbind the server. We can't wait for it to close, as the loop is about to stop.
+        if self._server is not None:
+            self._server.close()
+        if stop_loop:
+            self._event_loop.stop()
+
+    def set_graceful_shutdown(self, deadline: float=30.0, batch_size: int=100, batch_interval: float=0.5):
+        """
+        Make SIGTERM gracefully shut the server down with :func:`ButterflyHandler.shutdown`,
+        instead of stopping it immediately.
+
+        :param deadline: See :func:`ButterflyHandler.shutdown`.
+        :param batch_size: See :func:`ButterflyHandler.shutdown`.
+        :param batch_interval: See :func:`ButterflyHandler.shutdown`.
+        """
+        self.shutdown_options = {"deadline": deadline, "batch_size": batch_size, "batch_interval": batch_interval}
+
+    @classmethod
+    def _on_sigterm(cls, loop: asyncio.AbstractEventLoop):
+        """
+        Internal call used to handle SIGTERM, for every handler on an event loop.
+
+        The loop is only stopped once every handler has finished shutting down.
+        """
+        shutdowns = []
+        for handler in list(cls._loop_handlers.get(loop, ())):
+            if handler.shutdown_options is None:
+                handler.stop(stop_loop=False)
+            else:
+                shutdowns.append(loop.create_task(handler.shutdown(stop_loop=False, **handler.shutdown_options)))
+        if shutdowns:
+            asyncio.gather(*shutdowns).add_done_callback(lambda _: loop.stop())
+        else:
+            loop.stop()
+
+    async def shutdown(self, deadline: float=30.0, batch_size: int=100, batch_interval: float=0.5,
+            stop_loop: bool=True):
+        """
+        Gracefully shut down the server.
 
-    @asyncio.coroutine
-    def on_connection(self, butterfly: Butterfly):
+        This will:
+            - Stop accepting new connections.
+            - Call :func:`ButterflyHandler.on_shutdown` for every connected Butterfly.
+            - Wait for every write buffer to drain, up to the deadline.
+            - Disconnect the Butterflies in batches, so that clients don't all reconnect at once.
+
+        This method is a coroutine.
+        :param deadline: The maximum number of seconds to wait for write buffers to drain.
+        :param batch_size: The number of Butterflies to disconnect at once.
+        :param batch_interval: The number of seconds to wait between each batch.
+        :param stop_loop: Should the event loop be stopped afterwards?
+        """
+        self.logger.info("Shutting down server.")
+        # Stop accepting new connections.
+        if self._server is not None:
+            self._server.close()
+
+        butterflies = list(self.butterflies.values())
+        # Tell everyone we're going away.
+        for bf, _ in butterflies:
+            res = self.on_shutdown(bf)
+            if asyncio.coroutines.iscoroutine(res):
+                await res
+
+        # Wait for the write buffers to drain.
+        drains = [self._event_loop.create_task(self._wait_flushed(bf)) for bf, _ in butterflies]
+        if drains:
+            _, pending = await asyncio.wait(drains, timeout=deadline)
+            if pending:
+                self.logger.warning("Write buffers did not drain before the deadline.")
+                for task in pending:
+                    task.cancel()
+
+        # Disconnect in batches.
+        for i in range(0, len(butterflies), batch_size):
+            if i:
+                await asyncio.sleep(batch_interval)
+            for bf, fut in butterflies[i:i + batch_size]:
+                fut.cancel()
+                bf.stop()
+
+        if self.net is not None:
+            await self.net.stop()
+        if self.bridge is not None:
+            await self.bridge.stop()
+        self.logger.info("Server shut down.")
+        if stop_loop:
+            self._event_loop.stop()
+
+    @staticmethod
+    async def _wait_flushed(butterfly: Butterfly):
+        """
+        Wait until everything written to a Butterfly has been sent, or it has disconnected.
+        :param butterfly: The Butterfly to wait for.
+        """
+        if butterfly._connection_lost or not butterfly.get_write_buffer_size():
+            return
+        # With a high-water mark of 0, the transport only resumes writing once its buffer is empty.
+        butterfly._transport.set_write_buffer_limits(high=0)
+        try:
+            await butterfly.drain()
+        except ConnectionError:
+            pass
+
+    async def offer_handoff(self, path: str, **kwargs):
+        """
+        Offer our listening sockets to a replacement process, then gracefully shut down.
+
+        This will wait for a new process to call :func:`bfnet.handoff.receive_sockets` with the same path.
+        Once the sockets have been sent, the new process accepts all new connections, and
+        :func:`ButterflyHandler.shutdown` is called with the extra keyword arguments.
+
+        This method is a coroutine.
+        :param path: The path of the Unix domain socket to offer the sockets on.
+        """
+        if self._server is None:
+            raise RuntimeError("There is no server to hand off")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.setblocking(False)
+        try:
+            listener.bind(path)
+            listener.listen(1)
+            conn, _ = await self._event_loop.sock_accept(listener)
+        finally:
+            listener.close()
+            # Don't hide the real error if we never got as far as creating the socket file.
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+        with conn:
+            conn.setblocking(True)
+            handoff.send_sockets(conn, self._server.sockets)
+        self.logger.info("Handed off listening sockets on {}.".format(path))
+        await self.shutdown(**kwargs)
+
+    async def on_connection(self, butterfly: Butterfly):
         """
         Stub for an on_connection event.
 
@@ -120,10 +269,21 @@ class ButterflyHandler(object):
         # Begin handling.
         handler = self.begin_handling(butterfly)
         # Create a new entry in our butterfly table.
-        self.butterflies["{}:{}".format(butterfly.ip, butterfly.client_port)] = (butterfly, handler)
+        self.butterflies.add(butterfly, handler)
 
-    @asyncio.coroutine
-    def on_disconnect(self, butterfly: Butterfly):
+    def on_shutdown(self, butterfly: Butterfly):
+        """
+        Stub for an on_shutdown event.
+
+        This is called for every connected Butterfly when the server is shutting down gracefully,
+        before the write buffers are drained. Override this to send a "going away" message.
+
+        This method can be a coroutine.
+        :param butterfly: The butterfly that is about to be disconnected.
+        """
+        pass
+
+    async def on_disconnect(self, butterfly: Butterfly):
         """
         Stub for an on_disconnect event.
 
@@ -132,15 +292,51 @@ class ButterflyHandler(object):
         This method is a coroutine.
         :param butterfly: The butterfly object created.
         """
-        s = "{}:{}".format(butterfly.ip, butterfly.client_port)
-        if s in self.butterflies:
-            bf = self.butterflies.pop(s)
+        bf = self.butterflies.remove(butterfly)
+        if bf is not None:
             print(bf)
-            # These are here by default - don't call super() if you modify the butterfly dict!
-            assert isinstance(bf, tuple)
-            assert len(bf) == 2
             bf[1].cancel()
 
+    async def set_bridge(self, bridge):
+        """
+        Set and start the bridge used to broadcast to handlers in other processes.
+
+        This method is a coroutine.
+        :param bridge: A :class:`bfnet.Bridge.AbstractBridge` to use.
+        """
+        bridge._set_bf_handler(self)
+        await bridge.start()
+        self.bridge = bridge
+
+    def broadcast(self, data: bytes, exclude: Butterfly=None):
+        """
+        Send data to every connected Butterfly, including those connected to other processes through the bridge.
+        :param data: The byte data to send. This is written as-is to every Butterfly.
+        :param exclude: A local Butterfly to skip, such as the one that sent the message.
+        """
+        self.deliver_broadcast(data, exclude)
+        if self.bridge is not None:
+            self.bridge.publish(data)
+
+    def deliver_broadcast(self, data: bytes, exclude: Butterfly=None):
+        """
+        Write already encoded data to every local Butterfly.
+
+        This is called by the bridge for broadcasts from other processes.
+        :param data: The byte data to write.
+        :param exclude: A Butterfly to skip.
+        """
+        for bf, _ in list(self.butterflies.values()):
+            if bf is not exclude:
+                bf.write_raw(data)
+
+    def memory_stats(self) -> dict:
+        """
+        Get the number of bytes each connected Butterfly is holding in memory.
+        :return: A dict of connection ID -> the Butterfly's :func:`bfnet.Butterfly.AbstractButterfly.memory_stats`.
+        """
+        return {key: bf.memory_stats() for key, (bf, _) in self.butterflies.items()}
+
     def begin_handling(self, butterfly: Butterfly):
         """
         Begin the handler loop and start handling data that flows in.
@@ -161,10 +357,10 @@ class ButterflyHandler(object):
             functools.partial (https://docs.python.org/3/library/functools.html#functools.partial).
         :return: A :class:`~asyncio.Future` object for the function.
         """
-        future = self._event_loop.run_in_executor(self._executor, fun)
+        future = self._event_loop.run_in_executor(self.executor, fun)
         return future
 
-    def async_and_wait(self, fun: types.FunctionType):
+    async def async_and_wait(self, fun: types.FunctionType):
         """
         Turns a blocking function into an async function by running it inside an executor. It then uses
         :func:`~asyncio.wait_for` to wait for the Future to complete.
@@ -176,7 +372,7 @@ class ButterflyHandler(object):
         :return: The result of the function.
         """
         future = self.async_func(fun)
-        return (yield from asyncio.wait_for(future, loop=self._event_loop))
+        return (await future)
 
     def create_task(self, coro: types.FunctionType):
         """
@@ -187,15 +383,85 @@ class ButterflyHandler(object):
         future = self._event_loop.create_task(coro)
         return future
 
-    def call_soon(self, coro: types.FunctionType, *args):
+    def call_soon(self, callback: types.FunctionType, *args):
         """
-        Call a coroutine or Future as soon as possible on the event loop.
-        :param coro: The coroutine or Future to call.
+        Call a function as soon as possible on the event loop.
+
+        This must be called from the event loop's thread. From other threads, use :func:`call_soon_threadsafe`.
+        :param callback: The function to call.
         :param args: The arguments to the callback.
+        :return: An :class:`asyncio.Handle` for the call.
         """
-        handle = self._event_loop.call_soon(coro, args)
+        handle = self._event_loop.call_soon(callback, *args)
         return handle
 
+    def call_soon_threadsafe(self, callback: types.FunctionType, *args):
+        """
+        Call a function as soon as possible on the event loop, from any thread.
+
+        This wakes the event loop up for every call. To write to clients, use :func:`send_threadsafe`.
+        :param callback: The function to call.
+        :param args: The arguments to the callback.
+        :return: An :class:`asyncio.Handle` for the call.
+        """
+        return self._event_loop.call_soon_threadsafe(callback, *args)
+
+    def send_threadsafe(self, butterfly: Butterfly, payload):
+        """
+        Write to a Butterfly from any thread, such as a function run with :func:`async_func`.
+
+        Writes are queued, and flushed in order on the event loop, which is woken up once for every batch
+        of writes rather than for each one. Writes to Butterflies that have disconnected are dropped.
+        :param butterfly: The Butterfly to write to.
+        :param payload: What to pass to its write(), such as bytes or a Packet.
+        """
+        self.outbox.send(butterfly, payload)
+
+    def set_socket_options(self, options: SocketOptions):
+        """
+        Set the socket options profile used for new servers and connections.
+
+        For example, `handler.set_socket_options(SocketOptions.low_latency())`.
+        :param options: A :class:`bfnet.sockopts.SocketOptions`, or None to use the OS defaults.
+        """
+        self.socket_options = options
+
+    def start_capture(self, path: str, **kwargs):
+        """
+        Start recording everything clients send to a capture log, so it can be replayed later.
+
+        Clients that are already connected are recorded from now on.
+        :param path: The file to write. It will be created or truncated.
+        :param kwargs: Any other options for :class:`bfnet.capture.TrafficCapture`.
+        :return: The new :class:`bfnet.capture.TrafficCapture`.
+        """
+        # Imported here, so handlers that never capture don't pay for it.
+        from bfnet.capture import TrafficCapture
+        self.stop_capture()
+        self.capture = TrafficCapture(path, **kwargs)
+        for bf, _ in self.butterflies.values():
+            self.capture.record_open(bf)
+        return self.capture
+
+    def stop_capture(self):
+        """
+        Stop recording, and finish writing the capture log.
+        """
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    @property
+    def executor(self) -> futures.Executor:
+        """
+        The executor used by async_func, created on first use.
+
+        By default, this is a :class:`~concurrent.futures.ThreadPoolExecutor` with two threads for each CPU, plus one.
+        """
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2 + 1)
+        return self._executor
+
     def set_executor(self, executor: futures.Executor):
         """
         Set the default executor for use with async_func.
@@ -210,20 +476,24 @@ class ButterflyHandler(object):
         Do not touch.
         :param ssl_options: The SSL options to use.
         """
-        self._ssl.load_cert_chain(certfile=ssl_options[0], keyfile=ssl_options[1], password=ssl_options[2])
+        self.ssl_context.load_cert_chain(certfile=ssl_options[0], keyfile=ssl_options[1], password=ssl_options[2])
 
     @classmethod
     def get_handler(cls, loop: asyncio.AbstractEventLoop, ssl_context: ssl.SSLContext=None,
             log_level: int=logging.INFO, buffer_size: int=asyncio.streams._DEFAULT_LIMIT):
         """
-        Get the instance of the handler currently running.
+        Get the shared instance of this handler class, creating it if needed.
+
+        Each subclass has its own shared instance. To run more than one handler of the same class,
+        create them directly instead.
 
         :param loop: The :class:`asyncio.BaseEventLoop` to use for the server.
         :param ssl_context: The :class:`ssl.SSLContext` to use for the server.
         :param log_level: The logging level to use.
         :param buffer_size: The buffer size to use.
         """
-        if not cls.instance:
+        # Look in the class itself, so a subclass doesn't get its parent's instance.
+        if cls.__dict__.get("instance") is None:
             cls.instance = cls(loop, ssl_context, log_level, buffer_size)
         return cls.instance
 
@@ -240,34 +510,123 @@ class ButterflyHandler(object):
         bf = self.default_butterfly(loop=self._event_loop, bufsize=self._bufsize, handler=self)
         return bf
 
-    @asyncio.coroutine
-    def create_server(self, bind_options: tuple, ssl_options: tuple) -> Net:
+    async def create_server(self, bind_options, ssl_options: tuple=None, sock: socket.socket=None) -> Net:
         """
         Create a new server using the event loop specified.
 
         This method is a coroutine.
-        :param bind_options: The IP and port to bind to on the server.
-        :param ssl_options: A tuple of SSL options:
+        :param bind_options: What to bind to on the server. This can be:
+            - A tuple of the IP and port, for a TCP server.
+            - A string path, for a Unix domain socket server.
+        :param ssl_options: A tuple of SSL options, or None to run without TLS.
+            Only do this for connections that never leave the host, such as Unix domain sockets.
             - The certificate file to use
             - The private key to use
             - The private key password, or None if it does not have a password.
+        :param sock: An already listening socket to use instead of binding, such as one
+            received from :func:`bfnet.handoff.receive_sockets`.
         :return: A :class:`bfnet.Net.Net` object.
         """
 
         # Load SSL.
-        self._load_ssl(ssl_options)
+        ssl_context = self._get_ssl(ssl_options)
 
         # Create the server.
-        host, port = bind_options
-        self._server = yield from self._event_loop.create_server(self.butterfly_factory, host=host, port=port,
-            ssl=self._ssl)
+        kwargs = {"ssl": ssl_context}
+        if self.socket_options is not None:
+            kwargs["backlog"] = self.socket_options.backlog
+        unix = isinstance(bind_options, str) or (sock is not None and sock.family == socket.AF_UNIX)
+        if unix:
+            host, port = bind_options, 0
+            self._server = await self._event_loop.create_unix_server(self.butterfly_factory,
+                path=None if sock is not None else bind_options, sock=sock, **kwargs)
+        else:
+            host, port = bind_options
+            if sock is not None:
+                self._server = await self._event_loop.create_server(self.butterfly_factory, sock=sock, **kwargs)
+            else:
+                self._server = await self._event_loop.create_server(self.butterfly_factory, host=host,
+                    port=port, **kwargs)
+        if self.socket_options is not None:
+            for listener in self._server.sockets:
+                self.socket_options.apply_socket(listener, listening=True)
+        return self._create_net(host, port)
+
+    async def add_connection(self, sock: socket.socket, ssl_options: tuple=None) -> Butterfly:
+        """
+        Add an already connected socket, such as one end of a :func:`socket.socketpair`.
+
+        The Butterfly is handled exactly like one that connected to a server. If there is no server,
+        a Net without one is created, so you can still add handlers to it with `handler.net`.
+
+        This method is a coroutine.
+        :param sock: The connected socket.
+        :param ssl_options: A tuple of SSL options, as in :func:`ButterflyHandler.create_server`,
+            or None to run without TLS.
+        :return: The :class:`Butterfly` created.
+        """
+        ssl_context = self._get_ssl(ssl_options)
+        if self.net is None:
+            self._create_net("socket", 0)
+        if hasattr(self._event_loop, "connect_accepted_socket"):
+            _, bf = await self._event_loop.connect_accepted_socket(self.butterfly_factory, sock,
+                ssl=ssl_context)
+        elif ssl_context is None:
+            _, bf = await self._event_loop.create_connection(self.butterfly_factory, sock=sock)
+        else:
+            raise RuntimeError("This event loop cannot use TLS on an already connected socket")
+        return bf
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        """
+        The SSL context used for TLS servers and connections.
+
+        If none was given when the handler was created, a default server context is built on first use.
+        """
+        if self._ssl is None:
+            # This looks very similar to the code for create_default_context
+            # That's because it is the code
+            # For some reason, create_default_context doesn't like me and won't work properly
+            context = ssl.SSLContext(protocol=ssl.PROTOCOL_SSLv23)
+            # SSLv2 considered harmful.
+            context.options |= ssl.OP_NO_SSLv2
+
+            # SSLv3 has problematic security and is only required for really old
+            # clients such as IE6 on Windows XP
+            context.options |= ssl.OP_NO_SSLv3
+            context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            context.options |= getattr(ssl, "OP_NO_COMPRESSION", 0)
+            context.set_ciphers(ssl._RESTRICTED_SERVER_CIPHERS)
+            context.options |= getattr(ssl, "OP_CIPHER_SERVER_PREFERENCE", 0)
+            self._ssl = context
+        return self._ssl
+
+    def _get_ssl(self, ssl_options: tuple):
+        """
+        Internal call used to get the SSL context for a set of SSL options.
+        :param ssl_options: The SSL options to use, or None for no TLS.
+        :return: Our :class:`ssl.SSLContext`, or None.
+        """
+        if ssl_options is None:
+            return None
+        self._load_ssl(ssl_options)
+        return self.ssl_context
+
+    def _create_net(self, host: str, port: int) -> Net:
+        """
+        Internal call used to create our Net, once the server exists.
+        """
         # Create the Net.
         # Use the default net.
         self.net = self.default_net(ip=host, port=port, loop=self._event_loop, server=self._server)
         self.net._set_bf_handler(self)
-        # Create a signal handler.
+        # Create a signal handler, shared by every handler on this loop.
         if sys.platform != "win32":
-            self._event_loop.add_signal_handler(15, self.stop)
+            handlers = self._loop_handlers.setdefault(self._event_loop, weakref.WeakSet())
+            if not handlers:
+                self._event_loop.add_signal_handler(15, self._on_sigterm, self._event_loop)
+            handlers.add(self)
         return self.net
 
 
@@ -0,0 +1,386 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import logging
+import os
+import struct
+
+# Every batch is prefixed with its length, and every frame inside a batch is prefixed with its length.
+_length = struct.Struct("!I")
+
+
+def _encode_batch(frames: list) -> bytes:
+    """
+    Encode a list of frames into a single length-prefixed batch.
+    """
+    body = b"".join(_length.pack(len(frame)) + frame for frame in frames)
+    return _length.pack(len(body)) + body
+
+
+def _decode_batch(body: bytes) -> list:
+    """
+    Split the body of a batch back into frames.
+    """
+    frames = []
+    offset = 0
+    while offset < len(body):
+        size, = _length.unpack_from(body, offset)
+        offset += _length.size
+        frames.append(body[offset:offset + size])
+        offset += size
+    return frames
+
+
+class _BatchProtocol(asyncio.Protocol):
+    """
+    A protocol that splits an incoming stream into batches.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self._buffer.extend(data)
+        while len(self._buffer) >= _length.size:
+            size, = _length.unpack_from(self._buffer)
+            end = _length.size + size
+            if len(self._buffer) < end:
+                break
+            batch = bytes(self._buffer[:end])
+            del self._buffer[:end]
+            self.batch_received(batch)
+
+    def batch_received(self, batch: bytes):
+        """
+        Called with a full batch, including the length prefix.
+        """
+        pass
+
+
+class AbstractBridge(object):
+    """
+    A bridge forwards broadcast frames between ButterflyHandlers in different processes or hosts.
+
+    Frames passed to :func:`AbstractBridge.publish` are queued, and sent to the other handlers as
+    one batch on the next loop iteration. Frames received from the other handlers are written straight
+    to the local Butterflies, without being decoded.
+
+    Subclasses must implement :func:`AbstractBridge.start`, :func:`AbstractBridge.stop`, and
+    :func:`AbstractBridge.send_batch`.
+    """
+
+    def __init__(self):
+        self.bf_handler = None
+        self.loop = None
+
+        self._pending = []
+
+        self.logger = logging.getLogger("ButterflyNet")
+
+    def _set_bf_handler(self, handler):
+        self.bf_handler = handler
+        self.loop = handler._event_loop
+
+    async def start(self):
+        """
+        Connect to the other handlers.
+
+        This method is a coroutine.
+        """
+        pass
+
+    async def stop(self):
+        """
+        Disconnect from the other handlers.
+
+        This method is a coroutine.
+        """
+        pass
+
+    def send_batch(self, batch: bytes):
+        """
+        Send an encoded batch to the other handlers.
+        :param batch: The batch to send.
+        """
+        raise NotImplementedError
+
+    def publish(self, frame: bytes):
+        """
+        Queue a frame to be sent to the other handlers.
+        :param frame: The fully encoded frame.
+        """
+        if not self._pending:
+            self.loop.call_soon(self._flush)
+        self._pending.append(frame)
+
+    def _flush(self):
+        """
+        Send all pending frames as one batch.
+        """
+        frames, self._pending = self._pending, []
+        if frames:
+            self.send_batch(_encode_batch(frames))
+
+    def batch_received(self, batch: bytes):
+        """
+        Deliver a batch received from another handler to our local Butterflies.
+        :param batch: The batch, including the length prefix.
+        """
+        for frame in _decode_batch(batch[_length.size:]):
+            self.bf_handler.deliver_broadcast(frame)
+
+
+class _BrokerProtocol(_BatchProtocol):
+    """
+    A connection from a handler to the broker.
+    """
+
+    def __init__(self, broker):
+        super().__init__()
+        self._broker = broker
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        self._broker.members.add(self)
+
+    def connection_lost(self, exc):
+        self._broker.members.discard(self)
+
+    def batch_received(self, batch: bytes):
+        # Forward the batch to everyone else, untouched.
+        for member in self._broker.members:
+            if member is not self:
+                member.transport.write(batch)
+
+
+class BridgeBroker(object):
+    """
+    A minimal local broker, that relays batches between every handler connected to it.
+
+    This is started automatically by :class:`UnixBridge` if no broker is running.
+    Only one broker can run on a path at once. This is decided by an exclusive lock on "<path>.lock",
+    which the OS drops if the process holding it dies, so another handler can take over.
+    """
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop):
+        """
+        Create a new BridgeBroker.
+        :param path: The path of the Unix domain socket to listen on.
+        :param loop: The event loop to use.
+        """
+        self.path = path
+        self.loop = loop
+        self.members = set()
+
+        self._server = None
+        self._lock = None
+
+    def acquire(self) -> bool:
+        """
+        Try to become the broker for our path, without waiting.
+        :return: True if we are now the broker, or False if another one is.
+        """
+        # Imported here, as it is not available on Windows.
+        import fcntl
+        if self._lock is not None:
+            return True
+        lock = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        self._lock = lock
+        return True
+
+    async def start(self, stale: bool=False):
+        """
+        Start listening.
+
+        This method is a coroutine.
+        :param stale: Is there a socket file left behind by a broker that died? If so, it is removed first.
+        """
+        if not self.acquire():
+            raise RuntimeError("Another bridge broker is running on {}".format(self.path))
+        try:
+            if stale and os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = await self.loop.create_unix_server(lambda: _BrokerProtocol(self), path=self.path)
+        except Exception:
+            self._lock.close()
+            self._lock = None
+            raise
+
+    async def stop(self):
+        """
+        Stop listening, and disconnect all members.
+
+        This method is a coroutine.
+        """
+        self._server.close()
+        for member in list(self.members):
+            member.transport.close()
+        await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # Only give up the lock once the socket file is gone, so the next broker doesn't find it.
+        self._lock.close()
+        self._lock = None
+
+
+class _UnixBridgeProtocol(_BatchProtocol):
+    """
+    The connection from a :class:`UnixBridge` to the broker.
+    """
+
+    def __init__(self, bridge):
+        super().__init__()
+        self._bridge = bridge
+
+    def batch_received(self, batch: bytes):
+        self._bridge.batch_received(batch)
+
+    def connection_lost(self, exc):
+        self._bridge._connection_lost(self)
+
+
+class UnixBridge(AbstractBridge):
+    """
+    A bridge between handlers on the same host, over a Unix domain socket.
+
+    Every handler connects to a :class:`BridgeBroker` listening on the same path. If there is no broker,
+    the first handler to start will run one. If the broker goes away, such as when the handler running it stops,
+    every other handler reconnects, and one of them starts a new broker.
+    """
+
+    # How long to wait between attempts to connect to the broker, in seconds.
+    reconnect_delay = 0.1
+    # How many attempts start() makes before giving up.
+    start_attempts = 50
+
+    def __init__(self, path: str):
+        """
+        Create a new UnixBridge.
+        :param path: The path of the broker's Unix domain socket.
+        """
+        super().__init__()
+        self.path = path
+        self.broker = None
+
+        self._protocol = None
+        self._reconnecting = None
+        self._stopping = False
+
+    async def _connect(self):
+        """
+        Connect to the broker once, starting one if there is none.
+
+        This method is a coroutine.
+        :raises OSError: If we couldn't connect, such as when another handler is still starting its broker.
+        """
+        try:
+            _, self._protocol = await self.loop.create_unix_connection(lambda: _UnixBridgeProtocol(self),
+                path=self.path)
+            return
+        except FileNotFoundError:
+            stale = False
+        except ConnectionRefusedError:
+            # The socket file is there, but nothing is listening on it.
+            stale = True
+        broker = BridgeBroker(self.path, self.loop)
+        if broker.acquire():
+            self.logger.info("No bridge broker running on {}, starting one.".format(self.path))
+            await broker.start(stale)
+            self.broker = broker
+        _, self._protocol = await self.loop.create_unix_connection(lambda: _UnixBridgeProtocol(self),
+            path=self.path)
+
+    async def start(self):
+        """
+        Connect to the broker, starting one if needed.
+
+        This method is a coroutine.
+        """
+        self._stopping = False
+        for attempt in range(self.start_attempts):
+            try:
+                await self._connect()
+                return
+            except OSError:
+                if attempt == self.start_attempts - 1:
+                    raise
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _connection_lost(self, protocol: _UnixBridgeProtocol):
+        """
+        Called when our connection to the broker is lost, to reconnect.
+        """
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+        if not self._stopping and self._reconnecting is None:
+            self.logger.warning("Lost connection to the bridge broker, reconnecting.")
+            self._reconnecting = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        """
+        Reconnect to the broker, until it works or we are stopped.
+
+        This method is a coroutine.
+        """
+        try:
+            while not self._stopping:
+                try:
+                    await self._connect()
+                    self.logger.info("Reconnected to the bridge broker.")
+                    return
+                except OSError:
+                    await asyncio.sleep(self.reconnect_delay)
+        finally:
+            self._reconnecting = None
+
+    async def stop(self):
+        """
+        Disconnect from the broker, and stop it if we are running it.
+
+        This method is a coroutine.
+        """
+        self._flush()
+        self._stopping = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self._protocol is not None:
+            self._protocol.transport.close()
+            self._protocol = None
+        if self.broker is not None:
+            await self.broker.stop()
+            self.broker = None
+
+    def send_batch(self, batch: bytes):
+        """
+        Send a batch to the broker.
+        :param batch: The batch to send.
+        """
+        if self._protocol is None:
+            self.logger.warning("Bridge is not connected, dropping batch.")
+            return
+        self._protocol.transport.write(batch)
@@ -39,11 +39,18 @@ class AbstractButterfly(asyncio.Protocol):
 
         self._transport = None
 
+        # Write flow control state.
+        self._paused = False
+        self._drain_waiter = None
+        self._connection_lost = False
+        self._closing = False
+
         self.ip = "0.0.0.0"
         self.port = 0
+        # Set when the handler registers the connection. See :class:`bfnet.registry.ConnectionRegistry`.
+        self.connection_id = None
 
-        self.logger = logging.getLogger("ButterflyNet")
-        self.logger.setLevel(self._handler.log_level)
+        self.logger = handler.logger
 
     def connection_made(self, transport: asyncio.Transport):
         """
@@ -52,8 +59,18 @@ class AbstractButterfly(asyncio.Protocol):
         """
         super().connection_made(transport)
         self._transport = transport
-        self.ip, self.client_port = transport.get_extra_info("peername")
-        self.logger.info("Recieved connection from {}:{}".format(*transport.get_extra_info("peername")))
+        if self._handler.socket_options is not None:
+            self._handler.socket_options.apply_transport(transport)
+        peername = transport.get_extra_info("peername")
+        if isinstance(peername, tuple):
+            self.ip, self.client_port = peername[:2]
+        else:
+            # Unix domain sockets have no useful peer name, so use the file descriptor to tell them apart.
+            sock = transport.get_extra_info("socket")
+            self.ip, self.client_port = peername or "unix", sock.fileno() if sock is not None else id(self)
+        self.logger.info("Recieved connection from {}:{}".format(self.ip, self.client_port))
+        if self._handler.capture is not None:
+            self._handler.capture.record_open(self)
 
         # Call our handler.
         res = self._handler.on_connection(self)
@@ -68,6 +85,12 @@ class AbstractButterfly(asyncio.Protocol):
         """
         super().connection_lost(exc)
         self.logger.info("Lost connection from {}:{}".format(self.ip, self.client_port))
+        if self._handler.capture is not None:
+            self._handler.capture.record_close(self)
+
+        # Wake up anybody waiting to drain.
+        self._connection_lost = True
+        self._wake_drain(exc)
 
         # Call the handler.
         res = self._handler.on_disconnect(self)
@@ -78,20 +101,74 @@ class AbstractButterfly(asyncio.Protocol):
         """
         Kills the Butterfly.
         """
+        self._closing = True
         self._transport.close()
 
+    def get_write_buffer_size(self) -> int:
+        """
+        Get the number of bytes waiting to be written to the client.
+        """
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
+    def memory_stats(self) -> dict:
+        """
+        Get the number of bytes this connection is holding in memory.
+        :return: A dict with:
+            - read_buffer: Data recieved, that hasn't been read yet.
+            - write_buffer: Data waiting to be written to the client.
+        """
+        return {"read_buffer": 0, "write_buffer": self.get_write_buffer_size()}
+
+    def pause_writing(self):
+        """
+        Called by the transport when its write buffer goes over the high-water mark.
+        """
+        self._paused = True
+
+    def resume_writing(self):
+        """
+        Called by the transport when its write buffer drains below the low-water mark.
+        """
+        self._paused = False
+        self._wake_drain()
+
+    def _wake_drain(self, exc=None):
+        """
+        Wake up the coroutine waiting in drain(), if there is one.
+        """
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    async def _drain_helper(self):
+        """
+        Wait until the transport's write buffer is below the high-water mark.
+
+        This is also used by :class:`asyncio.StreamWriter`, which calls back into its protocol.
+        """
+        if self._connection_lost:
+            raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+        self._drain_waiter = self._loop.create_future()
+        await self._drain_waiter
+
     def read(self) -> bytes:
         """
         Read all available data from the Butterfly.
         """
         pass
 
-    @asyncio.coroutine
-    def drain(self):
+    async def drain(self):
         """
-        Drain the writer, if applicable.
+        Wait until the write buffer has drained below the high-water mark.
         """
-        pass
+        await self._drain_helper()
 
     def write(self, data: bytes):
         """
@@ -100,35 +177,57 @@ class AbstractButterfly(asyncio.Protocol):
         """
         pass
 
+    def write_raw(self, data: bytes):
+        """
+        Write already encoded data straight to the transport.
+        :param data: The byte data to write.
+        """
+        self._transport.write(data)
+
 
 class Butterfly(AbstractButterfly):
     """
     A butterfly represents a client object that has connected to your server.
 
     This will automatically call the appropriate methods in your handler, and set information about ourselves.
+
+    The size of each read adapts to the connection: it doubles while reads come back full, and halves
+    after several reads in a row come back mostly empty. Reading from the client is paused once twice
+    the read size is buffered, so busy connections get large buffers and idle ones small buffers.
     """
 
+    # The range the read size adapts within. A buffer size set below the minimum is never shrunk.
+    min_read_size = 1024
+    max_read_size = 256 * 1024
+    # How many mostly empty reads in a row before the read size is halved.
+    shrink_after = 4
+
     def __init__(self, handler, bufsize, loop: asyncio.AbstractEventLoop):
         """
         Create a new butterfly.
         :param handler: The :class:`ButterflyHandler` to set as our handler.
-        :param bufsize: The buffersize to use for reading.
+        :param bufsize: The initial buffersize to use for reading.
         :param loop: The :class:`asyncio.BaseEventLoop` to use.
         """
         super().__init__(handler, loop=loop)
-        self._streamreader = asyncio.StreamReader(loop=self._loop)
+        self._streamreader = asyncio.StreamReader(limit=bufsize, loop=self._loop)
         self._streamwriter = None
 
         self._bufsize = bufsize
+        self._read_size = bufsize
+        self._small_reads = 0
+        # How many bytes have been recieved, but not read yet, and whether reading from the client is paused.
+        # The StreamReader never sees the transport, so this is the only thing that pauses it.
+        self._buffered = 0
+        self._reading_paused = False
 
     def connection_made(self, transport: asyncio.Transport):
         """
         Called upon a connection being made.
 
         This will automatically call your BFHandler.on_connection().
-        :param transport: The transport to set the streamreader/streamwriter to.
+        :param transport: The transport to set the streamwriter to.
         """
-        self._streamreader.set_transport(transport)
         self._streamwriter = asyncio.StreamWriter(transport, self, self._streamreader, self._loop)
         super().connection_made(transport)
 
@@ -155,30 +254,74 @@ class Butterfly(AbstractButterfly):
         Otherwise, it will simply pass your data into the StreamReader.
         :param data: The data to handle.
         """
-        self.logger.debug("Recieved data: {}".format(data))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Recieved data: {}".format(data))
+        if self._handler.capture is not None:
+            self._handler.capture.record(self, data)
         self._streamreader.feed_data(data)
+        self._buffered += len(data)
+        if not self._reading_paused and self._buffered > 2 * self._read_size:
+            self._reading_paused = True
+            self._transport.pause_reading()
 
     def eof_received(self):
         """
         Called upon EOF recieved.
         """
+        # The client won't send anything else, so this is where its capture ends.
+        if self._handler.capture is not None:
+            self._handler.capture.record_close(self)
         self._streamreader.feed_eof()
         return True
 
-    @asyncio.coroutine
-    def read(self) -> bytes:
+    async def read(self) -> bytes:
         """
         Read in data from the Butterfly.
         :return: Bytes containing data from the butterfly.
         """
-        return (yield from self._streamreader.read(self._bufsize))
+        data = await self._streamreader.read(self._read_size)
+        self._buffered -= len(data)
+        self._adapt_read_size(len(data))
+        if self._reading_paused and self._buffered <= self._read_size and not self._connection_lost:
+            self._reading_paused = False
+            self._transport.resume_reading()
+        return data
+
+    def _adapt_read_size(self, size: int):
+        """
+        Grow or shrink the read size, based on how much the last read returned.
+        :param size: The number of bytes read.
+        """
+        if size >= self._read_size:
+            self._small_reads = 0
+            if self._read_size < self.max_read_size:
+                self._read_size = min(self._read_size * 2, self.max_read_size)
+        elif size < self._read_size // 4:
+            self._small_reads += 1
+            if self._small_reads >= self.shrink_after and self._read_size > self.min_read_size:
+                self._small_reads = 0
+                self._read_size = max(self._read_size // 2, self.min_read_size)
+        else:
+            self._small_reads = 0
+
+    def memory_stats(self) -> dict:
+        """
+        Get the number of bytes this connection is holding in memory.
+        :return: A dict with:
+            - read_buffer: Data recieved, that hasn't been read yet.
+            - write_buffer: Data waiting to be written to the client.
+            - read_size: The current read size.
+        """
+        stats = super().memory_stats()
+        stats["read_buffer"] = self._buffered
+        stats["read_size"] = self._read_size
+        return stats
 
-    @asyncio.coroutine
-    def drain(self):
+    async def drain(self):
         """
         Drain the writer.
         """
-        return (yield from self._streamwriter.drain())
+        return (await self._streamwriter.drain())
 
     def write(self, data: bytes):
         """
@@ -21,6 +21,7 @@ import types
 import re
 
 from bfnet import Butterfly
+from bfnet.util import as_coroutine_function
 
 
 class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad.
@@ -55,16 +56,25 @@ class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad
 
     def _set_bf_handler(self, handler):
         self.bf_handler = handler
+        self.logger = handler.logger
 
-    @asyncio.coroutine
-    def stop(self):
+    async def stop(self):
         """
         Stops the Net.
-        """
-        yield from self.server.wait_closed()
 
-    @asyncio.coroutine
-    def handle(self, butterfly: Butterfly):
+        This unbinds the server, drops every Butterfly still connected, and waits for the server to close.
+        """
+        if self.server is None:
+            return
+        self.server.close()
+        # Since Python 3.12, wait_closed() also waits for every connection to the server to be closed.
+        if self.bf_handler is not None:
+            for bf, _ in list(self.bf_handler.butterflies.values()):
+                if not bf._closing:
+                    bf.stop()
+        await self.server.wait_closed()
+
+    async def handle(self, butterfly: Butterfly):
         """
         Default handler.
 
@@ -74,18 +84,21 @@ class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad
         """
         # Enter an infinite loop.
         self.logger.debug("Dropped into default handler for new client")
+        handlers = self.handlers
         while True:
-            data = yield from butterfly.read()
+            data = await butterfly.read()
             if data is None or data == b'':
                 return
             else:
-                self.logger.debug("Handling data: {}".format(data))
+                # Don't format the data unless it will be logged.
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Handling data: {}".format(data))
                 # Loop over handlers.
-                for handler in self.handlers:
+                for handler in handlers:
                     # Check the match
                     matched = handler(data)
                     if matched is not None:
-                        yield from matched(data, butterfly, self.bf_handler)
+                        await matched(data, butterfly, self.bf_handler)
                         break
                 else:
                     self.logger.error("No valid handler")
@@ -95,11 +108,15 @@ class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad
     def any_data(self, func):
         """
         Decorator for ANY match.
+
+        Handlers should be coroutines. Generator-based coroutines are adapted once, here.
         :param func: The function to decorate.
         :return: The same function.
         """
+        handler = as_coroutine_function(func)
+
         def match(data: bytes):
-            return func
+            return handler
         self.handlers.append(match)
         return func
 
@@ -114,13 +131,14 @@ class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad
         def real_decorator(func: types.FunctionType):
             # Compile the regexp pattern.
             pattern = re.compile(regexp)
+            handler = as_coroutine_function(func)
 
             # Create a match function.
             def match(data: bytes):
                 # Match it - if it works, return the func. Else, return None.
                 data = data.decode()
                 if pattern.match(data):
-                    return func
+                    return handler
                 else:
                     return None
 
@@ -137,10 +155,12 @@ class Net(....__class__.__class__.__base__):  # you are ugly and should feel bad
         :param end: The end to search to.
         """
         def real_decorator(func: types.FunctionType):
+            handler = as_coroutine_function(func)
+
             def match(data: bytes):
                 data = data.decode()
-                if data.startswith(prefix=prefix, start=start, end=end):
-                    return func
+                if data.startswith(prefix, start, end):
+                    return handler
                 else:
                     return None
 
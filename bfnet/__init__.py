@@ -1,5 +1,8 @@
 from .Net import Net
 from .Butterfly import Butterfly
 from .BFHandler import ButterflyHandler
+from .Bridge import AbstractBridge, UnixBridge
+from .sockopts import SocketOptions
+from .registry import ConnectionRegistry
 
 get_handler = ButterflyHandler.get_handler
@@ -0,0 +1,274 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Recording and replaying the traffic a server recieves.
+#
+# Capturing is turned on with :func:`bfnet.ButterflyHandler.start_capture`. Everything every connection sends
+# the server is appended to a compact binary log, exactly as data_received() saw it, after TLS has been removed.
+# Records are buffered, and copied into a memory-mapped file in large blocks, so capturing costs little more than
+# a bytearray append per read.
+#
+# The log is a header of "!5sBd" (b"BFCAP", the format version, and the wall clock time capturing started),
+# followed by records of "!dIBI" (the time since capturing started, the connection, the record kind, and the size
+# of the data), each followed by its data. The data of an EVENT_OPEN record is the "ip:port" of the client.
+#
+# :func:`replay` re-drives a log against a server, with one simulated client for every connection in it,
+# as fast as it was recorded, a multiple of that, or as fast as possible. See benchmarks/replay.py.
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+
+file_header = struct.Struct("!5sBd")
+record_header = struct.Struct("!dIBI")
+
+CAPTURE_MAGIC = b"BFCAP"
+CAPTURE_VERSION = 1
+
+# Data recieved from a client.
+EVENT_DATA = 0
+# A client connected.
+EVENT_OPEN = 1
+# A client disconnected.
+EVENT_CLOSE = 2
+
+
+class TrafficCapture(object):
+    """
+    A capture log being written.
+    """
+
+    def __init__(self, path: str, max_bytes: int=64 * 1024 * 1024, buffer_size: int=64 * 1024, clock=time.time):
+        """
+        Create a new TrafficCapture.
+        :param path: The file to write. It will be created or truncated.
+        :param max_bytes: The largest the file can get. Once it is full, nothing else is recorded.
+        :param buffer_size: How much is buffered before it is copied into the file.
+        :param clock: The clock to timestamp records with.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self._clock = clock
+        self._start = clock()
+
+        with open(path, "wb") as f:
+            f.truncate(max_bytes)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), max_bytes)
+        self._buffer = bytearray(file_header.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self._start))
+        self._write = 0
+
+        # A dict of Butterfly -> the ID it is recorded under.
+        self._connections = {}
+        self._next_id = 1
+
+        self.records = 0
+        # The number of records that didn't fit in the file.
+        self.dropped = 0
+        self.closed = False
+
+    def _append(self, connection: int, kind: int, data: bytes):
+        if self.dropped:
+            # Once anything has been dropped, stop, so the log never has holes in it.
+            self.dropped += 1
+            return
+        buf = self._buffer
+        buf += record_header.pack(self._clock() - self._start, connection, kind, len(data))
+        buf += data
+        self.records += 1
+        if len(buf) >= self.buffer_size:
+            self.flush()
+
+    def record_open(self, butterfly):
+        """
+        Record a new connection.
+        :param butterfly: The Butterfly that connected.
+        """
+        connection = self._connections[butterfly] = self._next_id
+        self._next_id += 1
+        self._append(connection, EVENT_OPEN, "{}:{}".format(butterfly.ip, butterfly.client_port).encode())
+
+    def record(self, butterfly, data: bytes):
+        """
+        Record data recieved from a connection.
+        :param butterfly: The Butterfly that recieved it.
+        :param data: The data.
+        """
+        connection = self._connections.get(butterfly)
+        if connection is not None:
+            self._append(connection, EVENT_DATA, data)
+
+    def record_close(self, butterfly):
+        """
+        Record a connection closing.
+        :param butterfly: The Butterfly that disconnected.
+        """
+        connection = self._connections.pop(butterfly, None)
+        if connection is not None:
+            self._append(connection, EVENT_CLOSE, b"")
+
+    def flush(self):
+        """
+        Copy the buffered records into the file.
+        """
+        buf = self._buffer
+        if not buf:
+            return
+        end = self._write + len(buf)
+        if end > self.max_bytes:
+            # Drop everything buffered, rather than leave half a record at the end.
+            self.dropped += 1
+            buf.clear()
+            return
+        self._map[self._write:end] = buf
+        self._write = end
+        buf.clear()
+
+    def close(self):
+        """
+        Stop capturing, and trim the file to the records written.
+        """
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self._map.close()
+        self._file.truncate(self._write)
+        self._file.close()
+
+
+def read_capture(path: str):
+    """
+    Read the records of a capture log.
+    :param path: The log file.
+    :return: A generator of (seconds since capturing started, connection, kind, data).
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < file_header.size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _ = file_header.unpack_from(data)
+            if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+                raise ValueError("{} is not a capture log".format(path))
+            offset = file_header.size
+            while offset + record_header.size <= size:
+                timestamp, connection, kind, length = record_header.unpack_from(data, offset)
+                if connection == 0:
+                    # The rest of a file that wasn't closed properly.
+                    return
+                offset += record_header.size
+                yield timestamp, connection, kind, data[offset:offset + length]
+                offset += length
+        finally:
+            data.close()
+
+
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def replay(path: str, host: str, port: int, speed: float=1.0, copies: int=1, ssl=None) -> dict:
+    """
+    Replay a capture log against a server.
+
+    Every connection in the log becomes a simulated client, which connects and sends what the original client
+    sent, at the same times. Latency is measured from each write to the next data the client recieves.
+
+    This method is a coroutine.
+    :param path: The log file.
+    :param host: The host of the server.
+    :param port: The port of the server.
+    :param speed: How many times faster than recorded to replay, or 0 to replay as fast as possible.
+    :param copies: How many simulated clients to run for every connection in the log.
+    :param ssl: An :class:`ssl.SSLContext` to connect with, or None for plaintext.
+    :return: A dict with the number of clients, the number of errors, the bytes and writes sent, the time taken,
+        the throughput in bytes and writes per second, and the p50, p99 and maximum latency in seconds.
+    """
+    loop = asyncio.get_event_loop()
+    # A dict of connection -> (time opened, list of (time, data)).
+    connections = {}
+    for timestamp, connection, kind, data in read_capture(path):
+        if kind == EVENT_OPEN:
+            connections[connection] = (timestamp, [])
+        elif kind == EVENT_DATA and connection in connections:
+            connections[connection][1].append((timestamp, bytes(data)))
+
+    latencies = []
+    totals = {"bytes": 0, "writes": 0, "errors": 0}
+    start = loop.time()
+
+    async def wait_until(timestamp: float):
+        if speed:
+            delay = start + timestamp / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def client(opened: float, writes: list):
+        await wait_until(opened)
+        try:
+            reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+        except OSError:
+            totals["errors"] += 1
+            return
+        # The times of writes that haven't had a reply yet.
+        sent = []
+
+        async def read_replies():
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                if sent:
+                    now = loop.time()
+                    latencies.append(now - sent[0])
+                    del sent[:]
+
+        replies = loop.create_task(read_replies())
+        try:
+            for timestamp, data in writes:
+                await wait_until(timestamp)
+                sent.append(loop.time())
+                writer.write(data)
+                totals["bytes"] += len(data)
+                totals["writes"] += 1
+                await writer.drain()
+            # Give the server a moment to reply to the last write.
+            deadline = loop.time() + 1.0
+            while sent and not replies.done() and loop.time() < deadline:
+                await asyncio.sleep(0.005)
+        except OSError:
+            totals["errors"] += 1
+        finally:
+            replies.cancel()
+            writer.close()
+
+    await asyncio.gather(*[client(opened, writes) for opened, writes in connections.values() for _ in range(copies)])
+    taken = loop.time() - start
+    latencies.sort()
+    return {"clients": len(connections) * copies, "errors": totals["errors"], "bytes": totals["bytes"],
+            "writes": totals["writes"], "seconds": taken,
+            "bytes_per_second": totals["bytes"] / taken if taken else 0.0,
+            "writes_per_second": totals["writes"] / taken if taken else 0.0,
+            "latency_p50": _percentile(latencies, 0.5), "latency_p99": _percentile(latencies, 0.99),
+            "latency_max": latencies[-1] if latencies else 0.0}
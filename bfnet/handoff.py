@@ -0,0 +1,85 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Passing listening sockets between processes, for zero-downtime restarts.
+#
+# The old process offers its sockets with :func:`bfnet.ButterflyHandler.offer_handoff`, and
+# the new process picks them up with :func:`receive_sockets`, before passing one to
+# :func:`bfnet.ButterflyHandler.create_server`.
+#
+# This uses SCM_RIGHTS over a Unix domain socket, so it is not available on Windows.
+
+import array
+import os
+import socket
+import struct
+
+# One int per socket, holding the socket family.
+_family_fmt = struct.Struct("!i")
+
+
+def send_sockets(conn: socket.socket, socks: list):
+    """
+    Send a list of sockets over a connected Unix domain socket.
+    :param conn: The blocking Unix domain socket to send over.
+    :param socks: The sockets to send.
+    """
+    families = b"".join(_family_fmt.pack(sock.family) for sock in socks)
+    fds = array.array("i", (sock.fileno() for sock in socks))
+    conn.sendmsg([families], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds.tobytes())])
+
+
+def recv_sockets(conn: socket.socket) -> list:
+    """
+    Receive a list of sockets sent with :func:`send_sockets`.
+    :param conn: The blocking Unix domain socket to receive on.
+    :return: A list of :class:`socket.socket` objects.
+    """
+    # 64 sockets ought to be enough for anybody.
+    max_fds = 64
+    msg, ancdata, _, _ = conn.recvmsg(_family_fmt.size * max_fds, socket.CMSG_LEN(max_fds * array.array("i").itemsize))
+
+    fds = array.array("i")
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+    socks = []
+    for i, fd in enumerate(fds):
+        family, = _family_fmt.unpack_from(msg, i * _family_fmt.size)
+        # fromfd() duplicates the descriptor, so close the one we were given.
+        socks.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+        os.close(fd)
+    return socks
+
+
+def receive_sockets(path: str, timeout: float=None) -> list:
+    """
+    Connect to a handoff socket, and receive the listening sockets of the old process.
+
+    This method blocks, so call it before the event loop is started.
+    :param path: The path of the Unix domain socket the old process is offering on.
+    :param timeout: How long to wait for the sockets, or None to wait forever.
+    :return: A list of :class:`socket.socket` objects.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+        return recv_sockets(conn)
+    finally:
+        conn.close()
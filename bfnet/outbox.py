@@ -0,0 +1,92 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Writing to clients from other threads.
+#
+# Butterflies can only be written to from the event loop's thread. Threads, such as the ones running
+# :func:`bfnet.ButterflyHandler.async_func`, hand their writes to the handler's :class:`Outbox` instead,
+# with :func:`bfnet.ButterflyHandler.send_threadsafe`.
+#
+# Waking the event loop up is far more expensive than queueing a write, so the loop is only woken once for
+# each batch: the first write after a flush schedules one, and everything queued before it runs is written
+# in the same callback.
+
+import collections
+import threading
+
+
+class Outbox(object):
+    """
+    A queue of writes from other threads, flushed on the event loop.
+    """
+
+    def __init__(self, loop, logger):
+        """
+        Create a new Outbox.
+        :param loop: The event loop the Butterflies belong to.
+        :param logger: The logger to report failed writes to.
+        """
+        self._loop = loop
+        self.logger = logger
+        # A deque of (butterfly, payload). Appending and popping are atomic, so this needs no lock.
+        self._pending = collections.deque()
+        # Only held to decide which thread schedules the next flush.
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+        # The number of times the loop has been woken up, and the number of writes flushed.
+        self.wakeups = 0
+        self.flushed = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def send(self, butterfly, payload):
+        """
+        Queue a write. This can be called from any thread.
+        :param butterfly: The Butterfly to write to.
+        :param payload: What to pass to its write(), such as bytes or a Packet.
+        """
+        self._pending.append((butterfly, payload))
+        # Checking without the lock first is safe: at worst, we take the lock for nothing.
+        if self._scheduled:
+            return
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        """
+        Write everything queued so far. This runs on the event loop.
+        """
+        # Clear the flag first, so anything queued from now on either gets written below, or schedules a new flush.
+        with self._lock:
+            self._scheduled = False
+        self.wakeups += 1
+        pending = self._pending
+        while pending:
+            butterfly, payload = pending.popleft()
+            self.flushed += 1
+            if butterfly._closing or butterfly._connection_lost:
+                continue
+            try:
+                butterfly.write(payload)
+            except Exception:
+                self.logger.exception("Failed to write to {}:{} from another thread".format(
+                    butterfly.ip, butterfly.client_port))
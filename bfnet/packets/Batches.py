@@ -0,0 +1,201 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Batch decoding of fixed-size packets.
+#
+# A packet class with a fixed `layout` and `batch` set to True is never decoded one packet at a time. Instead,
+# every run of consecutive frames of that type in the receive buffer is decoded in one pass into columns, and
+# read() returns a single :class:`PacketBatch` for the whole run.
+#
+# The columns are a NumPy structured array if NumPy is installed, or a dict of :class:`array.array` otherwise.
+#
+# Only frames with a length, and without compression or checksums, are decoded in runs. Any other frame of the
+# type arrives as a batch of one, except for frames on a channel, which are delivered to the channel as packets.
+
+import array
+import struct
+
+# NumPy is slow to import, so it is only imported when the first decoder is made. See _get_numpy().
+numpy = None
+_numpy_loaded = False
+
+# The NumPy type for each struct code.
+_numpy_types = {"b": "i1", "B": "u1", "?": "?", "h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+                "q": "i8", "Q": "u8", "e": "f2", "f": "f4", "d": "f8"}
+
+
+def _get_numpy():
+    """
+    Import NumPy, the first time it is needed.
+    :return: The numpy module, or None if it isn't installed.
+    """
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        _numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def _array_type(code: str):
+    """
+    Get the array typecode with the same size as a standard struct code, or None if there isn't one.
+    """
+    if code in "fd":
+        return code
+    if code == "?":
+        return "B"
+    size = struct.calcsize("!" + code)
+    for typecode in "bhilq":
+        if array.array(typecode).itemsize == size:
+            return typecode.upper() if code.isupper() else typecode
+    return None
+
+
+# The array typecode for each struct code.
+_array_types = {code: _array_type(code) for code in _numpy_types}
+
+
+def parse_layout(layout: str) -> list:
+    """
+    Split a struct layout into one code per field.
+    :param layout: The struct format, such as "!Iff" or "!I16s".
+    :return: A list of codes, such as ["I", "f", "f"] or ["I", "16s"].
+    """
+    codes = []
+    count = ""
+    for char in layout.lstrip("@=<>!"):
+        if char.isdigit():
+            count += char
+        elif char == "s":
+            codes.append((count or "1") + "s")
+            count = ""
+        elif char in _numpy_types:
+            codes.extend([char] * int(count or 1))
+            count = ""
+        elif not char.isspace():
+            raise ValueError("Unsupported code {} in batch layout {}".format(char, layout))
+    return codes
+
+
+class BatchDecoder(object):
+    """
+    Decodes runs of one packet type, with a given header size, into columns.
+    """
+
+    def __init__(self, packet_type, header_size: int):
+        """
+        Create a new BatchDecoder.
+        :param packet_type: The packet class, which must have `layout` and `fields` set.
+        :param header_size: The size of the frame header in front of each body.
+        """
+        self.packet_type = packet_type
+        self.header_size = header_size
+        self.fields = tuple(packet_type.fields)
+        self.codes = parse_layout(packet_type.layout)
+        if len(self.codes) != len(self.fields):
+            raise ValueError("{} has {} fields, but its layout has {} values".format(
+                packet_type.__name__, len(self.fields), len(self.codes)))
+        order = ">" if packet_type.layout[:1] in "!>" else "<" if packet_type.layout[:1] == "<" else "="
+        # The whole frame, with the header skipped over.
+        self.record = struct.Struct("{}{}x{}".format("!" if order == ">" else order, header_size,
+                                                     "".join(self.codes)))
+        self.numpy = _get_numpy()
+        if self.numpy is not None:
+            self.dtype = self.numpy.dtype([("", "V{}".format(header_size))] + [
+                (name, "S" + code[:-1] if code.endswith("s") else order + _numpy_types[code])
+                for name, code in zip(self.fields, self.codes)])
+
+    def decode(self, data: bytes, count: int):
+        """
+        Decode a run of frames.
+        :param data: The frames, including their headers.
+        :param count: The number of frames.
+        :return: The columns.
+        """
+        if self.numpy is not None:
+            rows = self.numpy.frombuffer(data, self.dtype, count)
+            # Drop the header column, so the array only has the packet's own fields.
+            return rows[list(self.fields)]
+        columns = list(zip(*self.record.iter_unpack(data)))
+        result = {}
+        for name, code, column in zip(self.fields, self.codes, columns):
+            if code.endswith("s") or _array_types[code] is None:
+                result[name] = list(column)
+            else:
+                result[name] = array.array(_array_types[code], column)
+        return result
+
+
+# A dict of (packet type, header size) -> BatchDecoder.
+_decoders = {}
+
+
+def get_decoder(packet_type, header_size: int) -> BatchDecoder:
+    """
+    Get the decoder for a packet type, creating it if needed.
+    """
+    key = (packet_type, header_size)
+    decoder = _decoders.get(key)
+    if decoder is None:
+        decoder = _decoders[key] = BatchDecoder(packet_type, header_size)
+    return decoder
+
+
+class PacketBatch(object):
+    """
+    A run of packets of one type, decoded into columns.
+
+    This is returned by read() instead of the packets themselves. Get a column with `batch["name"]`.
+    """
+
+    def __init__(self, butterfly, packet_type, columns, count: int):
+        self.butterfly = butterfly
+        self.packet_type = packet_type
+        self.id = packet_type.id
+        # A NumPy structured array, or a dict of field name -> array.array.
+        self.columns = columns
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, name: str):
+        return self.columns[name]
+
+    def packets(self):
+        """
+        Turn the batch back into packet objects, one at a time.
+
+        This is slow, and only meant for code that can't handle columns.
+        """
+        fields = self.packet_type.fields
+        columns = [self.columns[name] for name in fields]
+        for row in zip(*columns):
+            packet = self.packet_type(self.butterfly)
+            for name, value in zip(fields, row):
+                setattr(packet, name, value.item() if hasattr(value, "item") else value)
+            yield packet
+
+    def release(self):
+        # Batches are never pooled.
+        pass
+
+    def retain(self):
+        pass
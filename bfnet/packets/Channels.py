@@ -0,0 +1,190 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Logical channels, multiplexed over a single connection.
+#
+# Frames with the FLAG_CHANNEL header flag carry a channel ID before their body. Channel 0 is the
+# connection itself, and works exactly like a connection without channels.
+#
+# Every other channel has its own handler coroutine, set with :func:`bfnet.packets.PacketNet.set_channel_handler`,
+# and its own inbound queue. Each direction of a channel has a flow control window, in bytes, which starts at
+# :attr:`Channel.window_size`. Sending a frame uses up window, and the reciever gives it back with a
+# :class:`ChannelWindowPacket` once its handler has read the packets. Frames that don't fit into the window
+# are queued, and sent fairly, one frame from each channel at a time. A frame bigger than the whole window is only
+# sent once all of the window has been given back. A sender that goes over the window is dropped.
+
+import asyncio
+import collections
+import struct
+
+from bfnet.util import new_queue
+from .Packets import Packet
+from .Scheduling import PRIORITY_CONTROL
+
+# The channel ID that follows the header (and length) of a FLAG_CHANNEL frame.
+channel_header = struct.Struct("!H")
+
+
+class ChannelWindowPacket(Packet):
+    """
+    The control packet used to give flow control window back to the sender of a channel.
+    """
+    # Negative IDs are reserved for ButterflyNet's own packets.
+    id = -3
+    fields = ("increment",)
+    priority = PRIORITY_CONTROL
+
+    _layout = struct.Struct("!I")
+
+    def __init__(self, pbf, increment: int=0):
+        super().__init__(pbf)
+        self.increment = increment
+
+    def unpack(self, data: bytes) -> bool:
+        self.increment, = self._layout.unpack(data[:self._layout.size])
+        return True
+
+    def gen(self) -> bytes:
+        return self._layout.pack(self.increment)
+
+
+class Channel(object):
+    """
+    A logical channel on a :class:`bfnet.packets.PacketButterfly`.
+
+    This has the same read() and write() interface as a PacketButterfly, so the same handlers work on both.
+    """
+
+    # The initial flow control window, in bytes, for each direction.
+    window_size = 256 * 1024
+
+    def __init__(self, butterfly, channel_id: int):
+        """
+        Create a new Channel.
+        :param butterfly: The PacketButterfly the channel runs over.
+        :param channel_id: The ID of the channel.
+        """
+        self.butterfly = butterfly
+        self.channel_id = channel_id
+        self.logger = butterfly.logger
+
+        self.packet_queue = new_queue(butterfly._loop)
+        # The handler task for this channel.
+        self.task = None
+
+        # How much more we can send before the reciever gives us more window.
+        self.send_window = self.window_size
+        # Frames waiting for window, or for the transport to drain.
+        self._outbound = collections.deque()
+        # How many bytes our handler has read since we last gave window back.
+        self._consumed = 0
+        # How many bytes we have recieved that we haven't given window back for.
+        self._unacked = 0
+        # The last packet returned by read(), to release back into its pool.
+        self._last_packet = None
+
+    @property
+    def handler(self):
+        return self.butterfly.handler
+
+    def packet_received(self, packet, size: int):
+        """
+        Called by the Butterfly when a packet arrives on this channel.
+        :param packet: The packet.
+        :param size: The size of the frame body, which counts against the window.
+        """
+        if self._unacked and self._unacked + size > self.window_size:
+            packet.release()
+            self.butterfly.protocol_error("Channel {} went over its flow control window, dropping client.".format(
+                self.channel_id))
+            return
+        self._unacked += size
+        self.packet_queue.put_nowait((packet, size))
+
+    async def read(self):
+        """
+        Get a new packet off this channel's queue.
+
+        This gives window back to the sender once half of it has been used up.
+        If the previous packet returned is pooled, it is released back into its pool.
+        """
+        self._release_last()
+        queue = self.packet_queue
+        item = queue.get_nowait() if not queue.empty() else await queue.get()
+        if item is None:
+            return None
+        packet, size = item
+        self._consumed += size
+        if self._consumed >= self.window_size // 2:
+            self.butterfly.send_control(ChannelWindowPacket(self, self._consumed), self.channel_id)
+            self._unacked -= self._consumed
+            self._consumed = 0
+        self._last_packet = packet
+        return packet
+
+    def _release_last(self):
+        """
+        Release the last packet returned by read() back into its pool.
+        """
+        if self._last_packet is not None:
+            self._last_packet.release()
+            self._last_packet = None
+
+    def write(self, pack):
+        """
+        Write a packet to this channel.
+
+        If the channel is out of window, the packet is queued until the reciever gives more.
+        :param pack: The packet to write.
+        """
+        self._outbound.append((pack.id, self.butterfly._handler.frame_cache.body(pack), pack.compress))
+        self.butterfly.schedule_channel(self)
+
+    def window_received(self, increment: int):
+        """
+        Called by the Butterfly when the reciever gives window back.
+        :param increment: The number of bytes of window given back.
+        """
+        self.send_window += increment
+        if self._outbound:
+            self.butterfly.schedule_channel(self)
+
+    def can_send(self) -> bool:
+        """
+        Check if this channel has a frame waiting, and the window to send it.
+        """
+        if not self._outbound:
+            return False
+        # A frame bigger than the whole window can only go once nothing else is in flight.
+        return len(self._outbound[0][1]) <= self.send_window or self.send_window >= self.window_size
+
+    def pop_frame(self) -> tuple:
+        """
+        Take the next frame to send, using up window for it.
+        :return: A tuple of (id, body, compress).
+        """
+        frame = self._outbound.popleft()
+        self.send_window -= len(frame[1])
+        return frame
+
+    def close(self):
+        """
+        Close the channel, stopping its handler.
+        """
+        self._outbound.clear()
+        self._release_last()
+        self.packet_queue.put_nowait(None)
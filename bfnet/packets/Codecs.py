@@ -0,0 +1,354 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Frame codecs, and the handshake that picks one.
+#
+# Every connection starts out with the version 1 :class:`LegacyCodec`, which works out what the peer can do
+# from the flags on every frame it sends. A peer that wants something better sends a :class:`HelloPacket`
+# as its first frame, holding the highest protocol version and the features it supports. The other side
+# replies with a HelloPacket holding the version and features both sides support, and from then on both sides
+# use the codec for that version and those features, which only does the checks that still apply.
+#
+# Peers that never send a HelloPacket keep using version 1, so old and new clients can share a server.
+# The peer that starts the handshake MUST NOT send anything else until it gets the reply.
+#
+# Version 2 frames always carry a length, and may carry a CRC32 of the body after it.
+#
+# Runs of frames of a packet type with `batch` set are split off in one go, and decoded together into a
+# :class:`bfnet.packets.Batches.PacketBatch`, as long as they carry a length and are not compressed, on a channel,
+# or checksummed.
+
+import struct
+import zlib
+
+from .Packets import Packet
+from .Scheduling import PRIORITY_CONTROL
+
+# The base protocol version, spoken by every connection before the handshake.
+PROTOCOL_VERSION = 1
+# The highest protocol version we can speak.
+MAX_PROTOCOL_VERSION = 2
+
+# The frame body has been compressed with the connection's compression context.
+FLAG_COMPRESSED = 0x01
+# The sender of the frame is able to decompress frames sent to it.
+FLAG_ACCEPTS_COMPRESSION = 0x02
+# The header is followed by the length of the body.
+# Frames without this flag take up the rest of the data recieved.
+FLAG_LENGTH = 0x04
+# The frame is part of a stream. See :mod:`bfnet.packets.Streams`.
+FLAG_STREAM = 0x08
+# The header (and length) is followed by a channel ID. See :mod:`bfnet.packets.Channels`.
+FLAG_CHANNEL = 0x10
+# The frame was recorded in the session journal, and takes the next sequence number.
+# See :mod:`bfnet.packets.Sessions`.
+FLAG_SEQUENCED = 0x20
+
+# Version 2 features, negotiated in the handshake.
+# Bodies may be compressed. Both sides must have the same compression settings.
+FEATURE_COMPRESSION = 0x01
+# Every frame body is followed by its CRC32.
+FEATURE_CHECKSUM = 0x02
+
+# b"BF", as a big-endian short, so checking it is an integer comparison.
+MAGIC = 0x4246
+
+# The frame header: magic, flags, version, packet ID.
+# On the wire this is the same as "!2shh", with the flags in the high byte of the version.
+header = struct.Struct("!HBBh")
+# The frame header, followed by the length of the body.
+framed_header = struct.Struct("!HBBhI")
+# The length that follows the header of a FLAG_LENGTH frame.
+frame_length = struct.Struct("!I")
+# The checksum that follows the body, with FEATURE_CHECKSUM.
+checksum = struct.Struct("!I")
+
+
+class HelloPacket(Packet):
+    """
+    The control packet used to negotiate the protocol version and features of a connection.
+    """
+    # Negative IDs are reserved for ButterflyNet's own packets.
+    id = -4
+    fields = ("version", "features")
+    priority = PRIORITY_CONTROL
+
+    _layout = struct.Struct("!HI")
+
+    def __init__(self, pbf, version: int=MAX_PROTOCOL_VERSION, features: int=0):
+        super().__init__(pbf)
+        self.version = version
+        self.features = features
+
+    def unpack(self, data: bytes) -> bool:
+        self.version, self.features = self._layout.unpack(data[:self._layout.size])
+        return True
+
+    def gen(self) -> bytes:
+        return self._layout.pack(self.version, self.features)
+
+
+def negotiate(version: int, features: int, max_version: int, supported_features: int) -> tuple:
+    """
+    Work out the version and features to use, from what the peer asked for and what we support.
+    :param version: The highest version the peer supports.
+    :param features: The features the peer asked for.
+    :param max_version: The highest version we support.
+    :param supported_features: The features we support.
+    :return: A tuple of (version, features).
+    """
+    version = min(version, max_version)
+    if version < 2:
+        return version, 0
+    return version, features & supported_features
+
+
+def select_codec(butterfly, version: int, features: int):
+    """
+    Create the codec for a negotiated version and set of features.
+    :param butterfly: The :class:`bfnet.packets.PacketButterfly` to create it for.
+    :param version: The negotiated protocol version.
+    :param features: The negotiated features.
+    :return: A new codec.
+    """
+    if version < 2:
+        return LegacyCodec(butterfly)
+    if features & FEATURE_CHECKSUM:
+        return ChecksumCodec(butterfly, features)
+    return FramedCodec(butterfly, features)
+
+
+class LegacyCodec(object):
+    """
+    The version 1 codec.
+
+    Frames may or may not carry a length, and the peer's abilities are learned from the flags on each frame.
+    """
+    version = PROTOCOL_VERSION
+    # Can stream chunks be sent with sendfile()?
+    sendfile = True
+
+    def __init__(self, butterfly):
+        self.butterfly = butterfly
+
+    @property
+    def variant(self):
+        """
+        A key that is equal for every connection that encodes frames the same way.
+        """
+        bf = self.butterfly
+        return self.version, bf.peer_framed or bf.frame_lengths, bf._compressor is not None
+
+    def feed(self, buf: bytearray):
+        """
+        Split buffered data into frames, handing each one to the Butterfly.
+
+        Used up data is removed from the buffer.
+        :param buf: The data recieved.
+        """
+        bf = self.butterfly
+        while len(buf) >= 6:
+            magic, flags, version, id = header.unpack_from(buf)
+            if magic != MAGIC:
+                bf.protocol_error("Recieved unknown packet with magic number {}".format(bytes(buf[:2])))
+                return
+            if version != self.version:
+                bf.protocol_error("Recieved packet with unsupported protocol version {}".format(version))
+                return
+            if flags & FLAG_LENGTH:
+                if len(buf) < framed_header.size:
+                    return
+                size, = frame_length.unpack_from(buf, 6)
+                if size > bf.max_frame_size:
+                    bf.protocol_error("Frame of {} bytes is too large, dropping client.".format(size))
+                    return
+                start = framed_header.size
+                end = start + size
+                if len(buf) < end:
+                    # Wait for the rest of the frame.
+                    return
+                bf.peer_framed = True
+                packet_type = bf._handler.batch_types.get(id)
+                if packet_type is not None and not flags & ~(FLAG_LENGTH | FLAG_ACCEPTS_COMPRESSION) \
+                        and size == packet_type._layout_size:
+                    if flags & FLAG_ACCEPTS_COMPRESSION and bf._compressor is not None:
+                        bf.peer_accepts_compression = True
+                    self._feed_run(buf, packet_type, start + size)
+                    if bf._closing:
+                        return
+                    continue
+            else:
+                # Unframed packets take up everything we have.
+                start, end = 6, len(buf)
+            if flags & FLAG_ACCEPTS_COMPRESSION and bf._compressor is not None:
+                bf.peer_accepts_compression = True
+            body = bytes(buf[start:end])
+            del buf[:end]
+            bf.frame_received(version, flags, id, body)
+            if bf._closing:
+                return
+            if bf.codec is not self:
+                # The handshake has finished, and the rest of the data is in the new format.
+                bf.codec.feed(buf)
+                return
+
+    def _feed_run(self, buf: bytearray, packet_type, record: int):
+        """
+        Hand a run of frames of a batched packet type to the Butterfly in one go.
+
+        The run is every frame at the start of the buffer with exactly the same header and length as the first.
+        :param buf: The data recieved, starting with a complete frame of the packet type.
+        :param packet_type: The packet type, which has `batch` set.
+        :param record: The size of each frame, including the header.
+        """
+        prefix = bytes(buf[:framed_header.size])
+        end = record
+        while len(buf) >= end + record and buf.startswith(prefix, end):
+            end += record
+        data = bytes(buf[:end])
+        del buf[:end]
+        self.butterfly.batch_received(packet_type, data, framed_header.size, end // record)
+
+    def encode(self, flags: int, id: int, body: bytes) -> bytes:
+        """
+        Add a header to a frame body.
+        :param flags: The frame flags.
+        :param id: The packet ID.
+        :param body: The frame body.
+        :return: The encoded frame.
+        """
+        bf = self.butterfly
+        if bf._compressor is not None:
+            flags |= FLAG_ACCEPTS_COMPRESSION
+        if bf.frame_lengths or bf.peer_framed or flags & (FLAG_LENGTH | FLAG_STREAM | FLAG_CHANNEL):
+            # An unframed frame would swallow any framed frame after it, so once one is sent, frame everything.
+            bf.frame_lengths = True
+            return framed_header.pack(MAGIC, flags | FLAG_LENGTH, self.version, id, len(body)) + body
+        return header.pack(MAGIC, flags, self.version, id) + body
+
+    def header(self, flags: int, id: int, size: int) -> bytes:
+        """
+        Encode just the header and length of a frame, for a body that will be written separately.
+        :param flags: The frame flags.
+        :param id: The packet ID.
+        :param size: The size of the body.
+        :return: The encoded header.
+        """
+        self.butterfly.frame_lengths = True
+        return framed_header.pack(MAGIC, flags | FLAG_LENGTH, self.version, id, size)
+
+    def reencode(self, frame: bytes) -> bytes:
+        """
+        Convert a frame from :func:`bfnet.packets.PacketHandler.encode_frame` into this codec's format.
+        :param frame: The frame, including the header.
+        :return: The converted frame.
+        """
+        bf = self.butterfly
+        if bf.frame_lengths or bf.peer_framed:
+            magic, flags, version, id = header.unpack_from(frame)
+            if bf._compressor is None:
+                flags &= ~FLAG_ACCEPTS_COMPRESSION
+            return framed_header.pack(magic, flags | FLAG_LENGTH, version, id, len(frame) - 6) + frame[6:]
+        if bf._compressor is None and frame[2] & FLAG_ACCEPTS_COMPRESSION:
+            # The handler has compression enabled, but this connection doesn't, such as a datagram peer.
+            return frame[:2] + bytes((frame[2] & ~FLAG_ACCEPTS_COMPRESSION,)) + frame[3:]
+        return frame
+
+
+class FramedCodec(LegacyCodec):
+    """
+    The version 2 codec.
+
+    Every frame carries a length, and compression has been agreed on in the handshake.
+    """
+    version = 2
+
+    def __init__(self, butterfly, features: int=0):
+        super().__init__(butterfly)
+        self.features = features
+
+    @property
+    def variant(self):
+        return self.version, self.features
+
+    def feed(self, buf: bytearray):
+        bf = self.butterfly
+        while len(buf) >= 10:
+            magic, flags, version, id, size = framed_header.unpack_from(buf)
+            if magic != MAGIC or version != self.version:
+                bf.protocol_error("Recieved packet with bad header {}".format(bytes(buf[:6])))
+                return
+            if size > bf.max_frame_size:
+                bf.protocol_error("Frame of {} bytes is too large, dropping client.".format(size))
+                return
+            end = 10 + size
+            if len(buf) < end:
+                return
+            packet_type = bf._handler.batch_types.get(id)
+            if packet_type is not None and not flags & ~(FLAG_LENGTH | FLAG_ACCEPTS_COMPRESSION) \
+                    and size == packet_type._layout_size:
+                self._feed_run(buf, packet_type, end)
+                if bf._closing:
+                    return
+                continue
+            body = bytes(buf[10:end])
+            del buf[:end]
+            bf.frame_received(version, flags, id, body)
+            if bf._closing:
+                return
+
+    def encode(self, flags: int, id: int, body: bytes) -> bytes:
+        return framed_header.pack(MAGIC, flags | FLAG_LENGTH, self.version, id, len(body)) + body
+
+    def reencode(self, frame: bytes) -> bytes:
+        magic, flags, version, id = header.unpack_from(frame)
+        return self.encode(flags & ~FLAG_ACCEPTS_COMPRESSION, id, frame[6:])
+
+
+class ChecksumCodec(FramedCodec):
+    """
+    The version 2 codec, with a CRC32 after every frame body.
+    """
+    # The checksum has to be written after the body, so the kernel can't send it for us.
+    sendfile = False
+
+    def feed(self, buf: bytearray):
+        bf = self.butterfly
+        while len(buf) >= 10:
+            magic, flags, version, id, size = framed_header.unpack_from(buf)
+            if magic != MAGIC or version != self.version:
+                bf.protocol_error("Recieved packet with bad header {}".format(bytes(buf[:6])))
+                return
+            if size > bf.max_frame_size:
+                bf.protocol_error("Frame of {} bytes is too large, dropping client.".format(size))
+                return
+            end = 10 + size
+            if len(buf) < end + 4:
+                return
+            body = bytes(buf[10:end])
+            crc, = checksum.unpack_from(buf, end)
+            del buf[:end + 4]
+            if zlib.crc32(body) != crc:
+                bf.protocol_error("Recieved packet with bad checksum, id {}".format(id))
+                return
+            bf.frame_received(version, flags, id, body)
+            if bf._closing:
+                return
+
+    def encode(self, flags: int, id: int, body: bytes) -> bytes:
+        return framed_header.pack(MAGIC, flags | FLAG_LENGTH, self.version, id, len(body)) + body + \
+            checksum.pack(zlib.crc32(body))
@@ -0,0 +1,223 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Packets over UDP.
+#
+# This is for low-latency data that can be lost, such as position updates. There is no TLS, no
+# ordering and no retransmission - if you need any of those, use the normal TCP server.
+#
+# Each datagram holds one or more frames, in the same format as over TCP. Every address that sends us a
+# datagram gets a virtual :class:`DatagramButterfly`, which is disconnected after it has been idle for a while,
+# so your Net handlers work unchanged. Frames sent over UDP are never compressed.
+
+import asyncio
+
+from .PacketButterfly import PacketButterfly
+
+
+class _PeerTransport(asyncio.BaseTransport):
+    """
+    A fake transport, that sends to one peer through the shared datagram transport.
+    """
+
+    def __init__(self, endpoint, addr: tuple):
+        super().__init__()
+        self._endpoint = endpoint
+        self._addr = addr
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self._addr
+        return self._endpoint.transport.get_extra_info(name, default)
+
+    def write(self, data: bytes):
+        if not self._closing:
+            self._endpoint.transport.sendto(data, self._addr)
+
+    def writelines(self, list_of_data):
+        self.write(b"".join(list_of_data))
+
+    # Every peer shares the datagram transport's write buffer, so these all act on it.
+    def get_write_buffer_size(self) -> int:
+        return self._endpoint.transport.get_write_buffer_size()
+
+    def get_write_buffer_limits(self) -> tuple:
+        return self._endpoint.transport.get_write_buffer_limits()
+
+    def set_write_buffer_limits(self, high: int=None, low: int=None):
+        self._endpoint.transport.set_write_buffer_limits(high, low)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def pause_reading(self):
+        # There is nothing to pause - datagrams we can't take are just lost.
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._endpoint.expire(self._addr)
+
+
+class DatagramButterfly(PacketButterfly):
+    """
+    A virtual Butterfly for one peer of a :class:`DatagramEndpoint`.
+
+    Datagram peers never use compression, as each compressed frame depends on every frame compressed before it,
+    so one lost datagram would make every datagram after it unreadable.
+    """
+
+    def __init__(self, handler, loop: asyncio.AbstractEventLoop, max_packets=0):
+        super().__init__(handler, loop, max_packets)
+        # Without a compression context, we never tell the peer we accept compressed frames, or send any.
+        self._compressor = None
+
+    def data_received(self, data: bytes):
+        """
+        Parse the frames out of one datagram.
+
+        A frame cut short by the end of the datagram is dropped, rather than waiting for the next datagram.
+        :param data: The datagram.
+        """
+        super().data_received(data)
+        self._buffer.clear()
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """
+    A DatagramEndpoint recieves datagrams for a :class:`bfnet.packets.PacketHandler`, and hands them to the
+    virtual Butterfly of the peer that sent them.
+
+    It also acts as the server object for the :class:`bfnet.Net`.
+    """
+
+    def __init__(self, handler, loop: asyncio.AbstractEventLoop, idle_timeout: float=30.0):
+        """
+        Create a new DatagramEndpoint.
+        :param handler: The :class:`bfnet.packets.PacketHandler` to use.
+        :param loop: The event loop to use.
+        :param idle_timeout: How long a peer can go without sending anything before it is disconnected.
+        """
+        self._handler = handler
+        self._loop = loop
+        self.idle_timeout = idle_timeout
+
+        self.transport = None
+        # A dict of addr -> [butterfly, last seen time].
+        self.peers = {}
+
+        self._sweeper = None
+        self._closed = loop.create_future()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+        self._sweeper = self._loop.call_later(self.idle_timeout / 2, self._sweep)
+
+    def connection_lost(self, exc):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        for addr in list(self.peers):
+            self.expire(addr)
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        """
+        Hand a datagram to the peer that sent it, creating a new virtual Butterfly if needed.
+        """
+        peer = self.peers.get(addr)
+        if peer is None:
+            bf = self._handler.datagram_butterfly_factory()
+            peer = self.peers[addr] = [bf, 0]
+            bf.connection_made(_PeerTransport(self, addr))
+        peer[1] = self._loop.time()
+        peer[0].data_received(data)
+
+    def pause_writing(self):
+        """
+        Called by the transport when its write buffer goes over the high-water mark, which stops every peer writing.
+        """
+        for bf, _ in list(self.peers.values()):
+            bf.pause_writing()
+
+    def resume_writing(self):
+        """
+        Called by the transport when its write buffer drains below the low-water mark.
+        """
+        for bf, _ in list(self.peers.values()):
+            bf.resume_writing()
+
+    def error_received(self, exc):
+        self._handler.logger.warning("Datagram error: {}".format(exc))
+
+    def expire(self, addr: tuple):
+        """
+        Disconnect a peer.
+        :param addr: The address of the peer.
+        """
+        peer = self.peers.pop(addr, None)
+        if peer is not None:
+            peer[0]._transport._closing = True
+            peer[0].connection_lost(None)
+
+    def _sweep(self):
+        """
+        Disconnect every peer that has been idle for too long.
+
+        This runs on one timer for every peer, rather than having a timer each.
+        """
+        cutoff = self._loop.time() - self.idle_timeout
+        for addr, (_, last_seen) in list(self.peers.items()):
+            if last_seen < cutoff:
+                self.expire(addr)
+        self._sweeper = self._loop.call_later(self.idle_timeout / 2, self._sweep)
+
+    def send_group(self, pack, butterflies):
+        """
+        Send a packet to a group of peers, encoding it only once for each frame format in use.
+        :param pack: The packet to send.
+        :param butterflies: An iterable of :class:`DatagramButterfly` to send it to.
+        """
+        frame = self._handler.encode_packet(pack)
+        # A dict of codec variant -> encoded frame.
+        encoded = {}
+        for bf in butterflies:
+            variant = bf.codec.variant
+            data = encoded.get(variant)
+            if data is None:
+                data = encoded[variant] = bf.codec.reencode(frame)
+            bf._write_frame(data)
+
+    def close(self):
+        """
+        Stop recieving datagrams.
+        """
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        """
+        Wait for the endpoint to close.
+
+        This method is a coroutine.
+        """
+        await self._closed
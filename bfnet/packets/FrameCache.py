@@ -0,0 +1,155 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# A cache of encoded frames, for packets that are sent over and over again.
+#
+# Packet types opt in with one of two class attributes:
+#     - `immutable`: Instances never change once created, so each instance remembers its own frames.
+#     - `cacheable`: gen() only depends on the packet's fields, so frames are kept in a bounded LRU, keyed by
+#       the packet type and :func:`bfnet.packets.Packets.BasePacket.cache_key`.
+#
+# A frame is kept for each codec variant in use, so every connection with the same frame format is handed the
+# same bytes object. Compressed frames are never cached, as compression contexts belong to a single connection.
+
+import collections
+
+# The entry keys for the generated body, and for the frame from PacketHandler.encode_frame().
+# Codec variants are tuples, so these never clash with them.
+BODY = "body"
+FRAME = "frame"
+
+
+class FrameCache(object):
+    """
+    A bounded LRU of encoded frames, shared by every Butterfly of a handler.
+    """
+
+    def __init__(self, maxsize: int=1024):
+        """
+        Create a new FrameCache.
+        :param maxsize: The maximum number of packets to keep frames for. 0 disables the LRU.
+            Immutable packets keep their own frames, so they don't count towards this.
+        """
+        self.maxsize = maxsize
+        # An OrderedDict of (packet type, cache key) -> {variant: bytes}, least recently used first.
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _entry(self, pack):
+        """
+        Get the dict of frames for a packet, or None if it can't be cached.
+        """
+        if pack.immutable:
+            if pack._encoded is None:
+                pack._encoded = {}
+            return pack._encoded
+        if not pack.cacheable or not self.maxsize:
+            return None
+        try:
+            key = (type(pack), pack.cache_key())
+            entry = self._entries.get(key)
+        except TypeError:
+            # Something in the key can't be hashed, such as a list.
+            return None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        entry = self._entries[key] = {}
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def body(self, pack) -> bytes:
+        """
+        Get the body of a packet, only calling gen() if it isn't cached.
+        :param pack: The packet.
+        :return: The generated body.
+        """
+        entry = self._entry(pack)
+        if entry is None:
+            return pack.gen()
+        body = entry.get(BODY)
+        if body is None:
+            body = entry[BODY] = pack.gen()
+        return body
+
+    def frame(self, pack, variant, encode) -> bytes:
+        """
+        Get the encoded frame of a packet, only encoding it if it isn't cached.
+        :param pack: The packet.
+        :param variant: The frame format, such as a codec's variant.
+        :param encode: A function that encodes a body into a frame of that format.
+        :return: The encoded frame.
+        """
+        entry = self._entry(pack)
+        if entry is None:
+            return encode(pack.gen())
+        frame = entry.get(variant)
+        if frame is not None:
+            self.hits += 1
+            return frame
+        self.misses += 1
+        body = entry.get(BODY)
+        if body is None:
+            body = entry[BODY] = pack.gen()
+        frame = entry[variant] = encode(body)
+        return frame
+
+    def invalidate(self, pack):
+        """
+        Throw away the cached frames of a packet, after it has been changed.
+        :param pack: The packet.
+        """
+        if pack.immutable:
+            pack._encoded = None
+            return
+        try:
+            self._entries.pop((type(pack), pack.cache_key()), None)
+        except TypeError:
+            pass
+
+    def invalidate_type(self, packet_type):
+        """
+        Throw away the cached frames of every packet of a type, such as after its gen() has changed.
+        Immutable packets keep their own frames, so call :func:`invalidate` on them instead.
+        :param packet_type: The packet class.
+        """
+        for key in [key for key in self._entries if key[0] is packet_type]:
+            del self._entries[key]
+
+    def clear(self):
+        """
+        Throw away every cached frame, and reset the metrics.
+        """
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        """
+        Get the cache metrics.
+        :return: A dict of hits, misses, evictions, the number of entries, and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries),
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,277 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Heartbeats, and round trip time estimates for every connection.
+#
+# Once :func:`bfnet.packets.PacketHandler.enable_heartbeats` has been called, the handler sends every connection a
+# :class:`PingPacket` once per interval, holding a sequence number and the time it was sent. The peer replies with a
+# :class:`PongPacket` holding the same values, so the round trip time is worked out from our own clock alone.
+# Every PacketButterfly answers pings, whether or not its own handler sends them.
+#
+# Pings are not sent with a timer for each connection. The handler has one timer, which ticks `slots` times per
+# interval, and each tick pings the connections in one slot, so the work is spread evenly over the interval.
+#
+# Each connection keeps a smoothed RTT and jitter estimate in its `rtt` attribute, an :class:`RttEstimator`, the same
+# way TCP does (RFC 6298). The :class:`HeartbeatScheduler` keeps a histogram of every sample, and can build histograms
+# of the current estimates, or list the slowest connections, so slow consumers can be found before their write
+# buffers pile up. Connections that miss `max_missed` pongs in a row are dropped.
+
+import bisect
+import struct
+
+from .Packets import Packet
+from .Scheduling import PRIORITY_CONTROL
+
+# The default histogram bucket bounds, in seconds.
+DEFAULT_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+class PingPacket(Packet):
+    """
+    The control packet used to measure the round trip time to the peer.
+    """
+    # Negative IDs are reserved for ButterflyNet's own packets.
+    id = -5
+    fields = ("seq", "timestamp")
+    priority = PRIORITY_CONTROL
+
+    _layout = struct.Struct("!Id")
+
+    def __init__(self, pbf, seq: int=0, timestamp: float=0.0):
+        super().__init__(pbf)
+        self.seq = seq
+        self.timestamp = timestamp
+
+    def unpack(self, data: bytes) -> bool:
+        self.seq, self.timestamp = self._layout.unpack(data[:self._layout.size])
+        return True
+
+    def gen(self) -> bytes:
+        return self._layout.pack(self.seq, self.timestamp)
+
+
+class PongPacket(PingPacket):
+    """
+    The reply to a :class:`PingPacket`, holding the same sequence number and time.
+    """
+    id = -6
+
+
+class RttEstimator(object):
+    """
+    The smoothed round trip time and jitter of one connection.
+    """
+    __slots__ = ("srtt", "jitter", "last", "min", "samples", "seq", "waiting", "missed")
+
+    # The gains for the smoothed RTT and jitter, from RFC 6298.
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self):
+        # The smoothed RTT and jitter, in seconds, or None before the first sample.
+        self.srtt = None
+        self.jitter = None
+        self.last = None
+        self.min = None
+        self.samples = 0
+        # The sequence number of the last ping sent, and whether its pong is still to come.
+        self.seq = 0
+        self.waiting = False
+        # The number of pings in a row that got no pong before the next was sent.
+        self.missed = 0
+
+    def next_ping(self) -> int:
+        """
+        Start a new ping.
+        :return: The sequence number to send.
+        """
+        if self.waiting:
+            self.missed += 1
+        self.seq = (self.seq + 1) & 0xffffffff
+        self.waiting = True
+        return self.seq
+
+    def pong_received(self, seq: int, rtt: float) -> bool:
+        """
+        Add a sample from a pong.
+        :param seq: The sequence number of the pong.
+        :param rtt: The time since its ping was sent.
+        :return: True if the sample was used, or False if it was nonsense.
+        """
+        if rtt < 0:
+            return False
+        if seq == self.seq:
+            self.waiting = False
+            self.missed = 0
+        if self.srtt is None:
+            self.srtt = rtt
+            self.jitter = rtt / 2
+        else:
+            self.jitter += self.beta * (abs(self.srtt - rtt) - self.jitter)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.last = rtt
+        self.min = rtt if self.min is None else min(self.min, rtt)
+        self.samples += 1
+        return True
+
+
+class Histogram(object):
+    """
+    A count of values in fixed buckets.
+    """
+
+    def __init__(self, bounds: tuple=DEFAULT_BOUNDS):
+        """
+        Create a new Histogram.
+        :param bounds: The upper bound of each bucket, in order. Values above the last go in an overflow bucket.
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def add(self, value: float):
+        """
+        Count a value.
+        :param value: The value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Get the upper bound of the bucket a percentile falls in.
+        :param fraction: The percentile, from 0 to 1.
+        :return: The bound, infinity if it is in the overflow bucket, or None if nothing has been counted.
+        """
+        if not self.total:
+            return None
+        rank = max(1, round(self.total * fraction))
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def reset(self):
+        """
+        Forget everything counted.
+        """
+        self.counts = [0] * len(self.counts)
+        self.total = 0
+
+    def as_dict(self) -> dict:
+        """
+        :return: A dict of bucket upper bound -> count, with the overflow bucket under infinity.
+        """
+        return dict(zip(self.bounds + (float("inf"),), self.counts))
+
+
+class HeartbeatScheduler(object):
+    """
+    Pings every connection of a handler once per interval, from one timer.
+    """
+
+    def __init__(self, handler, interval: float=5.0, max_missed: int=3, slots: int=10):
+        """
+        Create a new HeartbeatScheduler.
+        :param handler: The :class:`bfnet.packets.PacketHandler`.
+        :param interval: How often to ping each connection, in seconds.
+        :param max_missed: How many pongs in a row a connection can miss before it is dropped, or None to never drop.
+        :param slots: How many groups the connections are split into. One group is pinged every interval / slots.
+        """
+        self.handler = handler
+        self.interval = interval
+        self.max_missed = max_missed
+        self.slots = slots
+        # Every RTT sample from every connection.
+        self.samples = Histogram()
+        self._slot = 0
+        self._timer = None
+
+    def _slot_of(self, butterfly):
+        if getattr(butterfly, "rtt", None) is None:
+            # Only PacketButterflies can be pinged.
+            return None
+        return butterfly.connection_id % self.slots
+
+    def start(self):
+        """
+        Start pinging.
+        """
+        if self._timer is None:
+            # The registry index puts each connection in a slot, so a tick doesn't have to look at every connection.
+            self.handler.butterflies.add_index("heartbeat", self._slot_of)
+            self._timer = self.handler._event_loop.call_later(self.interval / self.slots, self._tick)
+
+    def stop(self):
+        """
+        Stop pinging.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self.handler.butterflies.remove_index("heartbeat")
+
+    def _tick(self):
+        """
+        Ping the connections in the next slot.
+        """
+        self._timer = self.handler._event_loop.call_later(self.interval / self.slots, self._tick)
+        slot = self._slot
+        self._slot = (slot + 1) % self.slots
+        for bf in self.handler.butterflies.lookup("heartbeat", slot):
+            if bf._closing:
+                continue
+            if self.max_missed is not None and bf.rtt.waiting and bf.rtt.missed + 1 >= self.max_missed:
+                self.handler.logger.warning("{}:{} missed {} heartbeats, dropping client.".format(
+                    bf.ip, bf.client_port, self.max_missed))
+                bf.stop()
+                continue
+            bf.send_ping()
+
+    def sample_received(self, butterfly, rtt: float):
+        """
+        Called by a Butterfly when it gets a pong.
+        :param butterfly: The Butterfly.
+        :param rtt: The round trip time of the ping.
+        """
+        self.samples.add(rtt)
+
+    def _measured(self) -> list:
+        return [bf for bf, _ in self.handler.butterflies.values()
+                if getattr(bf, "rtt", None) is not None and bf.rtt.srtt is not None]
+
+    def histograms(self, bounds: tuple=DEFAULT_BOUNDS) -> dict:
+        """
+        Get histograms of the current estimates of every connection.
+        :param bounds: The bucket bounds to use.
+        :return: A dict with "rtt" and "jitter" :class:`Histogram` objects, of the smoothed RTT and jitter.
+        """
+        rtt, jitter = Histogram(bounds), Histogram(bounds)
+        for bf in self._measured():
+            rtt.add(bf.rtt.srtt)
+            jitter.add(bf.rtt.jitter)
+        return {"rtt": rtt, "jitter": jitter}
+
+    def slowest(self, count: int=10) -> list:
+        """
+        Get the connections with the highest smoothed RTT, such as to shed or deprioritize them.
+        :param count: The number of connections to get.
+        :return: A list of Butterflies, slowest first.
+        """
+        return sorted(self._measured(), key=lambda bf: bf.rtt.srtt, reverse=True)[:count]
@@ -16,8 +16,35 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import collections
+import logging
+import os
 import struct
+import zlib
 from bfnet.Butterfly import AbstractButterfly
+from bfnet.util import new_queue
+from .PacketCompressor import PacketCompressor
+from .Sessions import SessionPacket, mark_sequenced
+from .Streams import StreamPacket, stream_header, STREAM_START, STREAM_END
+from .Channels import Channel, ChannelWindowPacket, channel_header
+from .Batches import PacketBatch, get_decoder
+from .Heartbeats import PingPacket, PongPacket, RttEstimator
+from .StateSync import StatePacket, StateAckPacket, StateReplica
+from .Scheduling import OutboundScheduler, PRIORITY_NORMAL, PRIORITY_CONTROL
+from .Codecs import HelloPacket, LegacyCodec, negotiate, select_codec, frame_length, PROTOCOL_VERSION, \
+    MAX_PROTOCOL_VERSION, FLAG_COMPRESSED, FLAG_ACCEPTS_COMPRESSION, FLAG_LENGTH, FLAG_STREAM, FLAG_CHANNEL, \
+    FLAG_SEQUENCED, FEATURE_COMPRESSION
+
+
+def add_frame_length(data: bytes) -> bytes:
+    """
+    Turn a frame without a length into a FLAG_LENGTH frame.
+    :param data: The frame, including the header.
+    :return: The new frame.
+    """
+    magic, version, id = PacketButterfly.unpacker.unpack_from(data)
+    return PacketButterfly.unpacker.pack(magic, version | (FLAG_LENGTH << 8), id) + \
+        frame_length.pack(len(data) - 6) + data[6:]
 
 
 class PacketButterfly(AbstractButterfly):
@@ -27,6 +54,19 @@ class PacketButterfly(AbstractButterfly):
     """
     unpacker = struct.Struct("!2shh")
 
+    # The largest frame body we will accept, to stop a client making us buffer forever.
+    max_frame_size = 16 * 1024 * 1024
+
+    # Should every frame carry a length? A frame without one takes up the rest of the data the peer recieves,
+    # so it swallows any frame sent after it, such as a stream chunk or a channel frame.
+    # Only turn this off to talk to clients from before FLAG_LENGTH, which can't read framed frames.
+    # Once a framed frame has been sent, this is turned back on for the connection.
+    frame_lengths = True
+
+    # How long a held back frame waits before its priority goes up by one, in seconds.
+    # See :mod:`bfnet.packets.Scheduling`.
+    priority_aging = 0.1
+
     def __init__(self, handler, loop: asyncio.AbstractEventLoop, max_packets=0):
         """
         Create a new Packeted Butterfly.
@@ -35,7 +75,67 @@ class PacketButterfly(AbstractButterfly):
         super().__init__(handler, loop)
 
         # Create a new Packet queue.
-        self.packet_queue = asyncio.Queue(loop=self._loop)
+        self.packet_queue = new_queue(self._loop)
+        # The frame size of every packet in the queue, and their total.
+        # Once the total goes over the handler's buffer size, we stop reading from the client.
+        self._queued_sizes = collections.deque()
+        self._queued_bytes = 0
+        self._queue_paused = False
+        self._reading_paused = False
+
+        # Data that has been recieved, but doesn't make up a full frame yet.
+        self._buffer = bytearray()
+        # Has the client sent us a length-prefixed frame?
+        self.peer_framed = False
+
+        # Create our compression context, if our handler has compression enabled.
+        if handler.compression_options is not None:
+            self._compressor = PacketCompressor(*handler.compression_options)
+        else:
+            self._compressor = None
+        # We only send compressed frames once the client has told us it can read them.
+        self.peer_accepts_compression = False
+
+        # The last packet returned by read(), which goes back to its pool on the next read().
+        self._last_packet = None
+
+        # The resumable session attached to this connection, if sessions are enabled.
+        self.session = None
+        # The session we started as a client, and the number of sequenced frames recieved in it.
+        self.session_token = None
+        self.session_seq = 0
+        # The future for the session reply we are waiting for, if we asked for one.
+        self._session_reply = None
+
+        # Streams being recieved, by stream ID.
+        self._streams = {}
+        # Streams that have too much buffered, and have paused reading.
+        self._paused_streams = set()
+        self._next_stream_id = 0
+
+        # Logical channels, by channel ID.
+        self.channels = {}
+        # Channels with frames ready to send, in round-robin order.
+        self._ready_channels = collections.deque()
+
+        # The codec for this connection's frames. This is replaced once the handshake has finished.
+        # See :mod:`bfnet.packets.Codecs`.
+        self.codec = LegacyCodec(self)
+        self._negotiated = False
+        # The future for the handshake we started, if we started one.
+        self._handshake = None
+
+        # Frames held back while the transport's write buffer is full.
+        self.scheduler = OutboundScheduler(loop, self.priority_aging)
+        # Is a file being sent with sendfile()? The transport can't be written to until it has finished,
+        # so every other frame is held back in the scheduler meanwhile.
+        self._sendfile_active = False
+
+        # The smoothed round trip time to the client, measured with heartbeats. See :mod:`bfnet.packets.Heartbeats`.
+        self.rtt = RttEstimator()
+
+        # Replicated states from the server, by sync ID. See :mod:`bfnet.packets.StateSync`.
+        self.replicas = {}
 
     @property
     def handler(self):
@@ -43,61 +143,693 @@ class PacketButterfly(AbstractButterfly):
 
     def data_received(self, data: bytes):
         """
-        Parses out the Packet header, to create an appropriate new
-        Packet object.
+        Splits the data recieved into frames, using the connection's codec.
         :param data: The data to parse in.
         """
         self.logger.debug("Recieved new packet, deconstructing...")
-        if len(data) < 6:
-            self.logger.error("Invalid packet recieved, dropping client.")
-            self.stop()
+        if self._handler.capture is not None:
+            self._handler.capture.record(self, data)
+        self._buffer.extend(data)
+        self.codec.feed(self._buffer)
+
+    def protocol_error(self, message: str):
+        """
+        Log a protocol error, and drop the client.
+        :param message: The error message.
+        """
+        self.logger.error(message)
+        self.stop()
+
+    def frame_received(self, version: int, flags: int, id: int, body: bytes):
+        """
+        Handle a single frame, to create an appropriate new Packet object.
+        :param version: The protocol version of the frame.
+        :param flags: The frame flags.
+        :param id: The packet ID.
+        :param body: The body of the frame, with the header removed.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Packet version {}, id {}, flags {}".format(version, id, flags))
+        if flags & FLAG_SEQUENCED:
+            self.session_seq += 1
+        channel_id = 0
+        if flags & FLAG_CHANNEL:
+            channel_id, = channel_header.unpack_from(body)
+            body = body[channel_header.size:]
+        if flags & FLAG_COMPRESSED:
+            if self._compressor is None:
+                self.logger.error("Recieved compressed packet, but compression is not enabled.")
+                self.stop()
+                return
+            try:
+                body = self._compressor.decompress(body)
+            except zlib.error as e:
+                self.logger.error("Failure decompressing packet: {}".format(e.args))
+                self.stop()
+                return
+        if channel_id:
+            self._channel_frame_received(channel_id, id, body)
             return
-        # Decode the header.
-        header = data[0:6]
-        try:
-            magic, version, id = self.unpacker.unpack(header)
-        except struct.error as e:
-            self.logger.error("Failure unpacking packet header: {}".format(e.args))
-            self.stop()
+        if flags & FLAG_STREAM:
+            self._stream_frame_received(id, body)
+            return
+        if id == HelloPacket.id:
+            packet = HelloPacket(self)
+            packet.create(body)
+            self._handle_hello(packet)
+            return
+        # Heartbeats are answered here, and never reach your handler.
+        if id == PingPacket.id or id == PongPacket.id:
+            packet = PingPacket(self)
+            packet.create(body)
+            if id == PingPacket.id:
+                self._send(PongPacket.id, PongPacket(self, packet.seq, packet.timestamp).gen(), flags=FLAG_LENGTH,
+                           priority=PRIORITY_CONTROL)
+            else:
+                self._handle_pong(packet)
             return
-        # Check header.
-        if magic != b"BF":
-            self.logger.error("Recieved unknown packet with magic number {}".format(magic.decode()))
-            self.stop()
+        # Replicated state is applied here, and never reaches your handler.
+        if id == StatePacket.id:
+            packet = StatePacket(self)
+            packet.create(body)
+            replica = self.replicas.get(packet.sync_id)
+            if replica is None:
+                self.logger.warning("Recieved state for unknown sync ID: {}".format(packet.sync_id))
+            else:
+                replica.apply(packet)
+            return
+        if id == StateAckPacket.id:
+            packet = StateAckPacket(self)
+            packet.create(body)
+            sync = self._handler.state_syncs.get(packet.sync_id)
+            if sync is not None:
+                sync.ack(self, packet.version)
+            return
+        # Session control packets are handled here, and never reach your handler.
+        if id == SessionPacket.id and (self._session_reply is not None or self._handler.session_options is not None):
+            packet = SessionPacket(self)
+            packet.create(body)
+            if self._session_reply is not None:
+                self._handle_session_reply(packet)
+            else:
+                self._handle_session(packet)
             return
-        self.logger.debug("Packet version {}, id {}".format(version, id))
         # Get the packet, if possible.
         if id in self._handler.packet_types:
             packet_type = self._handler.packet_types[id]
-            packet = packet_type(self)
-            created = packet.create(data[6:])
+            if packet_type.batch:
+                # This frame couldn't be batched by the codec, such as a compressed frame, so make a batch of one.
+                self.batch_received(packet_type, body, 0, 1)
+                return
+            packet = packet_type.acquire(self)
+            created = packet.create(body)
             if created:
-                self._loop.create_task(self.packet_queue.put(packet))
+                self._queue_packet(packet, len(body))
+            else:
+                packet.release()
         else:
             self.logger.warning("Recieved unknown packet ID: {}".format(id))
 
+    def batch_received(self, packet_type, data: bytes, header_size: int, count: int):
+        """
+        Decode a run of frames of a batched packet type into one :class:`bfnet.packets.Batches.PacketBatch`.
+        :param packet_type: The packet type.
+        :param data: The frames.
+        :param header_size: The size of the header in front of each frame body.
+        :param count: The number of frames.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Recieved batch of {} packets, id {}".format(count, packet_type.id))
+        columns = get_decoder(packet_type, header_size).decode(data, count)
+        self._queue_packet(PacketBatch(self, packet_type, columns, count), len(data))
+
+    def _channel_frame_received(self, channel_id: int, id: int, body: bytes):
+        """
+        Handle a frame sent on a logical channel.
+        :param channel_id: The channel ID.
+        :param id: The packet ID.
+        :param body: The body of the frame.
+        """
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.open_channel(channel_id)
+            if channel is None:
+                return
+        if id == ChannelWindowPacket.id:
+            packet = ChannelWindowPacket(channel)
+            packet.create(body)
+            channel.window_received(packet.increment)
+            return
+        if id not in self._handler.packet_types:
+            self.logger.warning("Recieved unknown packet ID: {}".format(id))
+            return
+        packet = self._handler.packet_types[id].acquire(channel)
+        if packet.create(body):
+            channel.packet_received(packet, len(body))
+        else:
+            packet.release()
+
+    def open_channel(self, channel_id: int) -> Channel:
+        """
+        Open a logical channel, and start its handler.
+        :param channel_id: The ID of the channel to open.
+        :return: The new :class:`bfnet.packets.Channels.Channel`, or None if there is no handler for it.
+        """
+        handler = self._handler.net.get_channel_handler(channel_id)
+        if handler is None:
+            self.logger.warning("No handler for channel {}, ignoring.".format(channel_id))
+            return None
+        channel = Channel(self, channel_id)
+        self.channels[channel_id] = channel
+        channel.task = self._loop.create_task(handler(channel))
+        return channel
+
+    def send_control(self, pack, channel_id: int=0):
+        """
+        Write a control packet straight away, skipping the session journal and channel flow control.
+        :param pack: The packet to write.
+        :param channel_id: The channel to send it on.
+        """
+        self._send(pack.id, pack.gen(), channel_id=channel_id, priority=pack.priority)
+
+    def schedule_channel(self, channel: Channel):
+        """
+        Queue a channel to have its waiting frames sent.
+        :param channel: The channel.
+        """
+        if channel not in self._ready_channels:
+            self._ready_channels.append(channel)
+        self._flush_channels()
+
+    def _flush_channels(self):
+        """
+        Send waiting channel frames, one from each channel at a time, until the transport is full.
+        """
+        ready = self._ready_channels
+        while ready and not self._paused and not self._closing and not self._sendfile_active:
+            channel = ready.popleft()
+            if not channel.can_send():
+                continue
+            id, body, compress = channel.pop_frame()
+            self._send(id, body, compress, channel_id=channel.channel_id)
+            if channel.can_send():
+                ready.append(channel)
+
+    def resume_writing(self):
+        """
+        Called by the transport when its write buffer drains below the low-water mark.
+
+        Frames that were held back are written first, highest priority first, until the transport is full again.
+        """
+        self._paused = False
+        self._flush_held()
+        if self._paused:
+            return
+        super().resume_writing()
+        self._flush_channels()
+
+    def _flush_held(self):
+        """
+        Write the frames that were held back, highest priority first, until the transport is full again.
+        """
+        scheduler = self.scheduler
+        while scheduler and not self._paused and not self._closing and not self._sendfile_active:
+            self._transport.write(scheduler.pop())
+
+    def get_write_buffer_size(self) -> int:
+        """
+        Get the number of bytes waiting to be written to the client, including frames held back.
+        """
+        return super().get_write_buffer_size() + self.scheduler.buffered
+
+    def _stream_frame_received(self, id: int, body: bytes):
+        """
+        Handle a frame that is part of a stream.
+        :param id: The packet ID of the stream.
+        :param body: The body of the frame.
+        """
+        stream_id, stream_flags = stream_header.unpack_from(body)
+        data = body[stream_header.size:]
+        if stream_flags & STREAM_START:
+            packet_type = self._handler.packet_types.get(id)
+            if packet_type is None or not issubclass(packet_type, StreamPacket):
+                self.logger.error("Recieved stream for unknown stream packet ID: {}".format(id))
+                self.stop()
+                return
+            packet = packet_type(self)
+            packet.stream_id = stream_id
+            packet.create(data)
+            self._streams[stream_id] = packet
+            # Hand it to the handler straight away, so it can start reading chunks.
+            self._queue_packet(packet, len(data))
+            return
+        packet = self._streams.get(stream_id)
+        if packet is None:
+            self.logger.warning("Recieved chunk for unknown stream: {}".format(stream_id))
+            return
+        if stream_flags & STREAM_END:
+            del self._streams[stream_id]
+            self.resume_stream(packet)
+            packet.feed_end()
+        else:
+            packet.feed_chunk(data)
+
+    def _queue_packet(self, packet, size: int):
+        """
+        Put a packet on the queue for read(), and stop reading from the client if the queue is too big.
+        :param packet: The packet.
+        :param size: The size of its frame body.
+        """
+        self.packet_queue.put_nowait(packet)
+        self._queued_sizes.append(size)
+        self._queued_bytes += size
+        if self._queued_bytes > self._handler._bufsize and not self._queue_paused:
+            self._queue_paused = True
+            self._update_reading()
+
+    def _update_reading(self):
+        """
+        Pause or resume reading from the client, depending on whether anything has too much data buffered.
+        """
+        paused = self._queue_paused or bool(self._paused_streams)
+        if paused == self._reading_paused or self._connection_lost:
+            return
+        self._reading_paused = paused
+        if paused:
+            self._transport.pause_reading()
+        else:
+            self._transport.resume_reading()
+
+    def pause_stream(self, packet: StreamPacket):
+        """
+        Stop reading from the client, as a stream has too much data buffered.
+        :param packet: The stream that is full.
+        """
+        self._paused_streams.add(packet)
+        self._update_reading()
+
+    def resume_stream(self, packet: StreamPacket):
+        """
+        Start reading from the client again, once no stream has too much data buffered.
+        :param packet: The stream that has been drained.
+        """
+        if packet not in self._paused_streams:
+            return
+        self._paused_streams.discard(packet)
+        self._update_reading()
+
+    def memory_stats(self) -> dict:
+        """
+        Get the number of bytes this connection is holding in memory.
+        :return: A dict with:
+            - read_buffer: Data recieved, that doesn't make up a full frame yet.
+            - queued: The frame bodies of packets waiting to be read.
+            - streams: Stream chunks waiting to be read.
+            - write_buffer: Data waiting to be written to the client.
+        """
+        stats = super().memory_stats()
+        stats["read_buffer"] = len(self._buffer)
+        stats["queued"] = self._queued_bytes
+        stats["streams"] = sum(packet._buffered for packet in self._streams.values())
+        return stats
+
     def connection_lost(self, exc):
         class FakeQueue(object):
-            def get(self):
+            async def get(self):
                 return None
 
-            @asyncio.coroutine
-            def put(self):
+            async def put(self, item):
+                return
+
+            def put_nowait(self, item):
                 return
 
+            def empty(self):
+                return True
+
         self.packet_queue = FakeQueue()
+        self._queued_sizes.clear()
+        self._queued_bytes = 0
+        self._release_last()
+        for packet in self._streams.values():
+            packet.feed_end(ConnectionResetError("Connection lost during stream"))
+        self._streams.clear()
+        for channel in self.channels.values():
+            channel.close()
+        self._ready_channels.clear()
+        self.scheduler.clear()
+        if self.session is not None:
+            self._handler.suspend_session(self.session)
+            self.session = None
         super().connection_lost(exc)
 
-    def read(self):
+    def _handle_session(self, pack: SessionPacket):
+        """
+        Handle a session control packet from the client.
+        :param pack: The SessionPacket recieved.
+        """
+        if self.session is not None:
+            # This is an acknowledgement.
+            self.session.journal.trim(pack.seq)
+            return
+        session, frames = self._handler.resume_session(pack.token, pack.seq)
+        if frames is None:
+            # Start again from scratch.
+            session, frames = self._handler.new_session(), []
+            seq = 0
+        else:
+            seq = pack.seq
+        session.butterfly = self
+        self._write_encoded(self._handler.encode_packet(SessionPacket(self, session.token, seq)))
+        for frame in frames:
+            self._write_encoded(frame)
+        self.session = session
+
+    async def start_session(self, token: bytes=None, seq: int=0, timeout: float=10.0) -> bool:
+        """
+        Start a session with the server, or resume one after reconnecting.
+
+        This must be called before anything else is sent on the connection, other than the handshake.
+        Afterwards, `session_token` and `session_seq` are what to pass in to resume the session on a new connection.
+
+        This method is a coroutine.
+        :param token: The token of the session to resume, or None to start a new one.
+        :param seq: The number of sequenced frames recieved in the session so far.
+        :param timeout: How long to wait for the reply.
+        :return: True if the session was resumed, and the frames missed are being replayed.
+        """
+        if token is None:
+            token, seq = b"\x00" * 16, 0
+        self._session_reply = self._loop.create_future()
+        self.send_control(SessionPacket(self, token, seq))
+        try:
+            reply = await asyncio.wait_for(self._session_reply, timeout)
+        finally:
+            self._session_reply = None
+        return reply.token == token and reply.seq == seq
+
+    def _handle_session_reply(self, pack: SessionPacket):
+        """
+        Handle the server's reply to :func:`start_session`.
+        :param pack: The SessionPacket recieved.
+        """
+        # The frames after this are counted from the sequence number the server continues from.
+        self.session_token = pack.token
+        self.session_seq = pack.seq
+        if not self._session_reply.done():
+            self._session_reply.set_result(pack)
+
+    def ack_session(self):
+        """
+        Tell the server every sequenced frame recieved so far, so it can drop them from its journal.
+        """
+        self.send_control(SessionPacket(self, self.session_token, self.session_seq))
+
+    @property
+    def supported_features(self) -> int:
+        """
+        The protocol features this connection will agree to in a handshake.
+        """
+        features = self._handler.supported_features
+        if self._compressor is None:
+            features &= ~FEATURE_COMPRESSION
+        return features
+
+    async def handshake(self, version: int=MAX_PROTOCOL_VERSION, features: int=None, timeout: float=10.0):
+        """
+        Negotiate the protocol version and features with the peer.
+
+        This must be called before anything else is sent on the connection.
+        If the peer doesn't reply in time, such as an older peer that doesn't know about the handshake,
+        the connection stays on version 1.
+
+        This method is a coroutine.
+        :param version: The highest version to ask for.
+        :param features: The features to ask for. Defaults to every feature this connection supports.
+        :param timeout: How long to wait for the reply.
+        :return: A tuple of the negotiated (version, features).
+        """
+        if features is None:
+            features = self.supported_features
+        self._handshake = self._loop.create_future()
+        self._send(HelloPacket.id, HelloPacket(self, version, features).gen(), flags=FLAG_LENGTH,
+                   priority=PRIORITY_CONTROL)
+        try:
+            return (await asyncio.wait_for(self._handshake, timeout))
+        except asyncio.TimeoutError:
+            self.logger.warning("No handshake reply from {}:{}, using version {}".format(
+                self.ip, self.client_port, self.codec.version))
+            return self.codec.version, 0
+
+    def _handle_hello(self, pack: HelloPacket):
+        """
+        Handle a handshake packet, and switch to the negotiated codec.
+        :param pack: The HelloPacket recieved.
+        """
+        if self._negotiated:
+            self.logger.warning("Recieved second handshake from {}:{}, ignoring.".format(self.ip, self.client_port))
+            return
+        self._negotiated = True
+        version, features = negotiate(pack.version, pack.features, self._handler.max_protocol_version,
+                                      self.supported_features)
+        if self._handshake is None:
+            # The peer started the handshake, so reply in the old format before switching.
+            self._send(HelloPacket.id, HelloPacket(self, version, features).gen(), flags=FLAG_LENGTH,
+                       priority=PRIORITY_CONTROL)
+        if version >= 2:
+            self.peer_framed = True
+            self.peer_accepts_compression = self._compressor is not None and bool(features & FEATURE_COMPRESSION)
+        self.codec = select_codec(self, version, features)
+        if self._handshake is not None and not self._handshake.done():
+            self._handshake.set_result((version, features))
+
+    def send_ping(self):
+        """
+        Send a heartbeat ping, to measure the round trip time. The reply updates `rtt`.
+        """
+        seq = self.rtt.next_ping()
+        self._send(PingPacket.id, PingPacket(self, seq, self._loop.time()).gen(), flags=FLAG_LENGTH,
+                   priority=PRIORITY_CONTROL)
+
+    def _handle_pong(self, pack: PingPacket):
+        """
+        Handle the reply to a heartbeat ping.
+        :param pack: The PongPacket recieved.
+        """
+        rtt = self._loop.time() - pack.timestamp
+        if self.rtt.pong_received(pack.seq, rtt) and self._handler.heartbeats is not None:
+            self._handler.heartbeats.sample_received(self, rtt)
+
+    def replicate(self, sync_id: int, packet_type) -> StateReplica:
+        """
+        Start applying a state replicated by the server.
+        :param sync_id: The ID of the state, which the server added with
+            :func:`bfnet.packets.PacketHandler.add_state_sync`.
+        :param packet_type: The packet type of each entity, the same as the server's.
+        :return: The new :class:`bfnet.packets.StateSync.StateReplica`.
+        """
+        replica = self.replicas[sync_id] = StateReplica(self, sync_id, packet_type)
+        return replica
+
+    def send_state(self, body: bytes):
+        """
+        Write a state frame built by :class:`bfnet.packets.StateSync.StateSync`, skipping the session journal.
+        :param body: The frame body.
+        """
+        self._send(StatePacket.id, body, StatePacket.compress, flags=FLAG_LENGTH, priority=StatePacket.priority)
+
+    def _release_last(self):
+        """
+        Release the last packet returned by read() back into its pool.
+        """
+        if self._last_packet is not None:
+            self._last_packet.release()
+            self._last_packet = None
+
+    async def read(self):
         """
         Get a new packet off the Queue.
+
+        If the previous packet returned is pooled, it is released back into its pool.
+        """
+        self._release_last()
+        queue = self.packet_queue
+        # Skip the coroutine when a packet is already waiting.
+        packet = queue.get_nowait() if not queue.empty() else await queue.get()
+        if self._queued_sizes:
+            self._queued_bytes -= self._queued_sizes.popleft()
+            if self._queue_paused and self._queued_bytes <= self._handler._bufsize // 2:
+                self._queue_paused = False
+                self._update_reading()
+        self._last_packet = packet
+        return packet
+
+    def _write_frame(self, data: bytes, priority: int=PRIORITY_NORMAL):
+        """
+        Write an encoded frame to the transport, or hold it back if the transport's write buffer is full.
+        :param data: The frame to write.
+        :param priority: The priority of the frame, if it is held back.
+        """
+        if self._paused or self._sendfile_active:
+            self.scheduler.push(data, priority)
+        else:
+            self._transport.write(data)
+
+    def _send(self, id: int, body: bytes, compress: bool=False, flags: int=0, channel_id: int=0,
+            priority: int=PRIORITY_NORMAL):
+        """
+        Add a header to a frame body, and write it.
+        :param id: The packet ID.
+        :param body: The frame body.
+        :param compress: Should the body be compressed, if it is worth it?
+        :param flags: Any extra frame flags.
+        :param channel_id: The logical channel to send the frame on.
+        :param priority: The priority of the frame.
+        """
+        # Only compress if the packet type asks for it, and the body is big enough to be worth it.
+        if compress and self.peer_accepts_compression and self._compressor.should_compress(body):
+            body = self._compressor.compress(body)
+            flags |= FLAG_COMPRESSED
+            # Compressed frames must arrive in the order they were compressed in.
+            priority = PRIORITY_NORMAL
+        if channel_id:
+            flags |= FLAG_CHANNEL
+            body = channel_header.pack(channel_id) + body
+        self._write_frame(self.codec.encode(flags, id, body), priority)
+
+    def _write_encoded(self, data: bytes):
+        """
+        Write a frame encoded by :func:`bfnet.packets.PacketHandler.encode_frame`, adding a length if needed.
+        :param data: The frame to write.
+        """
+        self._write_frame(self.codec.reencode(data))
+
+    def write_raw(self, data: bytes):
+        """
+        Write an already encoded frame to the client, such as a broadcast.
+
+        This is recorded in the session journal, if there is one.
+        :param data: The frame to write.
         """
-        return (yield from self.packet_queue.get())
+        if self.session is not None:
+            data = mark_sequenced(data)
+            self.session.journal.append(data)
+        self._write_encoded(data)
 
     def write(self, pack):
         """
         Write a packet to the client.
         :param pack: The packet to write. This will automatically add a header.
         """
-        header = self.unpacker.pack(b"BF", 1, pack.id)
-        self._transport.write(header + pack.gen())
+        cache = self._handler.frame_cache
+        if self.session is not None:
+            # Journal the frame uncompressed, as the compression context won't survive a reconnect.
+            self.session.journal.append(mark_sequenced(self._handler.encode_packet(pack)))
+            # The session journal counts frames in the order they were sent, so they can't be reordered.
+            self._send(pack.id, cache.body(pack), pack.compress, FLAG_SEQUENCED)
+            return
+        if pack.compress and self.peer_accepts_compression:
+            self._send(pack.id, cache.body(pack), True, priority=pack.priority)
+            return
+        codec = self.codec
+        self._write_frame(cache.frame(pack, codec.variant, lambda body: codec.encode(0, pack.id, body)),
+                          pack.priority)
+
+    async def write_stream(self, pack: StreamPacket, source, chunk_size: int=64 * 1024):
+        """
+        Write a packet, followed by a large payload in chunks.
+
+        Between each chunk, this yields to the event loop and waits for the write buffer to drain, so other packets
+        can be sent in between.
+        Streams are not recorded in the session journal.
+
+        This method is a coroutine.
+        :param pack: The :class:`bfnet.packets.StreamPacket` to send first.
+        :param source: Where to read the payload from. This can be:
+            - A bytes-like object.
+            - A binary file object. If the connection is not using TLS, and the event loop supports it,
+              the file is sent with sendfile() without being copied into memory.
+            - An iterable of bytes objects.
+            - An async iterable of bytes objects.
+        :param chunk_size: The maximum size of each chunk, when reading from bytes or a file.
+        """
+        stream_id = self._next_stream_id
+        self._next_stream_id = (self._next_stream_id + 1) & 0xffffffff
+        # Every frame of a stream is sent at one priority, so a chunk can't overtake the start of its stream.
+        # Compressed chunks have to go at PRIORITY_NORMAL, so the whole stream does.
+        priority = PRIORITY_NORMAL if pack.compress and self._compressor is not None else pack.priority
+        self._send(pack.id, stream_header.pack(stream_id, STREAM_START) + pack.gen(), flags=FLAG_STREAM,
+                   priority=priority)
+
+        if hasattr(source, "read") and self._can_sendfile(source):
+            await self._sendfile_chunks(pack.id, stream_id, source, chunk_size)
+        elif hasattr(source, "__anext__"):
+            while True:
+                try:
+                    chunk = await source.__anext__()
+                except StopAsyncIteration:
+                    break
+                await self._write_chunk(pack, stream_id, chunk, priority)
+        else:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                view = memoryview(source)
+                chunks = (view[i:i + chunk_size] for i in range(0, len(view), chunk_size))
+            elif hasattr(source, "read"):
+                chunks = iter(lambda: source.read(chunk_size), b"")
+            else:
+                chunks = source
+            for chunk in chunks:
+                await self._write_chunk(pack, stream_id, chunk, priority)
+
+        self._send(pack.id, stream_header.pack(stream_id, STREAM_END), flags=FLAG_STREAM, priority=priority)
+
+    async def _write_chunk(self, pack: StreamPacket, stream_id: int, chunk: bytes, priority: int):
+        """
+        Write one chunk of a stream, then wait for the write buffer to drain.
+        """
+        self._send(pack.id, stream_header.pack(stream_id, 0) + chunk, pack.compress, FLAG_STREAM,
+                   priority=priority)
+        if self._paused:
+            await self.drain()
+        else:
+            # Give everyone else a chance to write between chunks.
+            await asyncio.sleep(0)
+
+    def _can_sendfile(self, source) -> bool:
+        """
+        Check if a file can be sent with sendfile().
+        """
+        if getattr(self._loop, "sendfile", None) is None or self._compressor is not None or not self.codec.sendfile:
+            return False
+        if self._transport.get_extra_info("sslcontext") is not None:
+            return False
+        try:
+            source.fileno()
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    async def _sendfile_chunks(self, id: int, stream_id: int, source, chunk_size: int):
+        """
+        Send a file in chunks, letting the kernel copy the data.
+        """
+        offset = source.tell()
+        remaining = os.fstat(source.fileno()).st_size - offset
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            if self._paused:
+                # Let the frames held back go first, as the header has to be written right before the body.
+                await self.drain()
+            header = self.codec.header(FLAG_STREAM, id, stream_header.size + size)
+            self._transport.write(header + stream_header.pack(stream_id, 0))
+            self._sendfile_active = True
+            try:
+                await self._loop.sendfile(self._transport, source, offset, size)
+            finally:
+                self._sendfile_active = False
+            # Write what was held back while the file was being sent.
+            self._flush_held()
+            self._flush_channels()
+            await asyncio.sleep(0)
+            offset += size
+            remaining -= size
@@ -0,0 +1,91 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import zlib
+
+
+class PacketCompressor(object):
+    """
+    A PacketCompressor holds the zlib compression state for a single connection.
+
+    The compression and decompression contexts live for as long as the connection does,
+    so each frame can refer back to data sent in earlier frames. Frames are flushed with
+    Z_SYNC_FLUSH, which means every frame can be decompressed as soon as it arrives.
+
+    Both ends of the connection MUST use the same preset dictionary.
+    """
+
+    def __init__(self, dictionary: bytes=b"", threshold: int=256, level: int=6):
+        """
+        Create a new PacketCompressor.
+
+        :param dictionary: The preset dictionary to prime both contexts with.
+            This should contain byte sequences that commonly appear in your packets.
+        :param threshold: The minimum body size, in bytes, that will be compressed.
+            Bodies smaller than this are sent as-is.
+        :param level: The zlib compression level to use.
+        """
+        self.dictionary = dictionary
+        self.threshold = threshold
+        self.level = level
+
+        # Raw deflate streams - the zlib header and checksum are useless to us, as TLS already
+        # covers integrity and the stream never ends.
+        kwargs = {"zdict": dictionary} if dictionary else {}
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+        self._decompressobj = zlib.decompressobj(-zlib.MAX_WBITS, **kwargs)
+
+        # Statistics.
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def ratio(self) -> float:
+        """
+        The compression ratio achieved so far on outgoing frames.
+        """
+        if not self.bytes_out:
+            return 1.0
+        return self.bytes_in / self.bytes_out
+
+    def should_compress(self, data: bytes) -> bool:
+        """
+        Check if a frame body is large enough to be worth compressing.
+        :param data: The body to check.
+        """
+        return len(data) >= self.threshold
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a frame body.
+        :param data: The body to compress.
+        :return: The compressed body.
+        """
+        compressed = self._compressobj.compress(data) + self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Decompress a frame body.
+
+        This will raise a :class:`zlib.error` if the data is invalid.
+        :param data: The compressed body.
+        :return: The original body.
+        """
+        return self._decompressobj.decompress(data)
@@ -16,13 +16,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import binascii
 import logging
+import os
 import ssl
 
 from bfnet.BFHandler import ButterflyHandler
-from bfnet.packets import PacketButterfly
+from .PacketButterfly import PacketButterfly
+from .Codecs import PROTOCOL_VERSION, MAX_PROTOCOL_VERSION, FLAG_ACCEPTS_COMPRESSION, FEATURE_COMPRESSION, \
+    FEATURE_CHECKSUM, framed_header
+from .Batches import get_decoder
+from .FrameCache import FrameCache, FRAME
 from .Packets import BasePacket
 from .PacketNet import PacketNet
+from .Sessions import Session, SessionJournal, MappedSessionJournal
+from .Datagrams import DatagramButterfly, DatagramEndpoint
+from .Heartbeats import HeartbeatScheduler
+from .StateSync import StateSync
 
 
 class PacketHandler(ButterflyHandler):
@@ -35,17 +45,42 @@ class PacketHandler(ButterflyHandler):
     """
 
     def __init__(self, event_loop: asyncio.AbstractEventLoop, ssl_context: ssl.SSLContext=None,
-            loglevel: int=logging.DEBUG, buffer_size: int=asyncio.streams._DEFAULT_LIMIT):
-        super().__init__(event_loop, ssl_context, loglevel, 0)
+            loglevel: int=logging.DEBUG, buffer_size: int=asyncio.streams._DEFAULT_LIMIT, name: str=None):
+        # The buffer size is the number of bytes of packets each Butterfly can have waiting to be read,
+        # before it stops reading from the client.
+        super().__init__(event_loop, ssl_context, loglevel, buffer_size, name)
 
         # Define a new dict of Packet types.
         self.packet_types = {}
+        # The packet types that are decoded in batches. See :mod:`bfnet.packets.Batches`.
+        self.batch_types = {}
         # Define the basic packet type.
         self.basic_packet_type = BasePacket
 
         # Define the default Net type.
         self.default_net = PacketNet
 
+        # Application-level compression options, or None if compression is disabled.
+        self.compression_options = None
+
+        # Resumable session options, or None if sessions are disabled.
+        self.session_options = None
+        # A dict of session token -> Session.
+        self.sessions = {}
+
+        # The heartbeat scheduler, or None if heartbeats are disabled. See :mod:`bfnet.packets.Heartbeats`.
+        self.heartbeats = None
+
+        # Replicated states, by sync ID. See :mod:`bfnet.packets.StateSync`.
+        self.state_syncs = {}
+
+        # Encoded frames of immutable and cacheable packets. See :mod:`bfnet.packets.FrameCache`.
+        self.frame_cache = FrameCache()
+
+        # The highest protocol version we will agree to in a handshake.
+        # Lower this to hold a fleet on an older version while it is being upgraded.
+        self.max_protocol_version = MAX_PROTOCOL_VERSION
+
     def butterfly_factory(self):
         """
         Creates a new PacketedButterfly instead of a normal Butterfly.
@@ -53,6 +88,188 @@ class PacketHandler(ButterflyHandler):
         """
         return PacketButterfly(self, self._event_loop)
 
+    def datagram_butterfly_factory(self):
+        """
+        Creates a new virtual Butterfly for a datagram peer.
+        :return: A new :class:`bfnet.packets.Datagrams.DatagramButterfly`.
+        """
+        return DatagramButterfly(self, self._event_loop)
+
+    async def create_datagram_server(self, bind_options: tuple, idle_timeout: float=30.0):
+        """
+        Create a new server that sends and recieves packets over UDP, instead of TCP+TLS.
+
+        Datagrams are NOT encrypted. Only use this for data that doesn't need to be secure.
+
+        This method is a coroutine.
+        :param bind_options: The IP and port to bind to on the server.
+        :param idle_timeout: How long a peer can go without sending anything before it is disconnected.
+        :return: A :class:`bfnet.Net.Net` object.
+        """
+        host, port = bind_options
+        _, self._server = await self._event_loop.create_datagram_endpoint(
+            lambda: DatagramEndpoint(self, self._event_loop, idle_timeout), local_addr=(host, port))
+        return self._create_net(host, port)
+
+    def set_compression(self, dictionary: bytes=b"", threshold: int=256, level: int=6):
+        """
+        Enable per-frame zlib compression on new connections.
+
+        Only packet types with `compress` set to True are compressed, and only once the client has
+        signalled that it can decompress frames. Clients MUST use the same preset dictionary.
+        :param dictionary: The preset dictionary to prime the compression contexts with.
+        :param threshold: Bodies smaller than this many bytes are sent uncompressed.
+        :param level: The zlib compression level to use.
+        """
+        self.compression_options = (dictionary, threshold, level)
+
+    @property
+    def supported_features(self) -> int:
+        """
+        The protocol features we will agree to in a handshake.
+        See :mod:`bfnet.packets.Codecs`.
+        """
+        features = FEATURE_CHECKSUM
+        if self.compression_options is not None:
+            features |= FEATURE_COMPRESSION
+        return features
+
+    def enable_sessions(self, capacity: int=1024, ttl: float=60.0, spill_dir: str=None,
+            spill_size: int=1024 * 1024):
+        """
+        Enable resumable sessions.
+
+        See :mod:`bfnet.packets.Sessions` for the protocol clients must follow.
+        :param capacity: The maximum number of frames to keep for each session.
+        :param ttl: How long to keep a session after its client disconnects, in seconds.
+        :param spill_dir: If set, journals are kept in memory-mapped files in this directory, instead of on the heap.
+        :param spill_size: The size of each memory-mapped journal, in bytes.
+        """
+        self.session_options = {"capacity": capacity, "ttl": ttl, "spill_dir": spill_dir, "spill_size": spill_size}
+
+    def enable_heartbeats(self, interval: float=5.0, max_missed: int=3, slots: int=10) -> HeartbeatScheduler:
+        """
+        Start pinging every connection, to measure its round trip time and drop it if it stops answering.
+
+        See :mod:`bfnet.packets.Heartbeats`. Clients must be ButterflyNet clients that answer pings.
+        :param interval: How often to ping each connection, in seconds.
+        :param max_missed: How many pings in a row a connection can leave unanswered before it is dropped,
+            or None to never drop it.
+        :param slots: How many groups to split the connections into, so they aren't all pinged at once.
+        :return: The new :class:`bfnet.packets.Heartbeats.HeartbeatScheduler`.
+        """
+        self.disable_heartbeats()
+        self.heartbeats = HeartbeatScheduler(self, interval, max_missed, slots)
+        self.heartbeats.start()
+        return self.heartbeats
+
+    def disable_heartbeats(self):
+        """
+        Stop pinging connections.
+        """
+        if self.heartbeats is not None:
+            self.heartbeats.stop()
+            self.heartbeats = None
+
+    def add_state_sync(self, sync_id: int, packet_type, history: int=64, resync_every: int=300) -> StateSync:
+        """
+        Add a state to replicate to clients, by sending them what has changed on every tick.
+
+        See :mod:`bfnet.packets.StateSync`.
+        :param sync_id: The ID of the state. Clients replicate it with :func:`bfnet.packets.PacketButterfly.replicate`.
+        :param packet_type: The packet type of each entity, which must have `layout` and `fields` set.
+        :param history: The number of versions to keep the changes of.
+        :param resync_every: How many ticks to send each client a full snapshot after, or None to never.
+        :return: The new :class:`bfnet.packets.StateSync.StateSync`.
+        """
+        sync = self.state_syncs[sync_id] = StateSync(sync_id, packet_type, history, resync_every)
+        return sync
+
+    def new_session(self) -> Session:
+        """
+        Create a new session, with a random token.
+        :return: The new :class:`bfnet.packets.Sessions.Session`.
+        """
+        token = os.urandom(16)
+        opts = self.session_options
+        if opts["spill_dir"] is not None:
+            path = os.path.join(opts["spill_dir"], binascii.hexlify(token).decode() + ".journal")
+            journal = MappedSessionJournal(path, opts["spill_size"], opts["capacity"])
+        else:
+            journal = SessionJournal(opts["capacity"])
+        session = Session(token, journal)
+        self.sessions[token] = session
+        return session
+
+    def resume_session(self, token: bytes, seq: int) -> tuple:
+        """
+        Try to resume a session.
+        :param token: The token the client presented.
+        :param seq: The last sequence number the client received.
+        :return: A tuple of (session, frames to replay), or (None, None) if the session can't be resumed.
+        """
+        session = self.sessions.get(token)
+        if session is None or session.butterfly is not None:
+            return None, None
+        frames = session.journal.replay(seq)
+        if frames is None:
+            # The client is too far behind. Throw the session away.
+            self.expire_session(session)
+            return None, None
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        return session, frames
+
+    def suspend_session(self, session: Session):
+        """
+        Detach a session from its connection, and schedule it to expire.
+        :param session: The session to suspend.
+        """
+        session.butterfly = None
+        session.expiry = self._event_loop.call_later(self.session_options["ttl"], self.expire_session, session)
+
+    def expire_session(self, session: Session):
+        """
+        Throw a session away.
+        :param session: The session to expire.
+        """
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
+        if session.expiry is not None:
+            session.expiry.cancel()
+        session.journal.close()
+
+    def encode_frame(self, id: int, body: bytes) -> bytes:
+        """
+        Add an uncompressed header to a packet body.
+        :param id: The packet ID.
+        :param body: The generated packet body.
+        :return: The frame, including the header.
+        """
+        flags = FLAG_ACCEPTS_COMPRESSION if self.compression_options is not None else 0
+        return PacketButterfly.unpacker.pack(b"BF", (flags << 8) | PROTOCOL_VERSION, id) + body
+
+    def encode_packet(self, pack: BasePacket) -> bytes:
+        """
+        Encode a packet into a complete frame, that can be written to any of our Butterflies.
+
+        The frame is never compressed, as compression contexts belong to a single connection.
+        :param pack: The packet to encode.
+        :return: The frame, including the header.
+        """
+        return self.frame_cache.frame(pack, FRAME, lambda body: self.encode_frame(pack.id, body))
+
+    def broadcast(self, pack: BasePacket, exclude: PacketButterfly=None):
+        """
+        Send a packet to every connected Butterfly, including those connected to other processes through the bridge.
+
+        The packet is encoded once, and the same frame is written to every Butterfly.
+        :param pack: The packet to send.
+        :param exclude: A local Butterfly to skip.
+        """
+        super().broadcast(self.encode_packet(pack), exclude)
+
     def add_packet_type(self, pack: BasePacket):
         """
         Adds a new Packet type to your handler.
@@ -65,6 +282,14 @@ class PacketHandler(ButterflyHandler):
         """
         # Get the ID.
         id = pack.id
+        if pack.batch:
+            if pack.layout is None or pack.fields is None:
+                raise ValueError("Batched packet type {} needs a layout and fields".format(pack.__name__))
+            # Check the layout now, rather than when the first batch arrives.
+            get_decoder(pack, framed_header.size)
+            self.batch_types[id] = pack
+        else:
+            self.batch_types.pop(id, None)
         self.packet_types[id] = pack
 
         return pack
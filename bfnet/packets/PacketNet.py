@@ -18,6 +18,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import types
 
 from bfnet.Net import Net
+from bfnet.util import as_coroutine_function
 
 
 class PacketNet(Net):
@@ -29,6 +30,9 @@ class PacketNet(Net):
         super().__init__(ip, port, loop, server)
         # Set the real handler.
         self._real_handler = None
+        # Handlers for logical channels, by channel ID, and the handler for any other channel.
+        self._channel_handlers = {}
+        self._default_channel_handler = None
 
     def handle(self, butterfly):
         """
@@ -48,12 +52,42 @@ class PacketNet(Net):
 
         This can be used as a decorator, or as a normal call.
 
-        The handler MUST be a coroutine.
+        The handler MUST be a coroutine. Generator-based coroutines are adapted once, here.
 
         This handler MUST be an infinite loop. Failure to do so will mean your packets will stop being
         handled after one packet arrives.
         :param func: The function to set as the handler.
         :return: Your function back.
         """
-        self._real_handler = func
+        self._real_handler = as_coroutine_function(func)
         return func
+
+    def set_channel_handler(self, func: types.GeneratorType=None, channel_id: int=None):
+        """
+        Set the handler for logical channels.
+
+        This can be used as a decorator, or as a normal call. To set the handler for one channel ID only,
+        use it as `@net.set_channel_handler(channel_id=1)`.
+
+        Like the Packet handler, this MUST be a coroutine, and MUST be an infinite loop. It is called with a
+        :class:`bfnet.packets.Channels.Channel`, which has the same read() and write() methods as a Butterfly.
+        :param func: The function to set as the handler.
+        :param channel_id: The channel ID to handle, or None to handle every channel without its own handler.
+        :return: Your function back.
+        """
+        if func is None:
+            return lambda real_func: self.set_channel_handler(real_func, channel_id)
+        handler = as_coroutine_function(func)
+        if channel_id is None:
+            self._default_channel_handler = handler
+        else:
+            self._channel_handlers[channel_id] = handler
+        return func
+
+    def get_channel_handler(self, channel_id: int):
+        """
+        Get the handler for a logical channel.
+        :param channel_id: The channel ID.
+        :return: The handler, or None if there isn't one.
+        """
+        return self._channel_handlers.get(channel_id, self._default_channel_handler)
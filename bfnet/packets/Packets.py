@@ -19,17 +19,58 @@ import struct
 import collections
 
 from bfnet import util
+from .Scheduling import PRIORITY_NORMAL
+
+# Stands in for a class attribute that doesn't exist.
+_missing = object()
 
 
 class _MetaPacket(type):
     """
-    This Metaclass exists only to prepare an ordered dict.
+    This Metaclass prepares an ordered dict, and sets up the slots and free-list pool for each Packet class.
+
+    Classes that declare a `fields` schema get `__slots__` generated from it.
+    Classes that don't get a `__dict__`, so that they can set any attribute they like.
+    A class attribute with the same name as a field, such as `x = 0`, becomes the default value of that field.
     """
 
     @classmethod
     def __prepare__(mcs, name, bases):
         return collections.OrderedDict()
 
+    def __new__(mcs, name, bases, namespace):
+        defaults = {}
+        for base in reversed(bases):
+            defaults.update(getattr(base, "_field_defaults", {}))
+        if "__slots__" not in namespace:
+            fields = namespace.get("fields")
+            if fields is not None:
+                slots = []
+                for field in fields:
+                    if field in namespace:
+                        value = namespace[field]
+                    else:
+                        value = next((getattr(base, field) for base in bases if hasattr(base, field)), _missing)
+                    if hasattr(value, "__get__"):
+                        # A property, a method or a slot of a base class already holds this field.
+                        continue
+                    if field in namespace:
+                        # A slot can't have the same name as a class attribute.
+                        defaults[field] = namespace.pop(field)
+                    elif value is not _missing:
+                        defaults.setdefault(field, value)
+                    slots.append(field)
+                namespace["__slots__"] = tuple(slots)
+            elif not any(base.__dictoffset__ for base in bases):
+                namespace["__slots__"] = ("__dict__",)
+        namespace["_field_defaults"] = defaults
+        cls = super().__new__(mcs, name, bases, dict(namespace))
+        # Every class gets its own pool.
+        cls._pool = []
+        # The size of the body, for fixed layouts.
+        cls._layout_size = struct.calcsize(cls.layout) if cls.layout is not None else None
+        return cls
+
 
 class BasePacket(object, metaclass=_MetaPacket):
     """
@@ -37,6 +78,7 @@ class BasePacket(object, metaclass=_MetaPacket):
 
     This just creates a few stub methods.
     """
+    __slots__ = ("butterfly", "_retained", "_released", "_encoded")
 
     # Define a default id.
     # Packet IDs are ALWAYS unsigned, so this will never meet.
@@ -46,11 +88,103 @@ class BasePacket(object, metaclass=_MetaPacket):
     # This is ">" for network endianness by default.
     _endianness = ">"
 
+    # Should this packet type be compressed, if compression is enabled on the handler?
+    # Leave this off for small control packets, as they won't benefit from it.
+    compress = False
+
+    # The names of the attributes that make up this packet, in the order they are packed.
+    # If this is set, the class gets __slots__ generated from it instead of a __dict__.
+    fields = None
+
+    # Should instances be kept in a free-list pool and reused, instead of being created for every packet?
+    # Pooled packets are only valid until the next read() on their Butterfly, unless retain() is called.
+    pooled = False
+    # The maximum number of free instances to keep around.
+    pool_size = 64
+
+    # A fixed struct format for the packet body, with one value for each name in `fields`, such as "!Iff".
+    # If this is set, the default unpack() and gen() use it.
+    layout = None
+    # The priority of this packet type, when frames are held back because the client isn't reading fast enough.
+    # See :mod:`bfnet.packets.Scheduling`.
+    priority = PRIORITY_NORMAL
+
+    # Is a packet never changed once it has been created? If so, it remembers its own encoded frames.
+    # See :mod:`bfnet.packets.FrameCache`.
+    immutable = False
+    # Does gen() only depend on cache_key()? If so, encoded frames are kept in the handler's frame cache.
+    cacheable = False
+
+    # Should runs of this packet type be decoded together into a PacketBatch, instead of one at a time?
+    # This needs `layout` and `fields` to be set.
+    batch = False
+
     def __init__(self, pbf):
         """
         Default init method.
         """
         self.butterfly = pbf
+        self._retained = False
+        self._released = False
+        self._encoded = None
+        for name, value in self._field_defaults.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def acquire(cls, pbf):
+        """
+        Get an instance of this packet type, from the pool if possible.
+        :param pbf: The :class:`PacketButterfly` the packet belongs to.
+        :return: A new or recycled packet.
+        """
+        if cls.pooled and cls._pool:
+            pack = cls._pool.pop()
+            pack.butterfly = pbf
+            pack._released = False
+            return pack
+        return cls(pbf)
+
+    def release(self):
+        """
+        Return this packet to the pool, if it is pooled and has not been retained.
+
+        This is called automatically by the :class:`PacketButterfly` once your handler has read the next packet.
+        Releasing a packet more than once does nothing.
+        """
+        if not self.pooled or self._retained or self._released:
+            return
+        self._released = True
+        pool = type(self)._pool
+        if len(pool) < self.pool_size:
+            self.reset()
+            pool.append(self)
+
+    def retain(self):
+        """
+        Keep this packet out of the pool, so it is safe to hold on to after the next read().
+        """
+        self._retained = True
+
+    def reset(self):
+        """
+        Reset this packet before it is put back into the pool.
+
+        Override this to clear your own attributes, if unpack() doesn't overwrite all of them.
+        """
+        self.butterfly = None
+        self._encoded = None
+
+    def cache_key(self):
+        """
+        Get the key this packet is cached under, if the packet type is cacheable.
+
+        Two packets of the same type with equal keys MUST generate the same body.
+        By default this is the values of `fields`, or every public attribute if there are no fields.
+        :return: A hashable key.
+        """
+        if self.fields is not None:
+            return tuple(getattr(self, name) for name in self.fields)
+        return tuple(sorted((name, value) for name, value in vars(self).items() if not name.startswith("_")))
 
     def on_creation(self):
         """
@@ -78,10 +212,13 @@ class BasePacket(object, metaclass=_MetaPacket):
         """
         # Get the variables.
         to_fmt = []
-        v = vars(self)
-        for variable, val in v.items():
+        if self.fields is not None:
+            v = [(variable, getattr(self, variable)) for variable in self.fields]
+        else:
+            v = vars(self).items()
+        for variable, val in v:
             # Get a list of valid types.
-            if type(val) not in [bytes, str, int, float]:
+            if type(val) not in [bytes, str, int, float, list, tuple]:
                 self.butterfly.logger.debug("Found un-packable type: {}, skipping".format(type(val)))
             elif variable.startswith("_"):
                 self.butterfly.logger.debug("Found private variable {}, skipping".format(variable))
@@ -99,6 +236,7 @@ class Packet(BasePacket):
 
     This extends from BasePacket, and adds useful details that you'll want to use.
     """
+    __slots__ = ("_original_data",)
 
     def __init__(self, pbf):
         """
@@ -108,6 +246,13 @@ class Packet(BasePacket):
         super().__init__(pbf)
         self._original_data = b""
 
+    def reset(self):
+        """
+        Reset this packet before it is put back into the pool.
+        """
+        super().reset()
+        self._original_data = b""
+
     def create(self, data: bytes) -> bool:
         """
         Create a new Packet.
@@ -124,6 +269,9 @@ class Packet(BasePacket):
         Unpack the data for the packet.
         :return: A boolean, if it was unpacked.
         """
+        if self.layout is not None:
+            for name, value in zip(self.fields, util.get_struct(self.layout).unpack(data)):
+                setattr(self, name, value)
         return True
 
     def gen(self) -> bytes:
@@ -131,3 +279,5 @@ class Packet(BasePacket):
         Generate a new set of data to write to the connection.
         :return:
         """
+        if self.layout is not None:
+            return util.get_struct(self.layout).pack(*[getattr(self, name) for name in self.fields])
@@ -0,0 +1,103 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Priority scheduling of outbound frames.
+#
+# While the transport's write buffer is below its high-water mark, frames are written straight away, in the order
+# they are sent. Once it is full, frames are held back in an :class:`OutboundScheduler`, and released highest
+# priority first as the buffer drains, so a heartbeat doesn't wait behind megabytes of bulk data.
+#
+# Frames of the same priority are always sent in order. To stop bulk traffic starving forever, a frame's priority
+# goes up by one for every `aging` seconds it has been waiting.
+#
+# Frames are only reordered when it is safe to: compressed frames share one compression context, and session
+# journals count frames in the order they were sent, so both always use PRIORITY_NORMAL. Every frame of a stream
+# uses the same priority, so its chunks stay between its start and end.
+
+import collections
+
+# Bulk transfers, such as stream chunks.
+PRIORITY_BULK = -1
+# The default, for ordinary packets.
+PRIORITY_NORMAL = 0
+# Latency-critical control messages, such as heartbeats, acks and cancels.
+PRIORITY_CONTROL = 1
+
+
+class OutboundScheduler(object):
+    """
+    Frames held back for one connection, in a FIFO for each priority.
+    """
+
+    def __init__(self, loop, aging: float=0.1):
+        """
+        Create a new OutboundScheduler.
+        :param loop: The event loop, for the clock.
+        :param aging: How long a frame waits before its priority goes up by one, in seconds.
+        """
+        self._loop = loop
+        self.aging = aging
+        # A dict of priority -> deque of (time queued, frame).
+        self._queues = {}
+        self._count = 0
+        # The total size of the frames held back.
+        self.buffered = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, frame: bytes, priority: int):
+        """
+        Hold back a frame.
+        :param frame: The encoded frame.
+        :param priority: Its priority. Higher is sent first.
+        """
+        queue = self._queues.get(priority)
+        if queue is None:
+            queue = self._queues[priority] = collections.deque()
+        queue.append((self._loop.time(), frame))
+        self._count += 1
+        self.buffered += len(frame)
+
+    def pop(self) -> bytes:
+        """
+        Take the next frame to send: the oldest frame of the highest priority, after aging.
+        :return: The frame, or None if nothing is held back.
+        """
+        if not self._count:
+            return None
+        now = self._loop.time()
+        best = None
+        best_priority = None
+        for priority, queue in self._queues.items():
+            if not queue:
+                continue
+            effective = priority + (now - queue[0][0]) / self.aging
+            if best is None or effective > best_priority:
+                best, best_priority = queue, effective
+        _, frame = best.popleft()
+        self._count -= 1
+        self.buffered -= len(frame)
+        return frame
+
+    def clear(self):
+        """
+        Throw away every frame held back, such as when the connection is lost.
+        """
+        self._queues.clear()
+        self._count = 0
+        self.buffered = 0
@@ -0,0 +1,219 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Resumable sessions.
+#
+# When sessions are enabled on a :class:`PacketHandler`, every packet written to a client with `write()` or
+# `write_raw()` is given an implicit sequence number and recorded in a bounded journal. A client that reconnects
+# sends a :class:`SessionPacket` with its token and the last sequence number it received, and only
+# the frames it missed are replayed.
+#
+# The protocol is:
+#     - The client sends a SessionPacket as its first packet. The token is all zeroes for a new session.
+#     - The server replies with a SessionPacket holding the session token and the sequence number the
+#       client should continue from. If this differs from what the client sent, or the token changed,
+#       the session could not be resumed and the client must resynchronize.
+#     - Every frame after that reply with the FLAG_SEQUENCED header flag, including replayed ones, increments the
+#       sequence number by one. Other frames, such as heartbeats, state, streams and channel frames, are not
+#       journaled, and are not counted.
+#     - The client may send further SessionPackets to acknowledge frames, so the server can drop them.
+
+import collections
+import mmap
+import os
+import struct
+
+from .Packets import Packet
+from .Codecs import FLAG_SEQUENCED
+
+
+class SessionPacket(Packet):
+    """
+    The control packet used to start, resume and acknowledge a session.
+    """
+    # Negative IDs are reserved for ButterflyNet's own packets.
+    id = -2
+    fields = ("token", "seq")
+
+    _layout = struct.Struct("!16sQ")
+
+    def __init__(self, pbf, token: bytes=b"\x00" * 16, seq: int=0):
+        super().__init__(pbf)
+        self.token = token
+        self.seq = seq
+
+    def unpack(self, data: bytes) -> bool:
+        self.token, self.seq = self._layout.unpack(data[:self._layout.size])
+        return True
+
+    def gen(self) -> bytes:
+        return self._layout.pack(self.token, self.seq)
+
+
+def mark_sequenced(frame: bytes) -> bytes:
+    """
+    Set the FLAG_SEQUENCED header flag on an encoded frame.
+    :param frame: The frame, including the header.
+    :return: The new frame.
+    """
+    # The flags are the first byte after the magic number.
+    return frame[:2] + bytes((frame[2] | FLAG_SEQUENCED,)) + frame[3:]
+
+
+class SessionJournal(object):
+    """
+    A bounded ring buffer of sequence-numbered outbound frames, held in memory.
+    """
+
+    def __init__(self, capacity: int=1024):
+        """
+        Create a new SessionJournal.
+        :param capacity: The maximum number of frames to keep.
+        """
+        self.capacity = capacity
+        # The sequence number the next frame will get.
+        self.next_seq = 1
+        self._frames = collections.deque()
+
+    @property
+    def last_seq(self) -> int:
+        """
+        The sequence number of the last frame appended.
+        """
+        return self.next_seq - 1
+
+    @property
+    def first_seq(self) -> int:
+        """
+        The sequence number of the oldest frame still held.
+        """
+        if not self._frames:
+            return self.next_seq
+        return self._frames[0][0]
+
+    def append(self, frame: bytes) -> int:
+        """
+        Record an outbound frame.
+        :param frame: The full, uncompressed frame.
+        :return: The sequence number of the frame.
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        if len(self._frames) >= self.capacity:
+            self._evict()
+        self._store(seq, frame)
+        return seq
+
+    def trim(self, seq: int):
+        """
+        Drop every frame up to and including a sequence number, as the client has acknowledged them.
+        :param seq: The last sequence number acknowledged.
+        """
+        while self._frames and self._frames[0][0] <= seq:
+            self._evict()
+
+    def replay(self, after: int):
+        """
+        Get every frame after a sequence number.
+        :param after: The last sequence number the client received.
+        :return: A list of frames, or None if some of the frames have already been dropped.
+        """
+        if after > self.last_seq or after + 1 < self.first_seq:
+            return None
+        return [self._load(entry) for entry in self._frames if entry[0] > after]
+
+    def close(self):
+        """
+        Free any resources held by the journal.
+        """
+        self._frames.clear()
+
+    def _store(self, seq: int, frame: bytes):
+        self._frames.append((seq, frame))
+
+    def _load(self, entry: tuple) -> bytes:
+        return entry[1]
+
+    def _evict(self):
+        self._frames.popleft()
+
+
+class MappedSessionJournal(SessionJournal):
+    """
+    A SessionJournal that spills its frames into a memory-mapped file, instead of holding them on the heap.
+
+    The file is used as a byte ring; old frames are dropped as new ones overwrite them.
+    """
+
+    def __init__(self, path: str, max_bytes: int=1024 * 1024, capacity: int=65536):
+        """
+        Create a new MappedSessionJournal.
+        :param path: The file to map. It will be created or truncated.
+        :param max_bytes: The size of the file.
+        :param capacity: The maximum number of frames to keep.
+        """
+        super().__init__(capacity)
+        self.path = path
+        self.max_bytes = max_bytes
+
+        with open(path, "wb") as f:
+            f.truncate(max_bytes)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), max_bytes)
+        self._write = 0
+
+    def _store(self, seq: int, frame: bytes):
+        size = len(frame)
+        if size > self.max_bytes:
+            raise ValueError("Frame of {} bytes is larger than the journal".format(size))
+        start = self._write
+        if start + size > self.max_bytes:
+            # Wrap around. Everything left in the tail is older than everything at the start.
+            while self._frames and self._frames[0][1] >= start:
+                self._evict()
+            start = 0
+        end = start + size
+        # Drop the frames we are about to overwrite.
+        while self._frames and self._frames[0][1] < end and self._frames[0][1] + self._frames[0][2] > start:
+            self._evict()
+        self._map[start:end] = frame
+        self._frames.append((seq, start, size))
+        self._write = end
+
+    def _load(self, entry: tuple) -> bytes:
+        _, offset, size = entry
+        return self._map[offset:offset + size]
+
+    def close(self):
+        super().close()
+        self._map.close()
+        self._file.close()
+        os.unlink(self.path)
+
+
+class Session(object):
+    """
+    A resumable session, that outlives the connection it was created on.
+    """
+
+    def __init__(self, token: bytes, journal: SessionJournal):
+        self.token = token
+        self.journal = journal
+        # The Butterfly currently attached, or None if the client is disconnected.
+        self.butterfly = None
+        # The timer that expires the session while the client is disconnected.
+        self.expiry = None
@@ -0,0 +1,417 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Replicating state to many clients, by sending what has changed instead of full snapshots.
+#
+# The state is a table of entities, keyed by an unsigned 32-bit entity ID. Each entity is a record of a packet type
+# with `fields` and `layout` set, which is the schema. On the server, a :class:`StateSync` holds the table. The
+# application changes entities with :func:`StateSync.update` and :func:`StateSync.remove`, then calls
+# :func:`StateSync.tick` at its own tick rate, which closes a new version of the state and sends it to every
+# subscribed client.
+#
+# Each client has a baseline, the last version it acknowledged with a :class:`StateAckPacket`. It is sent a delta
+# holding every field changed between its baseline and the current version. Each changed entity is sent as its ID,
+# a bitmask of the fields that changed, and only those values, packed with the schema's layout. A zero bitmask
+# means the entity was removed. Deltas are cumulative, so a client that misses a few, such as over UDP, is brought
+# up to date by the next one, and clients that acknowledged the same version share one encoded delta. Only the
+# changes of the last `history` versions are kept, so the work done on each tick depends on what changed, not on
+# the size of the table.
+#
+# A client gets a full snapshot when it subscribes, when its baseline is older than the history, and every
+# `resync_every` ticks, so a client that has somehow drifted is corrected.
+#
+# On the client, :func:`bfnet.packets.PacketButterfly.replicate` creates a :class:`StateReplica` for a sync ID, which
+# applies the frames as they arrive, and acknowledges each version. Override :func:`StateReplica.on_update` to find
+# out what changed.
+#
+# State frames are not recorded in the session journal, as a reconnected client is sent a full snapshot anyway.
+
+import struct
+
+from bfnet import util
+from .Batches import parse_layout
+from .Packets import Packet
+from .Scheduling import PRIORITY_CONTROL
+
+# The header of a state frame: sync ID, version, baseline version (0 for a full snapshot).
+state_header = struct.Struct("!HII")
+
+
+class StatePacket(Packet):
+    """
+    A full snapshot of, or delta to, a replicated state.
+
+    This is only used to decode the header. Bodies are built by :class:`StateSync` directly.
+    """
+    # Negative IDs are reserved for ButterflyNet's own packets.
+    id = -7
+    fields = ("sync_id", "version", "baseline", "records")
+    # Full snapshots are worth compressing, if compression is enabled.
+    compress = True
+
+    def __init__(self, pbf, sync_id: int=0, version: int=0, baseline: int=0, records: bytes=b""):
+        super().__init__(pbf)
+        self.sync_id = sync_id
+        self.version = version
+        self.baseline = baseline
+        self.records = records
+
+    def unpack(self, data: bytes) -> bool:
+        self.sync_id, self.version, self.baseline = state_header.unpack_from(data)
+        self.records = data[state_header.size:]
+        return True
+
+    def gen(self) -> bytes:
+        return state_header.pack(self.sync_id, self.version, self.baseline) + self.records
+
+
+class StateAckPacket(Packet):
+    """
+    The control packet a client sends to acknowledge a version of a replicated state.
+    """
+    id = -8
+    fields = ("sync_id", "version")
+    priority = PRIORITY_CONTROL
+
+    _layout = struct.Struct("!HI")
+
+    def __init__(self, pbf, sync_id: int=0, version: int=0):
+        super().__init__(pbf)
+        self.sync_id = sync_id
+        self.version = version
+
+    def unpack(self, data: bytes) -> bool:
+        self.sync_id, self.version = self._layout.unpack(data[:self._layout.size])
+        return True
+
+    def gen(self) -> bytes:
+        return self._layout.pack(self.sync_id, self.version)
+
+
+class StateSchema(object):
+    """
+    Packs and unpacks entity records of a packet type, with a bitmask of the fields included.
+    """
+
+    def __init__(self, packet_type):
+        """
+        Create a new StateSchema.
+        :param packet_type: The packet class, which must have `layout` and `fields` set.
+        """
+        if packet_type.layout is None or packet_type.fields is None:
+            raise ValueError("State packet type {} needs a layout and fields".format(packet_type.__name__))
+        self.packet_type = packet_type
+        self.fields = tuple(packet_type.fields)
+        self.codes = parse_layout(packet_type.layout)
+        if len(self.codes) != len(self.fields):
+            raise ValueError("{} has {} fields, but its layout has {} values".format(
+                packet_type.__name__, len(self.fields), len(self.codes)))
+        self.order = packet_type.layout[0] if packet_type.layout[:1] in "@=<>!" else "!"
+        self.index = {name: i for i, name in enumerate(self.fields)}
+        self.full_mask = (1 << len(self.fields)) - 1
+        self.mask_size = (len(self.fields) + 7) // 8
+        # The entity ID and bitmask in front of each record, in the same byte order as the layout.
+        self.record_header = util.get_struct("{}I{}s".format(self.order, self.mask_size))
+        # The value of each field in a new entity, until it is set.
+        self.defaults = [b"" if code.endswith("s") else False if code == "?" else 0 for code in self.codes]
+        # A dict of bitmask -> (struct of the whole record, indexes of the fields, the bitmask as bytes).
+        self._masks = {}
+
+    def record_struct(self, mask: int) -> tuple:
+        """
+        Get the struct for a record holding the fields in a bitmask.
+        :param mask: The bitmask, with bit N set for field N.
+        :return: A tuple of (:class:`struct.Struct`, the indexes of the fields in the bitmask, the bitmask as bytes).
+        """
+        entry = self._masks.get(mask)
+        if entry is None:
+            indexes = tuple(i for i in range(len(self.codes)) if mask >> i & 1)
+            record = util.get_struct("{}I{}s{}".format(self.order, self.mask_size,
+                                                       "".join(self.codes[i] for i in indexes)))
+            entry = self._masks[mask] = (record, indexes, mask.to_bytes(self.mask_size, "big"))
+        return entry
+
+    def pack(self, entity_id: int, mask: int, values: list) -> bytes:
+        """
+        Pack one record.
+        :param entity_id: The entity ID.
+        :param mask: The fields to include, or 0 if the entity was removed.
+        :param values: The values of every field of the entity.
+        :return: The record.
+        """
+        record, indexes, mask_bytes = self.record_struct(mask)
+        if mask == self.full_mask:
+            return record.pack(entity_id, mask_bytes, *values)
+        return record.pack(entity_id, mask_bytes, *[values[i] for i in indexes])
+
+    def unpack(self, data: bytes):
+        """
+        Unpack every record in a frame body.
+        :param data: The records.
+        :return: A generator of (entity ID, bitmask, indexes of the fields in the bitmask, their values).
+        """
+        offset = 0
+        end = len(data)
+        header = self.record_header
+        while offset < end:
+            entity_id, mask = header.unpack_from(data, offset)
+            mask = int.from_bytes(mask, "big")
+            record, indexes, _ = self.record_struct(mask)
+            yield entity_id, mask, indexes, record.unpack_from(data, offset)[2:]
+            offset += record.size
+
+
+class _Subscriber(object):
+    """
+    What a StateSync knows about one client.
+    """
+    __slots__ = ("butterfly", "acked", "since_full")
+
+    def __init__(self, butterfly):
+        self.butterfly = butterfly
+        # The last version the client acknowledged, or 0 if it needs a full snapshot.
+        self.acked = 0
+        # The number of ticks since the client was sent a full snapshot.
+        self.since_full = 0
+
+
+class StateSync(object):
+    """
+    The server side of a replicated state.
+    """
+
+    def __init__(self, sync_id: int, packet_type, history: int=64, resync_every: int=300):
+        """
+        Create a new StateSync. Use :func:`bfnet.packets.PacketHandler.add_state_sync` instead of calling this directly.
+        :param sync_id: The ID of the state, which clients replicate it with.
+        :param packet_type: The packet type of each entity, which must have `layout` and `fields` set.
+        :param history: The number of versions to keep the changes of.
+            Clients whose baseline is older than this are sent a full snapshot.
+        :param resync_every: How many ticks to send each client a full snapshot after, or None to never.
+        """
+        self.sync_id = sync_id
+        self.schema = StateSchema(packet_type)
+        self.history = history
+        self.resync_every = resync_every
+        # A dict of entity ID -> list of field values.
+        self.entities = {}
+        self.version = 0
+        # The changes since the last tick, as a dict of entity ID -> bitmask of changed fields.
+        self._pending = {}
+        # The changes made in each of the last `history` versions, oldest first.
+        self._changes = []
+        # A dict of Butterfly -> _Subscriber.
+        self._subscribers = {}
+
+        self.full_sent = 0
+        self.deltas_sent = 0
+
+    def update(self, entity_id: int, pack=None, **values):
+        """
+        Set fields of an entity, creating it if it doesn't exist. Only fields whose value changed are sent.
+        :param entity_id: The entity ID.
+        :param pack: A packet of the state's type to take every field from.
+        :param values: Fields to set by name.
+        """
+        schema = self.schema
+        if pack is not None:
+            values = dict(zip(schema.fields, (getattr(pack, name) for name in schema.fields)), **values)
+        current = self.entities.get(entity_id)
+        if current is None:
+            current = self.entities[entity_id] = list(schema.defaults)
+            mask = schema.full_mask
+        else:
+            mask = 0
+        index = schema.index
+        for name, value in values.items():
+            i = index[name]
+            if current[i] != value:
+                current[i] = value
+                mask |= 1 << i
+        if mask:
+            self._pending[entity_id] = self._pending.get(entity_id, 0) | mask
+
+    def remove(self, entity_id: int):
+        """
+        Remove an entity.
+        :param entity_id: The entity ID.
+        """
+        if self.entities.pop(entity_id, None) is not None:
+            self._pending[entity_id] = 0
+
+    def subscribe(self, butterfly):
+        """
+        Start replicating the state to a client. It is sent a full snapshot on the next tick.
+        :param butterfly: The :class:`bfnet.packets.PacketButterfly` of the client.
+        """
+        self._subscribers.setdefault(butterfly, _Subscriber(butterfly))
+
+    def unsubscribe(self, butterfly):
+        """
+        Stop replicating the state to a client.
+        :param butterfly: The :class:`bfnet.packets.PacketButterfly` of the client.
+        """
+        self._subscribers.pop(butterfly, None)
+
+    def ack(self, butterfly, version: int):
+        """
+        Called when a client acknowledges a version, which becomes its baseline.
+        :param butterfly: The Butterfly of the client.
+        :param version: The version.
+        """
+        subscriber = self._subscribers.get(butterfly)
+        if subscriber is not None and subscriber.acked < version <= self.version:
+            subscriber.acked = version
+
+    def _delta(self, baseline: int) -> dict:
+        """
+        Merge the changes made since a baseline.
+        :return: A dict of entity ID -> bitmask of changed fields.
+        """
+        changes = self._changes
+        merged = {}
+        for version_changes in changes[len(changes) - (self.version - baseline):]:
+            for entity_id, mask in version_changes.items():
+                merged[entity_id] = merged.get(entity_id, 0) | mask
+        return merged
+
+    def _encode(self, changed) -> bytes:
+        """
+        Encode the records of changed entities.
+        :param changed: A dict of entity ID -> bitmask, or None for every entity.
+        """
+        schema = self.schema
+        entities = self.entities
+        if changed is None:
+            record, _, mask_bytes = schema.record_struct(schema.full_mask)
+            pack = record.pack
+            return b"".join([pack(entity_id, mask_bytes, *values) for entity_id, values in entities.items()])
+        pack = schema.pack
+        return b"".join([pack(entity_id, mask if entity_id in entities else 0, entities.get(entity_id))
+                         for entity_id, mask in changed.items()])
+
+    def tick(self):
+        """
+        Close a new version of the state, and send it to every subscribed client.
+        """
+        self.version += 1
+        self._changes.append(self._pending)
+        self._pending = {}
+        if len(self._changes) > self.history:
+            del self._changes[0]
+        oldest = self.version - len(self._changes)
+
+        # Clients that acknowledged the same version get the same body.
+        bodies = {}
+        for butterfly, subscriber in list(self._subscribers.items()):
+            if butterfly._closing:
+                del self._subscribers[butterfly]
+                continue
+            baseline = subscriber.acked
+            subscriber.since_full += 1
+            if baseline < oldest or (self.resync_every is not None and subscriber.since_full >= self.resync_every):
+                baseline = 0
+            if baseline == 0:
+                subscriber.since_full = 0
+                self.full_sent += 1
+            else:
+                self.deltas_sent += 1
+            body = bodies.get(baseline)
+            if body is None:
+                records = self._encode(None if baseline == 0 else self._delta(baseline))
+                body = bodies[baseline] = state_header.pack(self.sync_id, self.version, baseline) + records
+            butterfly.send_state(body)
+
+
+class StateReplica(object):
+    """
+    The client side of a replicated state. Use :func:`bfnet.packets.PacketButterfly.replicate` to create one.
+    """
+
+    def __init__(self, butterfly, sync_id: int, packet_type):
+        """
+        Create a new StateReplica.
+        :param butterfly: The :class:`bfnet.packets.PacketButterfly` connected to the server.
+        :param sync_id: The ID of the state.
+        :param packet_type: The packet type of each entity, the same as the server's.
+        """
+        self.butterfly = butterfly
+        self.sync_id = sync_id
+        self.schema = StateSchema(packet_type)
+        # A dict of entity ID -> list of field values.
+        self.entities = {}
+        # The last version applied, or 0 before the first snapshot.
+        self.version = 0
+
+    def get(self, entity_id: int):
+        """
+        Get an entity as a packet.
+        :param entity_id: The entity ID.
+        :return: A packet of the state's type, with every field set, or None if there is no such entity.
+        """
+        values = self.entities.get(entity_id)
+        if values is None:
+            return None
+        pack = self.schema.packet_type(self.butterfly)
+        for name, value in zip(self.schema.fields, values):
+            setattr(pack, name, value)
+        return pack
+
+    def apply(self, pack: StatePacket) -> bool:
+        """
+        Apply a snapshot or delta from the server, and acknowledge it.
+        :param pack: The StatePacket recieved.
+        :return: True if it was applied, or False if it was older than what we have, or we don't have its baseline.
+        """
+        if pack.version <= self.version or pack.baseline > self.version:
+            return False
+        entities = self.entities
+        changed, removed = set(), set()
+        if not pack.baseline:
+            removed.update(entities)
+            entities.clear()
+        schema = self.schema
+        full_mask = schema.full_mask
+        for entity_id, mask, indexes, values in schema.unpack(pack.records):
+            if not mask:
+                if entities.pop(entity_id, None) is not None:
+                    removed.add(entity_id)
+                continue
+            changed.add(entity_id)
+            removed.discard(entity_id)
+            if mask == full_mask:
+                entities[entity_id] = list(values)
+                continue
+            current = entities.get(entity_id)
+            if current is None:
+                current = entities[entity_id] = list(schema.defaults)
+            for i, value in zip(indexes, values):
+                current[i] = value
+        self.version = pack.version
+        self.butterfly.send_control(StateAckPacket(self.butterfly, self.sync_id, pack.version))
+        self.on_update(changed, removed)
+        return True
+
+    def on_update(self, changed: set, removed: set):
+        """
+        Stub called after a snapshot or delta has been applied.
+
+        Override this to react to changes.
+        :param changed: The IDs of the entities that were created or changed.
+        :param removed: The IDs of the entities that were removed.
+        """
+        pass
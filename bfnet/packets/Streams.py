@@ -0,0 +1,127 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import collections
+import struct
+
+from .Packets import Packet
+from .Scheduling import PRIORITY_BULK
+
+# Every stream frame body starts with the stream ID and the stream flags.
+stream_header = struct.Struct("!IB")
+
+# This is the first frame of the stream. The rest of the body is the packet itself.
+STREAM_START = 0x01
+# This is the last frame of the stream. It carries no data.
+STREAM_END = 0x02
+
+
+class StreamPacket(Packet):
+    """
+    A StreamPacket is a packet with a payload too large to be sent in one go.
+
+    The packet itself is sent first, followed by the payload in chunks. The packet is handed to your
+    handler as soon as it arrives, and the chunks can be read with :func:`StreamPacket.read_chunk`, or
+    with `async for` on Python 3.5+, while the rest of the payload is still arriving.
+
+    Other packets on the same connection are sent between the chunks, so a large transfer won't block them.
+
+    To send one, use :func:`bfnet.packets.PacketButterfly.write_stream`.
+    """
+
+    # The number of bytes that can be buffered before the connection stops reading.
+    buffer_limit = 1024 * 1024
+
+    # Chunks are held back behind everything else, once the client isn't reading fast enough.
+    priority = PRIORITY_BULK
+
+    def __init__(self, pbf):
+        super().__init__(pbf)
+        self.stream_id = None
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._finished = False
+        self._exception = None
+        self._waiter = None
+
+    def feed_chunk(self, chunk: bytes):
+        """
+        Called by the Butterfly when a chunk arrives.
+        :param chunk: The chunk of data.
+        """
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered > self.buffer_limit:
+            self.butterfly.pause_stream(self)
+        self._wake()
+
+    def feed_end(self, exc: Exception=None):
+        """
+        Called by the Butterfly when the stream ends.
+        :param exc: The exception to raise in the reader, if the stream was cut off.
+        """
+        self._finished = True
+        self._exception = exc
+        self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read_chunk(self):
+        """
+        Read the next chunk of the payload.
+
+        This method is a coroutine.
+        :return: The chunk, or None if the stream has ended.
+        """
+        while not self._chunks:
+            if self._exception is not None:
+                raise self._exception
+            if self._finished:
+                return None
+            self._waiter = self.butterfly._loop.create_future()
+            await self._waiter
+        chunk = self._chunks.popleft()
+        self._buffered -= len(chunk)
+        if self._buffered <= self.buffer_limit // 2:
+            self.butterfly.resume_stream(self)
+        return chunk
+
+    async def read_all(self) -> bytes:
+        """
+        Read the entire payload into memory.
+
+        This method is a coroutine.
+        """
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if chunk is None:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
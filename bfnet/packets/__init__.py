@@ -2,3 +2,13 @@ from .PacketHandler import PacketHandler
 from .Packets import BasePacket, Packet
 from .PacketButterfly import PacketButterfly
 from .PacketNet import PacketNet
+from .PacketCompressor import PacketCompressor
+from .Sessions import SessionPacket, SessionJournal, MappedSessionJournal
+from .Streams import StreamPacket
+from .Channels import Channel, ChannelWindowPacket
+from .Datagrams import DatagramButterfly, DatagramEndpoint
+from .Codecs import HelloPacket
+from .Batches import PacketBatch
+from .FrameCache import FrameCache
+from .Heartbeats import PingPacket, PongPacket, HeartbeatScheduler
+from .StateSync import StateSync, StateReplica
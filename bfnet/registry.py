@@ -0,0 +1,206 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The table of connected Butterflies.
+#
+# Every connection gets an integer connection ID, which never changes and is never reused by the same handler.
+# Secondary indexes map any key worked out from a Butterfly, such as its IP or the user it has logged in as,
+# to the connections with that key, so they can be found without scanning every connection.
+#
+# For example:
+#     handler.butterflies.add_index("user", lambda bf: getattr(bf, "user", None))
+#     ...
+#     butterfly.user = "alice"
+#     handler.butterflies.reindex(butterfly)
+#     ...
+#     for bf in handler.butterflies.lookup("user", "alice"):
+#         bf.write(b"You have mail\n")
+
+import collections
+import collections.abc
+import itertools
+
+
+class ConnectionRegistry(collections.abc.Mapping):
+    """
+    A mapping of connection ID -> (Butterfly, handling task), with secondary indexes.
+
+    Iterating over it, or over values() or items(), works on a snapshot, so it is safe to connect and disconnect
+    clients while doing so.
+    """
+
+    def __init__(self):
+        # A dict of connection ID -> (butterfly, task), in the order they connected.
+        self._entries = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        # A dict of index name -> function that gets the key of a Butterfly.
+        self._key_funcs = {}
+        # A dict of index name -> dict of key -> dict of connection ID -> butterfly.
+        self._indexes = {}
+        # A dict of connection ID -> dict of index name -> the key it is indexed under.
+        self._keys = {}
+
+        self.add_index("ip", lambda bf: bf.ip)
+
+    def __getitem__(self, connection_id: int) -> tuple:
+        return self._entries[connection_id]
+
+    def __contains__(self, connection_id) -> bool:
+        return connection_id in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def values(self) -> list:
+        return list(self._entries.values())
+
+    def items(self) -> list:
+        return list(self._entries.items())
+
+    def add_index(self, name: str, key):
+        """
+        Add a secondary index. Connections that are already registered are added to it straight away.
+        :param name: The name of the index, used with :func:`lookup`.
+        :param key: A function that takes a Butterfly and returns its key, or None to leave it out of the index.
+            The key must be hashable.
+        """
+        self._key_funcs[name] = key
+        self._indexes[name] = {}
+        for connection_id, (butterfly, _) in self._entries.items():
+            self._index(name, connection_id, butterfly)
+
+    def remove_index(self, name: str):
+        """
+        Remove a secondary index.
+        :param name: The name of the index.
+        """
+        if self._key_funcs.pop(name, None) is None:
+            return
+        del self._indexes[name]
+        for keys in self._keys.values():
+            keys.pop(name, None)
+
+    def _index(self, name: str, connection_id: int, butterfly):
+        """
+        Put a connection into one index, under its current key.
+        """
+        key = self._key_funcs[name](butterfly)
+        keys = self._keys[connection_id]
+        if name in keys and keys[name] == key:
+            return
+        self._unindex(name, connection_id)
+        if key is not None:
+            self._indexes[name].setdefault(key, collections.OrderedDict())[connection_id] = butterfly
+            keys[name] = key
+
+    def _unindex(self, name: str, connection_id: int):
+        """
+        Take a connection out of one index.
+        """
+        keys = self._keys[connection_id]
+        if name not in keys:
+            return
+        key = keys.pop(name)
+        index = self._indexes[name]
+        bucket = index[key]
+        del bucket[connection_id]
+        if not bucket:
+            del index[key]
+
+    def add(self, butterfly, task) -> int:
+        """
+        Register a new connection, and give it a connection ID.
+        :param butterfly: The Butterfly. Its `connection_id` is set.
+        :param task: The task handling its data.
+        :return: The connection ID.
+        """
+        connection_id = next(self._ids)
+        butterfly.connection_id = connection_id
+        self._entries[connection_id] = (butterfly, task)
+        self._keys[connection_id] = {}
+        for name in self._key_funcs:
+            self._index(name, connection_id, butterfly)
+        return connection_id
+
+    def remove(self, butterfly) -> tuple:
+        """
+        Unregister a connection.
+        :param butterfly: The Butterfly.
+        :return: The (butterfly, task) it was registered with, or None if it wasn't registered.
+        """
+        entry = self._entries.get(butterfly.connection_id)
+        if entry is None or entry[0] is not butterfly:
+            return None
+        connection_id = butterfly.connection_id
+        for name in self._key_funcs:
+            self._unindex(name, connection_id)
+        del self._keys[connection_id]
+        return self._entries.pop(connection_id)
+
+    def reindex(self, butterfly):
+        """
+        Update the indexes of a connection, after something its keys depend on has changed, such as logging in.
+        :param butterfly: The Butterfly.
+        """
+        connection_id = butterfly.connection_id
+        if connection_id not in self._entries:
+            return
+        for name in self._key_funcs:
+            self._index(name, connection_id, butterfly)
+
+    def get_butterfly(self, connection_id: int):
+        """
+        Get the Butterfly with a connection ID.
+        :param connection_id: The connection ID.
+        :return: The Butterfly, or None if it isn't connected.
+        """
+        entry = self._entries.get(connection_id)
+        return entry[0] if entry is not None else None
+
+    def lookup(self, name: str, key) -> list:
+        """
+        Get every connection with a key in an index.
+        :param name: The name of the index.
+        :param key: The key to look up.
+        :return: A list of Butterflies, in the order they connected.
+        """
+        bucket = self._indexes[name].get(key)
+        return list(bucket.values()) if bucket else []
+
+    def lookup_one(self, name: str, key):
+        """
+        Get the connection with a key in an index, such as the connection of a user.
+        :param name: The name of the index.
+        :param key: The key to look up.
+        :return: The Butterfly that connected first with that key, or None if there isn't one.
+        """
+        bucket = self._indexes[name].get(key)
+        if not bucket:
+            return None
+        return next(iter(bucket.values()))
+
+    def count(self, name: str, key) -> int:
+        """
+        Get the number of connections with a key in an index, such as to limit connections per IP.
+        :param name: The name of the index.
+        :param key: The key to look up.
+        """
+        bucket = self._indexes[name].get(key)
+        return len(bucket) if bucket else 0
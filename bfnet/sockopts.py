@@ -0,0 +1,147 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Socket-level tuning.
+#
+# A :class:`SocketOptions` profile is set on a handler with :func:`bfnet.ButterflyHandler.set_socket_options`.
+# It is applied to the listening sockets when the server is created, and to every connection as it is made.
+# Anything left as None keeps the operating system's default.
+
+import logging
+import socket
+
+logger = logging.getLogger("ButterflyNet")
+
+
+class SocketOptions(object):
+    """
+    A profile of socket options.
+    """
+
+    def __init__(self, nodelay: bool=None, send_buffer: int=None, recv_buffer: int=None, keepalive: bool=None,
+            keepalive_idle: int=None, keepalive_interval: int=None, keepalive_count: int=None, backlog: int=100,
+            write_buffer_high: int=None, write_buffer_low: int=None):
+        """
+        Create a new SocketOptions profile.
+        :param nodelay: Should Nagle's algorithm be disabled with TCP_NODELAY?
+        :param send_buffer: The kernel send buffer size (SO_SNDBUF), in bytes.
+        :param recv_buffer: The kernel recieve buffer size (SO_RCVBUF), in bytes.
+            This is also set on the listening socket, so it applies before the TCP window is agreed.
+        :param keepalive: Should TCP keepalive probes be sent on idle connections?
+        :param keepalive_idle: How long a connection is idle before the first probe, in seconds.
+        :param keepalive_interval: The time between probes, in seconds.
+        :param keepalive_count: How many probes can go unanswered before the connection is dropped.
+        :param backlog: The listen backlog.
+        :param write_buffer_high: The transport write buffer high-water mark, in bytes.
+        :param write_buffer_low: The transport write buffer low-water mark, in bytes.
+        """
+        self.nodelay = nodelay
+        self.send_buffer = send_buffer
+        self.recv_buffer = recv_buffer
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.backlog = backlog
+        self.write_buffer_high = write_buffer_high
+        self.write_buffer_low = write_buffer_low
+
+    @classmethod
+    def low_latency(cls, **kwargs):
+        """
+        A profile for small request/response packets.
+
+        Nagle's algorithm is disabled, and the write buffers are kept small so backpressure kicks in early.
+        :param kwargs: Any options to override.
+        """
+        options = dict(nodelay=True, keepalive=True, keepalive_idle=30, keepalive_interval=10, keepalive_count=3,
+                       write_buffer_high=16 * 1024, write_buffer_low=4 * 1024)
+        options.update(kwargs)
+        return cls(**options)
+
+    @classmethod
+    def bulk(cls, **kwargs):
+        """
+        A profile for high-throughput transfers, such as streams.
+
+        The kernel and transport buffers are large, so the connection is rarely starved.
+        :param kwargs: Any options to override.
+        """
+        options = dict(nodelay=False, send_buffer=1024 * 1024, recv_buffer=1024 * 1024, keepalive=True,
+                       keepalive_idle=120, keepalive_interval=30, keepalive_count=4, backlog=1024,
+                       write_buffer_high=1024 * 1024, write_buffer_low=256 * 1024)
+        options.update(kwargs)
+        return cls(**options)
+
+    def _socket_options(self, listening: bool) -> list:
+        """
+        Get the list of (level, option, value) to set on a socket.
+        :param listening: Is this for the listening socket? Only options inherited by accepted sockets are set on it.
+        """
+        options = []
+        if self.recv_buffer is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer))
+        if listening:
+            return options
+        if self.send_buffer is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer))
+        if self.nodelay is not None:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay)))
+        if self.keepalive is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive)))
+        if self.keepalive:
+            # macOS calls TCP_KEEPIDLE TCP_KEEPALIVE.
+            idle = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+            for option, value in ((idle, self.keepalive_idle),
+                                  (getattr(socket, "TCP_KEEPINTVL", None), self.keepalive_interval),
+                                  (getattr(socket, "TCP_KEEPCNT", None), self.keepalive_count)):
+                if option is not None and value is not None:
+                    options.append((socket.IPPROTO_TCP, option, value))
+        return options
+
+    def apply_socket(self, sock, listening: bool=False):
+        """
+        Set the options on a socket.
+
+        Options that the socket doesn't support, such as TCP options on a Unix domain socket, are skipped.
+        :param sock: The socket.
+        :param listening: Is this a listening socket?
+        """
+        # Ask the socket itself, as sock.type can have SOCK_NONBLOCK mixed in on older Pythons.
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE) != socket.SOCK_STREAM:
+            return
+        tcp = sock.family in (socket.AF_INET, getattr(socket, "AF_INET6", socket.AF_INET))
+        for level, option, value in self._socket_options(listening):
+            if level == socket.IPPROTO_TCP and not tcp:
+                continue
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                logger.warning("Could not set socket option {}: {}".format(option, e))
+
+    def apply_transport(self, transport):
+        """
+        Set the options on a new connection's socket and transport.
+        :param transport: The transport of the connection.
+        """
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            self.apply_socket(sock)
+        if self.write_buffer_high is not None or self.write_buffer_low is not None:
+            set_limits = getattr(transport, "set_write_buffer_limits", None)
+            if set_limits is not None:
+                set_limits(high=self.write_buffer_high, low=self.write_buffer_low)
@@ -0,0 +1,290 @@
+"""
+Copyright (C) 2015 Isaac Dickinson
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Helpers for testing ButterflyNet applications in-process, without sockets or TLS.
+#
+# :class:`MemoryTransport` connects two protocols through memory, with the same flow control as a real transport.
+# :class:`VirtualTimeLoop` is an event loop whose clock jumps straight to the next timer whenever there is
+# nothing else to do, so timeouts and rate limits can be tested instantly.
+#
+# For example:
+#     loop = VirtualTimeLoop()
+#     handler = ButterflyHandler(loop)
+#     reader, writer = open_connection(handler)
+#     writer.write(b"HELLO")
+#     loop.run_until_complete(reader.read(5))
+
+import asyncio
+import itertools
+import selectors
+
+
+class MemoryTransport(asyncio.Transport):
+    """
+    One end of an in-memory connection.
+
+    Data written is delivered to the other end on the next iteration of the event loop,
+    with everything written in the meantime delivered in one call to data_received().
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: asyncio.Protocol, extra: dict=None):
+        """
+        Create a new MemoryTransport. Use :func:`connect_pair` instead of calling this directly.
+        :param loop: The event loop to use.
+        :param protocol: The protocol at this end of the connection.
+        :param extra: The extra info, such as the peername.
+        """
+        super().__init__(extra)
+        self._loop = loop
+        self._protocol = protocol
+        self.peer = None
+
+        # Data written, that the other end hasn't recieved yet.
+        self._pending = bytearray()
+        self._scheduled = False
+        self._reading = True
+        self._closing = False
+        self._write_paused = False
+
+        self.high_water = 64 * 1024
+        self.low_water = 16 * 1024
+
+        # The total number of bytes written, for benchmarks.
+        self.bytes_written = 0
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def write(self, data: bytes):
+        if self._closing or not data:
+            return
+        self._pending.extend(data)
+        self.bytes_written += len(data)
+        self._schedule()
+        if not self._write_paused and len(self._pending) > self.high_water:
+            self._write_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        self.write(b"".join(list_of_data))
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return len(self._pending)
+
+    def set_write_buffer_limits(self, high: int=None, low: int=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self.high_water, self.low_water = high, low
+        if not self._write_paused and len(self._pending) > self.high_water and self._protocol is not None:
+            self._write_paused = True
+            self._protocol.pause_writing()
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        if not self._reading:
+            self._reading = True
+            self.peer._schedule()
+
+    def close(self):
+        """
+        Close the connection, once everything written so far has been delivered.
+        """
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.call_soon(self._close_when_flushed)
+
+    def abort(self):
+        """
+        Close the connection immediately, throwing away anything not yet delivered.
+        """
+        self._pending.clear()
+        self._closing = True
+        self._connection_lost(None)
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._deliver)
+
+    def _deliver(self):
+        """
+        Hand everything written so far to the other end.
+        """
+        self._scheduled = False
+        peer = self.peer
+        if not self._pending or peer is None or peer._protocol is None or not peer._reading:
+            # Delivery is picked up again when the other end resumes reading.
+            return
+        data = bytes(self._pending)
+        self._pending.clear()
+        peer._protocol.data_received(data)
+        if self._write_paused and len(self._pending) <= self.low_water and self._protocol is not None:
+            self._write_paused = False
+            self._protocol.resume_writing()
+
+    def _close_when_flushed(self):
+        if self._pending and self.peer._protocol is not None and self.peer._reading:
+            self._deliver()
+        self._connection_lost(None)
+
+    def _connection_lost(self, exc):
+        """
+        Tell both ends that the connection is gone.
+        """
+        for transport in (self, self.peer):
+            protocol, transport._protocol = transport._protocol, None
+            transport._closing = True
+            if protocol is not None:
+                protocol.connection_lost(exc)
+
+
+_ports = itertools.count(1)
+
+
+def connect_pair(loop: asyncio.AbstractEventLoop, client: asyncio.Protocol, server: asyncio.Protocol,
+        client_addr: tuple=None, server_addr: tuple=("127.0.0.1", 0)) -> tuple:
+    """
+    Connect two protocols to each other in memory.
+    :param loop: The event loop to use.
+    :param client: The protocol of the client end.
+    :param server: The protocol of the server end.
+    :param client_addr: The address the server sees the client as. Every client gets a different port by default.
+    :param server_addr: The address the client sees the server as.
+    :return: A tuple of (client transport, server transport).
+    """
+    if client_addr is None:
+        client_addr = ("127.0.0.1", next(_ports))
+    client_transport = MemoryTransport(loop, client, {"peername": server_addr, "sockname": client_addr})
+    server_transport = MemoryTransport(loop, server, {"peername": client_addr, "sockname": server_addr})
+    client_transport.peer, server_transport.peer = server_transport, client_transport
+    server.connection_made(server_transport)
+    client.connection_made(client_transport)
+    return client_transport, server_transport
+
+
+def connect(handler, client: asyncio.Protocol, client_addr: tuple=None):
+    """
+    Connect a protocol to a handler in memory, as if it had connected to the handler's server.
+
+    If the handler has no Net yet, a Net without a server is created, so you can add handlers to it
+    with `handler.net`.
+    :param handler: The :class:`bfnet.ButterflyHandler` to connect to.
+    :param client: The protocol of the client end.
+    :param client_addr: The address the server sees the client as.
+    :return: A tuple of (the Butterfly created for the client, the client transport).
+    """
+    if handler.net is None:
+        handler._create_net("memory", 0)
+    server = handler.butterfly_factory()
+    transport, _ = connect_pair(handler._event_loop, client, server, client_addr)
+    return server, transport
+
+
+def open_connection(handler, client_addr: tuple=None, limit: int=asyncio.streams._DEFAULT_LIMIT) -> tuple:
+    """
+    Connect a client to a handler in memory, and get a reader and writer for it.
+    :param handler: The :class:`bfnet.ButterflyHandler` to connect to.
+    :param client_addr: The address the server sees the client as.
+    :param limit: The buffer limit of the reader.
+    :return: A tuple of (:class:`asyncio.StreamReader`, :class:`asyncio.StreamWriter`).
+    """
+    loop = handler._event_loop
+    reader = asyncio.StreamReader(limit=limit, loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    _, transport = connect(handler, protocol, client_addr)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    A selector that advances the clock of a :class:`VirtualTimeLoop` instead of waiting.
+
+    Real file descriptors are still polled, so threads can still wake the loop up.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.loop = None
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing is scheduled at all, so the only thing that can happen is real I/O.
+            return self._selector.select(None)
+        # Skip straight to the next timer.
+        self.loop.advance(timeout)
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop with a virtual clock.
+
+    Whenever every task is waiting on a timer, the clock jumps straight to the next one, so
+    `asyncio.sleep(3600)` returns immediately, with `loop.time()` an hour later.
+    """
+
+    def __init__(self):
+        selector = _VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self._clock = 0.0
+
+    def time(self) -> float:
+        return self._clock
+
+    def advance(self, seconds: float):
+        """
+        Move the clock forward. Timers that are now due run on the next iteration of the loop.
+        :param seconds: The number of seconds to move forward.
+        """
+        self._clock += seconds
@@ -15,43 +15,94 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-"""
-Misc utils for deep internal usage of Python.
-"""
+# Misc utils for deep internal usage of Python.
+
+import array
+import asyncio
+import functools
+import inspect
 import struct
+import sys
+import types
+
+# The struct codes for each integer size, smallest first.
+_signed_codes = (("b", 1, -0x80, 0x7f), ("h", 2, -0x8000, 0x7fff),
+                 ("i", 4, -0x80000000, 0x7fffffff), ("q", 8, -0x8000000000000000, 0x7fffffffffffffff))
+_unsigned_codes = (("B", 1, 0, 0xff), ("H", 2, 0, 0xffff), ("I", 4, 0, 0xffffffff), ("Q", 8, 0, 0xffffffffffffffff))
+
+# The array typecode with the same size as each struct code.
+_array_codes = {}
+for _code in "bBhHiIlLqQ":
+    _array_codes.setdefault((_code.lower(), array.array(_code).itemsize), _code)
 
 
-def infer_int_pack(arg) -> str:
+def infer_int_pack(arg, signed: bool=True, min_size: int=2) -> str:
     """
     Attempt to infer the correct struct format for an int.
     :param arg: The integer argument to infer.
+    :param signed: Should a signed format be used?
+        Signed ints that are too big to be signed, but fit in 64 bits, get "Q".
+    :param min_size: The smallest size, in bytes, to use.
     :return: A character for the struct string.
     """
-    # Short
-    if (-32768) <= arg <= 32767:
-        return "h"
-    # Int
-    elif (-2147483648) <= arg <= 2147483647:
-        return "i"
-    # Long Long, I think
-    elif (-18446744073709551616) <= arg <= 18446744073709551615:
-        return "q"
-    else:
-        raise OverflowError("Number {} too big to fit into a struct normally".format(arg))
-
-
-def _process_args(*args):
-    a = []
-    for arg in args:
-        if isinstance(arg, str):
-            for _ in arg:
-                a.append(_)
-        elif isinstance(arg, bytes):
-            for _ in arg:
-                a.append(_.to_bytes(1, "big"))
-        else:
-            a.append(arg)
-    return tuple(a)
+    return _infer_range(arg, arg, signed, min_size)
+
+
+def infer_int_list_pack(values, signed: bool=True, min_size: int=1) -> str:
+    """
+    Infer one struct format that fits every int in a sequence.
+    :param values: The integers to infer.
+    :param signed: Should a signed format be used?
+    :param min_size: The smallest size, in bytes, to use.
+    :return: A character for the struct string.
+    """
+    if not values:
+        return _infer_range(0, 0, signed, min_size)
+    return _infer_range(min(values), max(values), signed, min_size)
+
+
+def _infer_range(low: int, high: int, signed: bool, min_size: int) -> str:
+    for code, size, code_low, code_high in (_signed_codes if signed else _unsigned_codes):
+        if size >= min_size and code_low <= low and high <= code_high:
+            return code
+    # Too big for signed, but positive values might still fit unsigned.
+    if signed and low >= 0 and high <= 0xffffffffffffffff:
+        return "Q"
+    raise OverflowError("Number {} too big to fit into a struct normally".format(high if high > 0 else low))
+
+
+def pack_int_list(values, signed: bool=True, min_size: int=1) -> bytes:
+    """
+    Pack a list of ints in network order, using one width for the whole list.
+
+    This packs through :class:`array.array`, which is much faster than packing each int for long lists.
+    :param values: The integers to pack.
+    :param signed: Should a signed format be used?
+    :param min_size: The smallest size, in bytes, to use.
+    :return: The packed bytes data.
+    """
+    code = infer_int_list_pack(values, signed, min_size)
+    size = struct.calcsize(code)
+    typecode = _array_codes.get((code.lower(), size))
+    if typecode is None:
+        return get_struct("!{}{}".format(len(values), code)).pack(*values)
+    if code.isupper():
+        typecode = typecode.upper()
+    arr = array.array(typecode, values)
+    if sys.byteorder == "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+@functools.lru_cache(maxsize=1024)
+def get_struct(fmt: str) -> struct.Struct:
+    """
+    Get a compiled :class:`struct.Struct` for a format string.
+
+    These are cached, so each format is only compiled once.
+    :param fmt: The format string.
+    """
+    return struct.Struct(fmt)
 
 
 def auto_infer_struct_pack(*args, pack: bool=False) -> str:
@@ -59,33 +110,89 @@ def auto_infer_struct_pack(*args, pack: bool=False) -> str:
     This will automatically attempt to infer the struct pack/unpack format string
     from the types of your arguments.
 
-    All integer values will be set as unsigned by default.
+    All integer values are signed, and at least 2 bytes wide.
+    Strings are encoded as UTF-8. Lists of ints are packed with one width for the whole list.
 
     :param pack: Should we automatically pack your data up?
     :param args: The items to infer from.
     :return: Either the string format string, or the packed bytes data.
     """
-    # Set the fmt string
-    fmt_string = "!"
+    # Build the fmt string, and the values to pack, in one pass.
+    codes = ["!"]
+    values = []
     for arg in args:
-        if type(arg) == int:
-            # Complicated stuff here.
-            fmt_string += infer_int_pack(arg)
-        elif type(arg) == float:
+        t = type(arg)
+        if t is int:
+            # Most ints are small, so check for a short first.
+            codes.append("h" if -0x8000 <= arg <= 0x7fff else infer_int_pack(arg))
+            values.append(arg)
+        elif t is float:
             # Use a double.
-            fmt_string += "d"
-        elif type(arg) == str:
+            codes.append("d")
+            values.append(arg)
+        elif t is str:
             # Use a char[] s
-            fmt_string += "{}s".format(len(arg))
-        elif type(arg) == bytes:
-            # Use a normal 'c'
-            fmt_string += "{}c".format(len(arg))
-        elif type(arg) == bool:
-            fmt_string += "?"
+            arg = arg.encode()
+            codes.append("{}s".format(len(arg)))
+            values.append(arg)
+        elif t is bytes:
+            codes.append("{}s".format(len(arg)))
+            values.append(arg)
+        elif t is bool:
+            codes.append("?")
+            values.append(arg)
+        elif (t is list or t is tuple) and all(type(i) is int for i in arg):
+            codes.append("{}{}".format(len(arg), infer_int_list_pack(arg, min_size=2)))
+            values.extend(arg)
         else:
             raise ValueError("Type could not be determined - {}".format(type(arg)))
+    fmt_string = "".join(codes)
     if not pack:
         return fmt_string
     # Pack data.
-    s = struct.pack(fmt_string, *_process_args(*args))
-    return s
+    return get_struct(fmt_string).pack(*values)
+
+
+def new_queue(loop) -> asyncio.Queue:
+    """
+    Create an :class:`asyncio.Queue` for an event loop.
+
+    Python 3.10 removed the loop argument, and binds the queue to the loop it is first used on instead.
+    :param loop: The event loop to use.
+    """
+    if sys.version_info >= (3, 10):
+        return asyncio.Queue()
+    return asyncio.Queue(loop=loop)
+
+
+def as_coroutine_function(func):
+    """
+    Adapt a handler, so that calling it always returns something that can be awaited.
+
+    This is done once, when the handler is registered, so it costs as little as possible on each call:
+        - Native `async def` functions are returned as-is.
+        - Generator-based coroutines are marked as awaitable with :func:`types.coroutine`, in place, and wrapped
+          in a native coroutine, as tasks can't be created from generators since Python 3.12.
+        - Anything else is wrapped, and may return an awaitable or not.
+    :param func: The handler.
+    :return: A function that returns an awaitable.
+    """
+    if inspect.iscoroutinefunction(func):
+        return func
+    if inspect.isgeneratorfunction(func):
+        generator = types.coroutine(func)
+
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            return (await generator(*args, **kwargs))
+
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        res = func(*args, **kwargs)
+        if inspect.isawaitable(res):
+            res = await res
+        return res
+
+    return wrapper
@@ -50,16 +50,14 @@ class Packet0Echo(Packet):
         return self.autopack()
 
 
-@asyncio.coroutine
-def main():
-    my_server = yield from my_handler.create_server(("127.0.0.1", 8001), ("keys/test.crt", "keys/test.key", None))
+async def main():
+    my_server = await my_handler.create_server(("127.0.0.1", 8001), ("keys/test.crt", "keys/test.key", None))
 
 
     @my_server.set_handler
-    @asyncio.coroutine
-    def handler(bf: PacketButterfly):
+    async def handler(bf: PacketButterfly):
         while True:
-            echopacket = yield from bf.read()
+            echopacket = await bf.read()
             if not echopacket:
                 break
             bf.write(echopacket)
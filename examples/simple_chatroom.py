@@ -1,7 +1,7 @@
 import logging
 import ssl
 import string
-from bfnet import Net
+from bfnet import Net, UnixBridge
 from bfnet.Butterfly import Butterfly
 from bfnet.BFHandler import ButterflyHandler
 import asyncio
@@ -21,54 +21,47 @@ loop = asyncio.get_event_loop()
 
 
 class MyHandler(ButterflyHandler):
-    @asyncio.coroutine
-    def on_connection(self, butterfly: Butterfly):
-        # Here we re-purpose the Butterfly dict.
+    async def on_connection(self, butterfly: Butterfly):
         # Read in their nickname.
         butterfly.write(b"Nickname: ")
-        nick = yield from butterfly.read()
+        nick = await butterfly.read()
         nick = nick.rstrip(b'\n').rstrip(b'\r')
+        # Nicknames are indexed, so checking if one is taken doesn't scan every connection.
+        if self.butterflies.lookup_one("nick", nick) is not None:
+            butterfly.write(b"That nickname is taken.\n")
+            butterfly.stop()
+            return
         # Tell the others somebody has connected.
         self.logger.debug("{} has joined".format(nick.decode()))
-        for bf, _ in self.butterflies.values():
-            bf.write(nick + b" has joined the room\n")
+        self.broadcast(nick + b" has joined the room\n")
         # Set the `nick` attribute on the Butterfly.
         butterfly.nick = nick
-        # Begin handling normally.
-        fut = self.begin_handling(butterfly)
-        self.butterflies[nick] = (butterfly, fut)
-
+        # Begin handling normally. This registers the Butterfly, and adds it to the nick index.
+        await super().on_connection(butterfly)
 
-    @asyncio.coroutine
-    def on_disconnect(self, butterfly: Butterfly):
-        # Override the on_disconnect to cancel the correct futures.
+    async def on_disconnect(self, butterfly: Butterfly):
+        # Cancel the handler, and remove the Butterfly from the connection table.
+        await super().on_disconnect(butterfly)
         if not hasattr(butterfly, "nick"):
             self.logger.warning("Connection cancelled before on_connect finished - will be killed soon!")
             return
-        if butterfly.nick in self.butterflies:
-            bf = self.butterflies.pop(butterfly.nick)
-            assert isinstance(bf, tuple)
-            assert len(bf) == 2
-            bf[1].cancel()
-        for bf, _ in self.butterflies.values():
-            bf.write(butterfly.nick + b" has left the room.\n")
+        self.broadcast(butterfly.nick + b" has left the room.\n")
 
 
-@asyncio.coroutine
-def main():
+async def main():
     my_handler = MyHandler.get_handler(loop=loop, log_level=logging.DEBUG)
-    my_server = yield from my_handler.create_server(("127.0.0.1", 8001), ("localhost.crt", "server.key", None))
+    # Index the connections by nickname. Butterflies without one yet are left out.
+    my_handler.butterflies.add_index("nick", lambda bf: getattr(bf, "nick", None))
+    my_server = await my_handler.create_server(("127.0.0.1", 8001), ("localhost.crt", "server.key", None))
+    # Share the room with chat servers in other processes.
+    await my_handler.set_bridge(UnixBridge("/tmp/bfnet-chat.sock"))
 
 
     # Define our simple coroutine for handling messages.
     @my_server.any_data
-    @asyncio.coroutine
-    def _handle_data(data: bytes, butterfly: Butterfly, handler: ButterflyHandler):
-        # Echo messages to all other Butterflies.
-        for bf in handler.butterflies.values():
-            assert isinstance(bf, tuple), "bf should be a tuple -> {}".format(bf)
-            if bf[0] != butterfly:
-                bf[0].write(butterfly.nick + b": " + data)
+    async def _handle_data(data: bytes, butterfly: Butterfly, handler: ButterflyHandler):
+        # Echo messages to all other Butterflies, in every process.
+        handler.broadcast(butterfly.nick + b": " + data, exclude=butterfly)
 
 
 if __name__ == '__main__':
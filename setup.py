@@ -2,14 +2,15 @@ from setuptools import setup
 import sys, os
 
 if not os.environ.get("CIRCLE_USERNAME", None):
-    if not sys.version_info >= (3, 4, 0):
-        sys.exit("Sorry, this library requires Python 3.4 or higher.")
+    if not sys.version_info >= (3, 5, 0):
+        sys.exit("Sorry, this library requires Python 3.5 or higher.")
 
 
 setup(
     name='ButterflyNet',
     version='1.0.0',
     packages=['bfnet'],
+    python_requires='>=3.5',
     url='https://butterflynet.veriny.tf',
     license='AGPLv3',
     author='Isaac Dickinson',
@@ -19,8 +20,14 @@ setup(
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: GNU Affero General Public License v3",
         "Programming Language :: Python :: 3 :: Only",
-        "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Topic :: Internet",
         "Topic :: Software Development :: Libraries"
     ],
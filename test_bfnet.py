@@ -30,3 +30,1457 @@ def test_server_echo():
     example_server.kill()
 
 
+def test_packet_compressor_roundtrip():
+    from bfnet.packets import PacketCompressor
+    dictionary = b'{"sensor": "temperature", "value": '
+    sender = PacketCompressor(dictionary, threshold=16)
+    receiver = PacketCompressor(dictionary, threshold=16)
+
+    for i in range(10):
+        body = '{{"sensor": "temperature", "value": {}, "id": {}}}'.format(i, i * 31).encode()
+        compressed = sender.compress(body)
+        assert receiver.decompress(compressed) == body
+    # The persistent context means a frame compresses better than it would on a fresh one.
+    fresh = PacketCompressor(dictionary, threshold=16)
+    assert len(sender.compress(body)) < len(fresh.compress(body))
+    assert sender.ratio > 1
+    assert not sender.should_compress(b"tiny")
+
+
+def test_unix_bridge_forwards_batches(tmpdir):
+    import asyncio
+    import socket
+    from bfnet import UnixBridge
+
+    class FakeHandler(object):
+        def __init__(self, loop):
+            self._event_loop = loop
+            self.received = []
+
+        def deliver_broadcast(self, data, exclude=None):
+            self.received.append(data)
+
+    loop = asyncio.new_event_loop()
+    path = str(tmpdir.join("bridge.sock"))
+    handlers = [FakeHandler(loop) for _ in range(3)]
+    bridges = [UnixBridge(path) for _ in handlers]
+
+    # A socket file left behind by a broker that died, which nothing is listening on.
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    async def run():
+        for handler, bridge in zip(handlers, bridges):
+            bridge._set_bf_handler(handler)
+            await bridge.start()
+        assert bridges[0].broker is not None and bridges[1].broker is None
+        bridges[0].publish(b"BF\x00\x01\x00\x00hello")
+        bridges[0].publish(b"BF\x00\x01\x00\x00world")
+        await asyncio.sleep(0.1)
+
+        # The handler running the broker stops, and the others elect a new one between them.
+        await bridges[0].stop()
+        await asyncio.sleep(0.5)
+        assert len([bridge for bridge in bridges[1:] if bridge.broker is not None]) == 1
+        bridges[1].publish(b"BF\x00\x01\x00\x00again")
+        bridges[2].publish(b"BF\x00\x01\x00\x00reply")
+        await asyncio.sleep(0.1)
+        for bridge in reversed(bridges[1:]):
+            await bridge.stop()
+
+    loop.run_until_complete(run())
+    loop.close()
+    assert handlers[0].received == []
+    assert handlers[1].received == [b"BF\x00\x01\x00\x00hello", b"BF\x00\x01\x00\x00world",
+                                    b"BF\x00\x01\x00\x00reply"]
+    assert handlers[2].received == [b"BF\x00\x01\x00\x00hello", b"BF\x00\x01\x00\x00world",
+                                    b"BF\x00\x01\x00\x00again"]
+
+
+def test_pooled_packet_reuse():
+    from bfnet.packets import Packet
+
+    class Position(Packet):
+        id = 1
+        fields = ("x", "y")
+        pooled = True
+
+        def __init__(self, pbf):
+            super().__init__(pbf)
+            self.x = 0
+            self.y = 0
+
+    first = Position.acquire(None)
+    assert not hasattr(first, "__dict__")
+    first.release()
+    assert Position.acquire(None) is first
+
+    # Releasing twice only puts it into the pool once.
+    first.release()
+    first.release()
+    assert Position._pool == [first]
+    assert Position.acquire(None) is first and Position.acquire(None) is not first
+
+    first.retain()
+    first.release()
+    assert Position.acquire(None) is not first
+
+    # Class attributes with the same name as a field become its default, instead of clashing with its slot.
+    class Velocity(Packet):
+        fields = ("dx", "dy")
+        dx = 1.5
+
+        @property
+        def dy(self):
+            return self.dx * 2
+
+    class Acceleration(Velocity):
+        fields = ("dx", "dy", "dz")
+        dz = 0.0
+
+    velocity, acceleration = Velocity(None), Acceleration(None)
+    assert velocity.dx == 1.5 and velocity.dy == 3.0
+    velocity.dx = 2.0
+    assert velocity.dy == 4.0 and not hasattr(velocity, "__dict__")
+    assert (acceleration.dx, acceleration.dy, acceleration.dz) == (1.5, 3.0, 0.0)
+
+
+def test_session_resume(tmpdir):
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.testing import connect_pair
+
+    class Message(Packet):
+        id = 1
+        fields = ("value",)
+        layout = "!I"
+
+    def message(bf, value):
+        pack = Message(bf)
+        pack.value = value
+        return pack
+
+    for spill_dir in (None, str(tmpdir)):
+        loop = asyncio.new_event_loop()
+        handler = PacketHandler(loop, loglevel=logging.WARNING)
+        handler.on_connection = lambda bf: None
+        handler.add_packet_type(Message)
+        handler.enable_sessions(capacity=16, ttl=5, spill_dir=spill_dir)
+        clients = PacketHandler(loop, loglevel=logging.WARNING)
+        clients.add_packet_type(Message)
+        client, server = clients.butterfly_factory(), handler.butterfly_factory()
+        _, server_transport = connect_pair(loop, client, server)
+
+        async def run():
+            assert not await client.start_session()
+            for value in range(3):
+                server.write(message(server, value))
+            # Heartbeats aren't journaled, so they don't take a sequence number.
+            server.send_ping()
+            assert [(await client.read()).value for _ in range(3)] == [0, 1, 2]
+            await asyncio.sleep(0.01)
+            assert client.session_seq == 3
+            client.ack_session()
+            await asyncio.sleep(0.01)
+            assert server.session.journal.first_seq == 4
+
+            # The connection drops before these two arrive.
+            server.write(message(server, 3))
+            server.write(message(server, 4))
+            server_transport.abort()
+            resumed, server2 = clients.butterfly_factory(), handler.butterfly_factory()
+            connect_pair(loop, resumed, server2)
+            assert await resumed.start_session(client.session_token, client.session_seq)
+            server2.write(message(server2, 5))
+            values = [(await asyncio.wait_for(resumed.read(), 1)).value for _ in range(3)]
+            assert values == [3, 4, 5] and resumed.session_seq == 6
+
+            # A client too far behind starts again from scratch.
+            fresh = clients.butterfly_factory()
+            connect_pair(loop, fresh, handler.butterfly_factory())
+            resumed.stop()
+            await asyncio.sleep(0.01)
+            assert not await fresh.start_session(resumed.session_token, 1)
+            assert fresh.session_token != resumed.session_token and fresh.session_seq == 0
+
+        loop.run_until_complete(run())
+        loop.close()
+
+
+def test_util_int_inference():
+    import struct
+    from bfnet import util
+
+    assert util.infer_int_pack(1) == "h"
+    assert util.infer_int_pack(2 ** 63 - 1) == "q"
+    assert util.infer_int_pack(2 ** 63) == "Q"
+    assert util.infer_int_pack(200, signed=False, min_size=1) == "B"
+    assert util.auto_infer_struct_pack(1, 2.0, "abc", b"de", [1, 70000]) == "!hd3s2s2i"
+    assert util.get_struct("!hd") is util.get_struct("!hd")
+
+    values = [-5, 0, 40000]
+    assert util.pack_int_list(values) == struct.pack("!3i", *values)
+
+
+def test_handshake_selects_codec():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.packets.Codecs import ChecksumCodec, FEATURE_CHECKSUM, FEATURE_COMPRESSION
+    from bfnet.testing import connect_pair
+
+    class Message(Packet):
+        id = 1
+        compress = True
+
+        def __init__(self, pbf, data=b""):
+            super().__init__(pbf)
+            self.data = data
+
+        def unpack(self, data):
+            self.data = data
+            return True
+
+        def gen(self):
+            return self.data
+
+    loop = asyncio.new_event_loop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    handler.add_packet_type(Message)
+    handler.set_compression(threshold=16)
+    client, server = handler.butterfly_factory(), handler.butterfly_factory()
+    client_transport, server_transport = connect_pair(loop, client, server)
+
+    async def run():
+        negotiated = await client.handshake(features=FEATURE_CHECKSUM | FEATURE_COMPRESSION)
+        client.write(Message(client, b"hello " * 20))
+        packet = await server.read()
+        return negotiated, packet.data
+
+    negotiated, data = loop.run_until_complete(run())
+    assert negotiated == (2, FEATURE_CHECKSUM | FEATURE_COMPRESSION)
+    assert data == b"hello " * 20
+    assert isinstance(client.codec, ChecksumCodec) and isinstance(server.codec, ChecksumCodec)
+    assert client.peer_accepts_compression and server.peer_accepts_compression
+
+    # A corrupted frame drops the connection.
+    frame = bytearray(client.codec.encode(0, 1, b"data"))
+    frame[-5] ^= 0xff
+    server.data_received(bytes(frame))
+    assert server_transport.is_closing()
+
+    # A client that never sends a handshake keeps using version 1.
+    legacy = handler.butterfly_factory()
+    connect_pair(loop, handler.butterfly_factory(), legacy)
+    legacy.data_received(b"BF\x00\x01\x00\x01hello")
+    packet = loop.run_until_complete(legacy.read())
+    assert packet.data == b"hello" and legacy.codec.version == 1
+    loop.close()
+
+
+def test_memory_transport_echo():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.testing import VirtualTimeLoop, open_connection
+
+    loop = VirtualTimeLoop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    connections = [open_connection(handler) for _ in range(1000)]
+
+    @handler.net.any_data
+    async def echo(data, butterfly, handler):
+        # A slow handler costs nothing in virtual time.
+        await asyncio.sleep(5)
+        butterfly.write(data)
+
+    async def run():
+        for i, (_, writer) in enumerate(connections):
+            writer.write(str(i).encode())
+        return (await asyncio.gather(*[reader.read(16) for reader, _ in connections]))
+
+    replies = loop.run_until_complete(run())
+    assert replies == [str(i).encode() for i in range(len(connections))]
+    assert loop.time() == 5
+    assert len(handler.butterflies) == len(connections)
+
+    for _, writer in connections:
+        writer.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not handler.butterflies
+    loop.close()
+
+
+def test_generator_based_handlers():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.testing import open_connection, connect
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    reader, writer = open_connection(handler)
+
+    # The old @asyncio.coroutine style, without the decorator, which is gone since Python 3.11.
+    @handler.net.prefix_match("gen")
+    def generator(data, butterfly, handler):
+        yield from asyncio.sleep(0)
+        butterfly.write(b"generator " + data)
+
+    @handler.net.any_data
+    def plain(data, butterfly, handler):
+        butterfly.write(b"plain " + data)
+
+    async def run():
+        replies = []
+        for data in (b"gen", b"other"):
+            writer.write(data)
+            replies.append(await asyncio.wait_for(reader.read(64), 1))
+        return replies
+
+    assert loop.run_until_complete(run()) == [b"generator gen", b"plain other"]
+    writer.close()
+    loop.run_until_complete(asyncio.sleep(0))
+
+    class Msg(Packet):
+        id = 1
+        fields = ("value",)
+        layout = "!I"
+
+    packet_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    packet_handler.add_packet_type(Msg)
+    client_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    client_handler.on_connection = lambda bf: None
+    client_handler.add_packet_type(Msg)
+    client = client_handler.butterfly_factory()
+    connect(packet_handler, client)
+    received = []
+
+    @packet_handler.net.set_handler
+    def read_all(bf):
+        while True:
+            pack = yield from bf.read()
+            if pack is None:
+                return
+            received.append(pack.value)
+
+    pack = Msg(client)
+    pack.value = 42
+    client.write(pack)
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert received == [42]
+    client.stop()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    loop.close()
+
+
+def test_virtual_time_handshake_timeout():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.packets import PacketHandler
+    from bfnet.testing import VirtualTimeLoop, connect
+
+    loop = VirtualTimeLoop()
+    # An old server, that only reads raw bytes, never replies to the handshake.
+    old_server = ButterflyHandler(loop, loglevel=logging.ERROR)
+    client = PacketHandler(loop, loglevel=logging.ERROR)
+    client.on_connection = lambda bf: None
+    butterfly = client.butterfly_factory()
+    connect(old_server, butterfly)
+
+    assert loop.run_until_complete(butterfly.handshake(timeout=30)) == (1, 0)
+    assert loop.time() == 30
+    butterfly.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_independent_handlers_share_loop():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.packets import PacketHandler
+    from bfnet.testing import VirtualTimeLoop, open_connection
+
+    loop = VirtualTimeLoop()
+    public = ButterflyHandler(loop, loglevel=logging.WARNING, buffer_size=4, name="public")
+    internal = ButterflyHandler(loop, loglevel=logging.ERROR, buffer_size=4096, name="internal")
+    public.set_graceful_shutdown(deadline=1, batch_interval=0)
+    connections = {public: open_connection(public), internal: open_connection(internal)}
+    chunks = {public: [], internal: []}
+
+    for handler in connections:
+        @handler.net.any_data
+        async def echo(data, butterfly, handler):
+            chunks[handler].append(data)
+            butterfly.write(data)
+
+    async def run():
+        replies = []
+        for reader, writer in connections.values():
+            writer.write(b"abcdefgh")
+            await asyncio.sleep(0.1)
+            replies.append((await reader.read(100)))
+        return replies
+
+    assert loop.run_until_complete(run()) == [b"abcdefgh", b"abcdefgh"]
+    # Each handler reads with its own buffer size.
+    assert chunks == {public: [b"abcd", b"efgh"], internal: [b"abcdefgh"]}
+    assert public.net is not internal.net and public.executor is not internal.executor
+    assert len(public.butterflies) == len(internal.butterflies) == 1
+    assert public.logger.level == logging.WARNING and internal.logger.level == logging.ERROR
+
+    # SIGTERM reaches every handler on the loop, and stops it once they have all finished.
+    ButterflyHandler._on_sigterm(loop)
+    loop.run_forever()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not public.butterflies and not internal.butterflies
+    loop.close()
+
+    # Each handler class has its own shared instance.
+    assert PacketHandler.get_handler(loop) is not ButterflyHandler.get_handler(loop)
+    assert PacketHandler.get_handler(loop) is PacketHandler.get_handler(loop)
+
+
+def test_socket_options_applied():
+    import asyncio
+    import logging
+    import socket
+    from bfnet import ButterflyHandler, SocketOptions
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    handler.set_socket_options(SocketOptions.low_latency(recv_buffer=64 * 1024, keepalive_idle=15))
+
+    async def run():
+        net = await handler.create_server(("127.0.0.1", 0), None)
+        port = net.server.sockets[0].getsockname()[1]
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        await asyncio.sleep(0.1)
+        butterfly, task = list(handler.butterflies.values())[0]
+        sock = butterfly._transport.get_extra_info("socket")
+        assert butterfly._transport.get_write_buffer_limits() == (4 * 1024, 16 * 1024)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 15
+        writer.close()
+        # Drop the connection ourselves, as the server can't close while it is still open.
+        butterfly.stop()
+        await task
+        await net.stop()
+
+    loop.run_until_complete(run())
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_adaptive_read_size_and_backpressure():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.testing import VirtualTimeLoop, open_connection, connect_pair
+
+    loop = VirtualTimeLoop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING, buffer_size=2048)
+    reader, writer = open_connection(handler)
+    sizes = []
+
+    @handler.net.any_data
+    async def record(data, butterfly, handler):
+        sizes.append(len(data))
+
+    writer.write(b"x" * 100000)
+    loop.run_until_complete(asyncio.sleep(1))
+    assert sum(sizes) == 100000
+    # Full reads double the read size.
+    assert sizes[:3] == [2048, 4096, 8192]
+    butterfly = list(handler.butterflies.values())[0][0]
+    assert butterfly.memory_stats()["read_size"] > 8192
+    for _ in range(50):
+        writer.write(b"y")
+        loop.run_until_complete(asyncio.sleep(1))
+    # Mostly empty reads shrink it back down.
+    assert butterfly.memory_stats()["read_size"] == butterfly.min_read_size
+    writer.close()
+
+    # Data that isn't read stops the connection reading, once there is twice the read size of it.
+    idle = ButterflyHandler(loop, loglevel=logging.WARNING, buffer_size=2048)
+    idle.on_connection = lambda bf: None
+    server = idle.butterfly_factory()
+    client_transport, server_transport = connect_pair(loop, asyncio.Protocol(), server)
+    client_transport.write(b"z" * 5000)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not server_transport._reading
+    assert server.memory_stats()["read_buffer"] == 5000
+    assert len(loop.run_until_complete(server.read())) == 2048
+    assert server_transport._reading
+
+    # Packets waiting to be read stop the connection reading, until they are read.
+    packets = PacketHandler(loop, loglevel=logging.WARNING, buffer_size=1000)
+    packets.on_connection = lambda bf: None
+
+    @packets.add_packet_type
+    class Blob(Packet):
+        id = 1
+
+        def unpack(self, data):
+            return True
+
+    server = packets.butterfly_factory()
+    _, server_transport = connect_pair(loop, packets.butterfly_factory(), server)
+    for _ in range(20):
+        server.data_received(b"BF\x04\x01\x00\x01\x00\x00\x00\x64" + b"z" * 100)
+    assert not server_transport._reading
+    assert server.memory_stats()["queued"] == 2000
+    for _ in range(15):
+        loop.run_until_complete(server.read())
+    assert server_transport._reading
+    loop.close()
+
+
+def test_batch_decoding():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet, PacketBatch, Batches
+    from bfnet.packets.Codecs import FLAG_LENGTH
+    from bfnet.testing import connect_pair
+
+    class Sample(Packet):
+        id = 1
+        fields = ("tick", "x", "y")
+        layout = "!Iff"
+        batch = True
+
+    loop = asyncio.new_event_loop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    handler.add_packet_type(Sample)
+    client, server = handler.butterfly_factory(), handler.butterfly_factory()
+    connect_pair(loop, client, server)
+
+    def send(count):
+        frames = []
+        for i in range(count):
+            pack = Sample(client)
+            pack.tick, pack.x, pack.y = i, i / 2, -i
+            frames.append(client.codec.encode(FLAG_LENGTH, Sample.id, pack.gen()))
+        # A full run, and half a frame, in one read.
+        data = b"".join(frames)
+        server.data_received(data + data[:7])
+        server.data_received(data[7:22])
+
+    numpy = Batches._get_numpy()
+    for use_numpy in ([True, False] if numpy is not None else [False]):
+        Batches.numpy = numpy if use_numpy else None
+        Batches._decoders.clear()
+        send(100)
+        batch = loop.run_until_complete(server.read())
+        assert isinstance(batch, PacketBatch) and len(batch) == 100
+        assert list(batch["tick"]) == list(range(100))
+        assert list(batch["y"]) == [-i for i in range(100)]
+        # The rest of the second run arrives as its own batch.
+        rest = loop.run_until_complete(server.read())
+        assert len(rest) == 1 and list(rest["tick"]) == [0]
+        packets = list(batch.packets())
+        assert packets[3].tick == 3 and packets[3].x == 1.5
+    Batches.numpy = numpy
+    loop.close()
+
+
+def test_frame_cache():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.testing import connect_pair
+
+    gens = []
+
+    class Roster(Packet):
+        id = 1
+        fields = ("room", "members")
+        cacheable = True
+
+        def gen(self):
+            gens.append(self.room)
+            return self.autopack()
+
+    class Config(Packet):
+        id = 2
+        fields = ("value",)
+        layout = "!I"
+        immutable = True
+
+    loop = asyncio.new_event_loop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    written = []
+    servers = []
+    for _ in range(3):
+        server = handler.butterfly_factory()
+        _, transport = connect_pair(loop, asyncio.Protocol(), server)
+        transport.write = written.append
+        servers.append(server)
+
+    pack = Roster(servers[0])
+    pack.room, pack.members = 1, (2, 3)
+    for server in servers:
+        server.write(pack)
+    # Every client is handed the same bytes object, and gen() only ran once.
+    assert written[0] is written[1] is written[2] and gens == [1]
+    # Changing a field changes the key.
+    pack.room = 5
+    servers[0].write(pack)
+    assert gens == [1, 5] and written[3] != written[0]
+    assert handler.frame_cache.stats()["hits"] == 2 and handler.frame_cache.stats()["misses"] == 2
+    handler.frame_cache.invalidate(pack)
+    servers[0].write(pack)
+    assert gens == [1, 5, 5]
+
+    config = Config(servers[0])
+    config.value = 7
+    servers[0].write(config)
+    config.value = 8
+    servers[0].write(config)
+    # Immutable packets are never generated again, until they are invalidated.
+    assert written[-1] is written[-2]
+    handler.frame_cache.invalidate(config)
+    servers[0].write(config)
+    assert written[-1].endswith(b"\x00\x00\x00\x08")
+    loop.close()
+
+
+def test_priority_scheduling():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.packets.Scheduling import OutboundScheduler, PRIORITY_BULK, PRIORITY_CONTROL
+    from bfnet.testing import VirtualTimeLoop, connect_pair
+
+    class Bulk(Packet):
+        id = 1
+        priority = PRIORITY_BULK
+
+        def gen(self):
+            return b"x" * 1000
+
+    class Cancel(Packet):
+        id = 2
+        priority = PRIORITY_CONTROL
+
+        def gen(self):
+            return b"cancel"
+
+    loop = VirtualTimeLoop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    server = handler.butterfly_factory()
+    _, transport = connect_pair(loop, asyncio.Protocol(), server)
+    transport.set_write_buffer_limits(high=4000)
+    written = []
+    write = transport.write
+
+    def record(data):
+        written.append(data[5:6])
+        write(data)
+
+    transport.write = record
+    for _ in range(20):
+        server.write(Bulk(server))
+    server.write(Cancel(server))
+    # The transport filled up after a few bulk frames, and the rest were held back.
+    assert len(server.scheduler) == 17
+    assert server.get_write_buffer_size() == transport.get_write_buffer_size() + server.scheduler.buffered
+    loop.run_until_complete(asyncio.sleep(0.01))
+    # The cancel overtook the bulk frames that were held back.
+    assert written.index(b"\x02") == 4 and len(written) == 21
+
+    # Frames that have waited long enough overtake higher priorities.
+    scheduler = OutboundScheduler(loop, aging=0.1)
+    scheduler.push(b"bulk", PRIORITY_BULK)
+    loop.advance(0.5)
+    scheduler.push(b"cancel", PRIORITY_CONTROL)
+    assert scheduler.pop() == b"bulk" and scheduler.pop() == b"cancel" and scheduler.pop() is None
+    server.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_send_threadsafe():
+    import asyncio
+    import logging
+    import threading
+    from bfnet import ButterflyHandler
+    from bfnet.testing import open_connection
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    reader, writer = open_connection(handler)
+    loop.run_until_complete(asyncio.sleep(0))
+    butterfly = list(handler.butterflies.values())[0][0]
+
+    def work(thread):
+        for i in range(1000):
+            handler.send_threadsafe(butterfly, "{}{:04}".format(thread, i).encode())
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data = loop.run_until_complete(reader.readexactly(10000))
+    writes = [data[i:i + 5] for i in range(0, 10000, 5)]
+    # Each thread's writes arrive in order, and the loop was woken up far less than once per write.
+    for thread in b"01":
+        assert [w for w in writes if w[0] == thread] == ["{}{:04}".format(chr(thread), i).encode() for i in range(1000)]
+    assert handler.outbox.flushed == 2000
+    assert handler.outbox.wakeups < 100
+
+    # call_soon passes the arguments through.
+    result = []
+    handler.call_soon(result.extend, (1, 2))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert result == [1, 2]
+    writer.close()
+    butterfly.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_connection_registry_indexes():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.testing import open_connection
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    handler.butterflies.add_index("user", lambda bf: getattr(bf, "user", None))
+    connections = [open_connection(handler, client_addr=(ip, 1000 + i))
+                   for i, ip in enumerate(["10.0.0.1", "10.0.0.1", "10.0.0.2"])]
+    loop.run_until_complete(asyncio.sleep(0))
+    butterflies = [bf for bf, _ in handler.butterflies.values()]
+    assert [bf.connection_id for bf in butterflies] == [1, 2, 3]
+    assert handler.butterflies.lookup("ip", "10.0.0.1") == butterflies[:2]
+    assert handler.butterflies.count("ip", "10.0.0.2") == 1
+
+    # Logging in moves a connection into the user index.
+    assert handler.butterflies.lookup_one("user", "alice") is None
+    butterflies[2].user = "alice"
+    handler.butterflies.reindex(butterflies[2])
+    assert handler.butterflies.lookup_one("user", "alice") is butterflies[2]
+
+    # Disconnecting while iterating is safe, and takes the connection out of every index.
+    for connection_id in handler.butterflies:
+        if connection_id != 1:
+            handler.butterflies[connection_id][0].stop()
+            loop.run_until_complete(asyncio.sleep(0))
+    assert list(handler.butterflies) == [1]
+    assert handler.butterflies.lookup("ip", "10.0.0.1") == butterflies[:1]
+    assert handler.butterflies.lookup_one("user", "alice") is None and handler.butterflies.count("ip", "10.0.0.2") == 0
+    butterflies[0].stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert all(writer.transport.is_closing() for _, writer in connections)
+    loop.close()
+
+
+def test_capture_and_replay(tmpdir):
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.capture import read_capture, replay, EVENT_OPEN, EVENT_DATA, EVENT_CLOSE
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    path = str(tmpdir.join("traffic.bfcap"))
+
+    async def run():
+        net = await handler.create_server(("127.0.0.1", 0), None)
+        port = net.server.sockets[0].getsockname()[1]
+
+        @net.any_data
+        async def echo(data, butterfly, handler):
+            butterfly.write(data)
+
+        capture = handler.start_capture(path, buffer_size=16)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for message in (b"hello", b"world"):
+            writer.write(message)
+            await reader.readexactly(5)
+        writer.close()
+        await asyncio.sleep(0.1)
+        handler.stop_capture()
+        assert capture.records == 4 and not capture.dropped
+
+        stats = await replay(path, "127.0.0.1", port, speed=0, copies=5)
+        # Close the connections first, as the server can't close while any are still open.
+        for butterfly, task in handler.butterflies.values():
+            butterfly.stop()
+        await asyncio.sleep(0.1)
+        assert not handler.butterflies
+        await net.stop()
+        return stats
+
+    stats = loop.run_until_complete(run())
+    records = list(read_capture(path))
+    assert [kind for _, _, kind, _ in records] == [EVENT_OPEN, EVENT_DATA, EVENT_DATA, EVENT_CLOSE]
+    assert records[1][3] == b"hello" and records[2][3] == b"world"
+    assert records[1][0] <= records[2][0]
+    assert stats["clients"] == 5 and stats["errors"] == 0 and stats["writes"] == 10 and stats["bytes"] == 50
+    assert 0 < stats["latency_p50"] <= stats["latency_max"]
+    loop.close()
+
+
+def test_lazy_handler_resources():
+    import asyncio
+    import functools
+    import logging
+    import ssl
+    from concurrent import futures
+    from bfnet import ButterflyHandler
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    # Nothing slow is made until it is needed.
+    assert handler._executor is None and handler._ssl is None
+    assert loop.run_until_complete(handler.async_func(functools.partial(sum, [1, 2]))) == 3
+    assert isinstance(handler._executor, futures.ThreadPoolExecutor)
+    assert isinstance(handler.ssl_context, ssl.SSLContext) and handler.ssl_context is handler._ssl
+
+    # A context given up front is used as it is.
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    assert ButterflyHandler(loop, ssl_context=context, loglevel=logging.WARNING).ssl_context is context
+    handler.executor.shutdown()
+    loop.close()
+
+
+def test_heartbeats_measure_rtt():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler
+    from bfnet.testing import VirtualTimeLoop, connect
+
+    loop = VirtualTimeLoop()
+    handler = PacketHandler(loop, loglevel=logging.ERROR)
+    heartbeats = handler.enable_heartbeats(interval=1.0, max_missed=3, slots=4)
+    handler._create_net("memory", 0)
+
+    @handler.net.set_handler
+    async def handle(bf):
+        while (await bf.read()) is not None:
+            pass
+
+    client_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    client_handler.on_connection = lambda bf: None
+
+    clients = [client_handler.butterfly_factory() for _ in range(3)]
+    servers = [connect(handler, client)[0] for client in clients]
+    # The last client takes 40ms to see anything the server sends.
+    slow = clients[-1]
+    receive = slow.data_received
+    slow.data_received = lambda data: loop.call_later(0.04, receive, data)
+    # This one never answers.
+    dead, _ = connect(handler, asyncio.Protocol())
+    loop.run_until_complete(asyncio.sleep(0))
+    assert {bf.connection_id % 4 for bf in servers + [dead]} == {0, 1, 2, 3}
+
+    loop.run_until_complete(asyncio.sleep(2.1))
+    assert all(bf.rtt.samples == 2 for bf in servers)
+    assert servers[0].rtt.srtt == 0 and abs(servers[-1].rtt.srtt - 0.04) < 1e-6
+    assert heartbeats.slowest(1) == [servers[-1]]
+    assert heartbeats.samples.total == 6 and heartbeats.samples.percentile(0.99) == 0.05
+    assert heartbeats.histograms()["rtt"].as_dict()[0.001] == 2
+
+    # The client that never answered is dropped after three pings, and the others are still connected.
+    loop.run_until_complete(asyncio.sleep(1.2))
+    assert dead.connection_id not in handler.butterflies and len(handler.butterflies) == 3
+    handler.disable_heartbeats()
+    # The scheduler's index goes with it, so the registry doesn't keep indexing connections into it.
+    assert "heartbeat" not in handler.butterflies._indexes
+    for bf in servers:
+        bf.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_state_sync_deltas():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.testing import VirtualTimeLoop, connect
+
+    class Player(Packet):
+        fields = ("x", "y", "health", "name")
+        layout = "!ffH8s"
+
+    loop = VirtualTimeLoop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    sync = handler.add_state_sync(1, Player, history=4, resync_every=10)
+    client_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    client_handler.on_connection = lambda bf: None
+
+    clients = [client_handler.butterfly_factory() for _ in range(2)]
+    servers = [connect(handler, client)[0] for client in clients]
+    replicas = [client.replicate(1, Player) for client in clients]
+    updates = []
+    replicas[0].on_update = lambda changed, removed: updates.append((changed, removed))
+    sent = []
+    for server in servers:
+        server.send_state = lambda body, send=server.send_state: (sent.append(body), send(body))
+
+    def tick():
+        del sent[:]
+        sync.tick()
+        loop.run_until_complete(asyncio.sleep(0))
+
+    for i in range(100):
+        sync.update(i, x=float(i), health=100, name=b"p%d" % i)
+        sync.subscribe(servers[i % 2])
+    tick()
+    # Both get the same full snapshot.
+    assert sent[0] is sent[1] and len(sent[0]) == 10 + 100 * 23
+    assert replicas[0].entities == replicas[1].entities and replicas[0].get(7).name == b"p7\x00\x00\x00\x00\x00\x00"
+    # The second client stops acknowledging, so its baseline stays at the first snapshot.
+    clients[1].send_control = lambda pack: None
+
+    # One changed field costs its value, the entity ID and the bitmask.
+    sync.update(7, y=2.5, health=100)
+    sync.remove(9)
+    tick()
+    assert len(sent[0]) == 10 + (5 + 4) + 5
+    assert replicas[0].get(7).y == 2.5 and 9 not in replicas[0].entities
+    assert updates[-1] == ({7}, {9})
+
+    # The client that stopped acknowledging gets everything since its baseline.
+    sync.update(8, x=1.0)
+    tick()
+    assert len(sent[0]) == 10 + 9 and len(sent[1]) == 10 + 9 + 5 + 9
+    assert replicas[1].entities == replicas[0].entities and replicas[1].get(8).x == 1.0
+
+    # Once its baseline is older than the history, it is sent a full snapshot.
+    tick()
+    tick()
+    assert sync.full_sent == 2 and len(sent[1]) == 10 + 9 + 5 + 9
+    tick()
+    assert sync.full_sent == 3 and len(sent[1]) == 10 + 99 * 23 and len(sent[0]) == 10
+
+    # Everyone is resynced every 10 ticks.
+    for _ in range(5):
+        tick()
+    assert len(sent[0]) == 10 + 99 * 23 and replicas[0].version == sync.version == 11
+    for server in servers:
+        server.stop()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+
+def test_streams_interleave_with_plain_writes():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet, StreamPacket
+    from bfnet.testing import connect_pair
+
+    class Small(Packet):
+        id = 1
+        fields = ("value",)
+        layout = "!I"
+
+    class File(StreamPacket):
+        id = 2
+
+        def gen(self):
+            return b"file"
+
+        def unpack(self, data):
+            return True
+
+    loop = asyncio.new_event_loop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    handler.add_packet_type(Small)
+    handler.add_packet_type(File)
+    client, server = handler.butterfly_factory(), handler.butterfly_factory()
+    # No hello handshake, so neither side has seen a framed frame yet.
+    connect_pair(loop, client, server)
+
+    async def run():
+        for value in (1, 2):
+            pack = Small(client)
+            pack.value = value
+            client.write(pack)
+            await client.write_stream(File(client), b"x" * 1000, chunk_size=100)
+        received = []
+        for _ in range(4):
+            pack = await asyncio.wait_for(server.read(), 1)
+            if isinstance(pack, File):
+                received.append(len(await pack.read_all()))
+            else:
+                received.append(pack.value)
+        return received
+
+    # Neither plain write swallows the stream frames after it.
+    assert loop.run_until_complete(run()) == [1, 1000, 2, 1000]
+    loop.close()
+
+
+def test_compressed_stream_while_paused():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, StreamPacket
+    from bfnet.packets.Codecs import FEATURE_COMPRESSION
+    from bfnet.packets.Scheduling import PRIORITY_BULK
+    from bfnet.testing import connect_pair
+
+    class File(StreamPacket):
+        id = 1
+        compress = True
+        priority = PRIORITY_BULK
+
+        def gen(self):
+            return b"file"
+
+        def unpack(self, data):
+            return True
+
+    loop = asyncio.new_event_loop()
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.on_connection = lambda bf: None
+    handler.add_packet_type(File)
+    handler.set_compression(threshold=16)
+    client, server = handler.butterfly_factory(), handler.butterfly_factory()
+    connect_pair(loop, client, server)
+    data = bytes(range(256)) * 40
+
+    async def run():
+        await client.handshake(features=FEATURE_COMPRESSION)
+        assert client.peer_accepts_compression
+        client.pause_writing()
+        writer = loop.create_task(client.write_stream(File(client), data, chunk_size=1024))
+        await asyncio.sleep(0)
+        client.resume_writing()
+        await writer
+        pack = await asyncio.wait_for(server.read(), 1)
+        return await asyncio.wait_for(pack.read_all(), 1)
+
+    # The compressed chunks held back while paused didn't overtake the start of the stream.
+    assert loop.run_until_complete(run()) == data
+    loop.close()
+
+
+def test_channels_interleave():
+    import asyncio
+    import logging
+    from unittest import mock
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.packets.Channels import Channel
+    from bfnet.testing import connect
+
+    class Msg(Packet):
+        id = 1
+        fields = ("value",)
+        # Pad each body out, so a few frames use up the window.
+        layout = "!I296x"
+        pooled = True
+
+    with mock.patch.object(Channel, "window_size", 1024):
+        loop = asyncio.new_event_loop()
+        server_handler = PacketHandler(loop, loglevel=logging.CRITICAL)
+        client_handler = PacketHandler(loop, loglevel=logging.CRITICAL)
+        client_handler.on_connection = lambda bf: None
+        client_handler._create_net("memory", 0)
+        received = []
+
+        async def handler(bf):
+            while True:
+                pack = await bf.read()
+                if pack is None:
+                    break
+                received.append((getattr(bf, "channel_id", 0), pack.value))
+
+        async def drain(channel):
+            while (await channel.read()) is not None:
+                pass
+
+        for h in (server_handler, client_handler):
+            h.add_packet_type(Msg)
+        client = client_handler.butterfly_factory()
+        server, _ = connect(server_handler, client)
+        server_handler.net.set_handler(handler)
+        server_handler.net.set_channel_handler(handler)
+        client_handler.net.set_channel_handler(drain)
+        channels = [client, client.open_channel(1), client.open_channel(2)]
+
+        # No hello handshake, so the plain channel 0 writes must not swallow the channel frames after them.
+        for value in range(10):
+            for channel in channels:
+                pack = Msg(channel)
+                pack.value = value
+                channel.write(pack)
+        # Only three frames fit in each window, so the rest wait until the server's handler gives window back.
+        assert channels[1].send_window < 300 and len(channels[1]._outbound) == 7
+        loop.run_until_complete(asyncio.sleep(0.1))
+        for channel_id in range(3):
+            assert [value for c, value in received if c == channel_id] == list(range(10))
+        # Each channel handler read its packets in turn, releasing the one before back into the pool.
+        assert len(Msg._pool) >= 2
+
+        # A client that ignores the window is dropped.
+        for _ in range(4):
+            client._send(Msg.id, bytes(300), channel_id=2)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        assert server._connection_lost and not server_handler.butterflies
+        loop.close()
+
+
+def test_graceful_shutdown():
+    import asyncio
+    import logging
+    from bfnet import ButterflyHandler
+    from bfnet.testing import open_connection
+
+    loop = asyncio.new_event_loop()
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    connections = [open_connection(handler) for _ in range(3)]
+    # The first client isn't reading, so its goodbye never drains.
+    connections[0][1].transport.pause_reading()
+    goodbye = b"going away" * 10000
+
+    def on_shutdown(butterfly):
+        butterfly.write(goodbye)
+
+    handler.on_shutdown = on_shutdown
+    loop.run_until_complete(asyncio.sleep(0))
+    assert len(handler.butterflies) == 3
+
+    async def run():
+        start = loop.time()
+        await handler.shutdown(deadline=0.5, batch_size=2, batch_interval=0, stop_loop=False)
+        return loop.time() - start, [await reader.read() for reader, _ in connections[1:]]
+
+    taken, replies = loop.run_until_complete(run())
+    # The clients that were reading got everything before they were disconnected.
+    assert replies == [goodbye, goodbye]
+    assert 0.5 <= taken < 1
+    assert not handler.butterflies
+    loop.close()
+
+
+def test_socket_handoff(tmpdir):
+    import asyncio
+    import logging
+    import os
+    import socket
+    import threading
+    from bfnet import ButterflyHandler
+    from bfnet.handoff import send_sockets, recv_sockets, receive_sockets
+
+    # Send a listening socket over a socketpair, and accept a connection on the copy.
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    old, new = socket.socketpair()
+    send_sockets(old, [listener])
+    received, = recv_sockets(new)
+    listener.close()
+    client = socket.create_connection(received.getsockname())
+    conn, _ = received.accept()
+    client.sendall(b"hello")
+    assert conn.recv(5) == b"hello"
+    for sock in (old, new, received, client, conn):
+        sock.close()
+
+    # Hand off a running server to a "new process" in another thread.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    path = str(tmpdir.join("handoff.sock"))
+    handed = []
+
+    async def run():
+        net = await handler.create_server(("127.0.0.1", 0), None)
+        address = net.server.sockets[0].getsockname()
+        thread = threading.Thread(target=lambda: handed.extend(receive_sockets(path, timeout=5)))
+        loop.call_soon(thread.start)
+        await handler.offer_handoff(path, deadline=1, stop_loop=False)
+        thread.join()
+        return address
+
+    address = loop.run_until_complete(run())
+    assert [sock.getsockname() for sock in handed] == [address]
+    assert not os.path.exists(path)
+    # The old server is closed, but the new process can still accept on the socket.
+    client = socket.create_connection(address)
+    handed[0].accept()[0].close()
+    client.close()
+    handed[0].close()
+    loop.close()
+
+
+def test_datagram_server():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.packets.Codecs import framed_header, MAGIC, FLAG_LENGTH, PROTOCOL_VERSION
+
+    class Text(Packet):
+        id = 1
+
+        def __init__(self, pbf, text: bytes=b""):
+            super().__init__(pbf)
+            self.text = text
+
+        def unpack(self, data):
+            self.text = data
+            return True
+
+        def gen(self):
+            return self.text
+
+    def frame(text):
+        return framed_header.pack(MAGIC, FLAG_LENGTH, PROTOCOL_VERSION, Text.id, len(text)) + text
+
+    class Client(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.received = []
+
+        def datagram_received(self, data, addr):
+            self.received.append(data)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.add_packet_type(Text)
+    received = []
+
+    async def echo(bf):
+        while True:
+            pack = await bf.read()
+            if pack is None:
+                return
+            received.append(pack.text)
+            bf.write(Text(bf, b"echo " + pack.text))
+
+    async def run():
+        net = await handler.create_datagram_server(("127.0.0.1", 0), idle_timeout=0.2)
+        assert handler.net is net
+        net.set_handler(echo)
+        address = net.server.transport.get_extra_info("sockname")
+        clients = [(await loop.create_datagram_endpoint(Client, remote_addr=address)) for _ in range(2)]
+
+        # Each datagram is decoded on its own, so a frame cut short is dropped, not joined to the next datagram.
+        clients[0][0].sendto(frame(b"a") + frame(b"b") + frame(b"cut short")[:12])
+        clients[0][0].sendto(frame(b"d"))
+        clients[1][0].sendto(frame(b"e"))
+        await asyncio.sleep(0.05)
+        assert received == [b"a", b"b", b"d", b"e"]
+        assert len(handler.butterflies) == 2
+        assert clients[0][1].received == [frame(b"echo a"), frame(b"echo b"), frame(b"echo d")]
+
+        # A group send encodes the packet once for both peers.
+        peers = [bf for bf, _ in handler.butterflies.values()]
+        net.server.send_group(Text(None, b"everyone"), peers)
+        await asyncio.sleep(0.05)
+        assert clients[0][1].received[-1] == clients[1][1].received[-1] == frame(b"everyone")
+        assert peers[0].get_write_buffer_size() == 0 and peers[0]._transport.get_write_buffer_limits()
+
+        # Peers that go quiet are swept away, and come back as new peers.
+        await asyncio.sleep(0.4)
+        assert not handler.butterflies
+        clients[1][0].sendto(frame(b"f"))
+        await asyncio.sleep(0.05)
+        assert len(handler.butterflies) == 1
+
+        await handler.shutdown(deadline=1, batch_interval=0, stop_loop=False)
+        assert not handler.butterflies and net.server.transport.is_closing()
+        for transport, _ in clients:
+            transport.close()
+
+    loop.run_until_complete(run())
+    loop.close()
+
+
+def test_datagram_peers_never_compress():
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet
+    from bfnet.packets.Codecs import framed_header, MAGIC, FLAG_LENGTH, FLAG_ACCEPTS_COMPRESSION, PROTOCOL_VERSION
+
+    class Text(Packet):
+        id = 1
+        compress = True
+
+        def __init__(self, pbf, text: bytes=b""):
+            super().__init__(pbf)
+            self.text = text
+
+        def unpack(self, data):
+            self.text = data
+            return True
+
+        def gen(self):
+            return self.text
+
+    def frame(text, flags=0):
+        return framed_header.pack(MAGIC, flags | FLAG_LENGTH, PROTOCOL_VERSION, Text.id, len(text)) + text
+
+    class Client(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.received = []
+
+        def datagram_received(self, data, addr):
+            self.received.append(data)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = PacketHandler(loop, loglevel=logging.WARNING)
+    handler.add_packet_type(Text)
+    handler.set_compression(threshold=16)
+    texts = [str(i).encode() * 100 for i in range(3)]
+
+    async def reply(bf):
+        await bf.read()
+        for text in texts:
+            bf.write(Text(bf, text))
+
+    async def run():
+        net = await handler.create_datagram_server(("127.0.0.1", 0))
+        net.set_handler(reply)
+        address = net.server.transport.get_extra_info("sockname")
+        transport, client = await loop.create_datagram_endpoint(Client, remote_addr=address)
+        # The peer says it can read compressed frames, but we still don't send any.
+        transport.sendto(frame(b"hello", FLAG_ACCEPTS_COMPRESSION))
+        await asyncio.sleep(0.05)
+        assert not next(iter(handler.butterflies.values()))[0].peer_accepts_compression
+        # Even when the first datagram is lost, the ones after it can be read on their own.
+        assert client.received[1:] == [frame(text) for text in texts[1:]]
+        transport.close()
+        await handler.shutdown(deadline=1, batch_interval=0, stop_loop=False)
+
+    loop.run_until_complete(run())
+    loop.close()
+
+
+def test_unix_socket_connections(tmpdir):
+    import asyncio
+    import logging
+    import socket
+    from bfnet import ButterflyHandler
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ButterflyHandler(loop, loglevel=logging.WARNING)
+    path = str(tmpdir.join("server.sock"))
+
+    async def run():
+        net = await handler.create_server(path, None)
+
+        @net.any_data
+        async def echo(data, butterfly, handler):
+            butterfly.write(data)
+
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b"hello")
+        assert (await reader.readexactly(5)) == b"hello"
+
+        # One end of a socketpair is handled like any other connection to the server.
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        await handler.add_connection(ours)
+        await loop.sock_sendall(theirs, b"world")
+        assert (await loop.sock_recv(theirs, 5)) == b"world"
+
+        # Neither end has a peer name, so they are told apart by their file descriptors.
+        butterflies = [bf for bf, _ in handler.butterflies.values()]
+        assert len(butterflies) == 2
+        for bf in butterflies:
+            assert (bf.ip, bf.client_port) == ("unix", bf._transport.get_extra_info("socket").fileno())
+        assert butterflies[0].client_port != butterflies[1].client_port
+
+        writer.close()
+        theirs.close()
+        await net.stop()
+        await asyncio.sleep(0.1)
+        assert not handler.butterflies
+
+    loop.run_until_complete(run())
+    loop.close()
+
+
+def test_writes_during_file_stream(tmpdir):
+    import asyncio
+    import logging
+    from bfnet.packets import PacketHandler, Packet, StreamPacket
+
+    class Small(Packet):
+        id = 1
+        fields = ("value",)
+        layout = "!I"
+
+    class File(StreamPacket):
+        id = 2
+
+        def gen(self):
+            return b"file"
+
+        def unpack(self, data):
+            return True
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    client_handler = PacketHandler(loop, loglevel=logging.WARNING)
+    client_handler.on_connection = lambda bf: None
+    for h in (server_handler, client_handler):
+        h.add_packet_type(Small)
+        h.add_packet_type(File)
+    path = tmpdir.join("big.bin")
+    path.write_binary(b"x" * (8 * 1024 * 1024))
+    received = []
+
+    async def handler(bf):
+        while True:
+            pack = await bf.read()
+            if pack is None:
+                return
+            if isinstance(pack, File):
+                received.append(len(await pack.read_all()))
+            else:
+                received.append(pack.value)
+
+    async def run():
+        net = await server_handler.create_server(("127.0.0.1", 0), None)
+        net.set_handler(handler)
+        port = net.server.sockets[0].getsockname()[1]
+        _, client = await loop.create_connection(client_handler.butterfly_factory, "127.0.0.1", port)
+
+        async def smalls():
+            for value in range(50):
+                pack = Small(client)
+                pack.value = value
+                client.write(pack)
+                client.send_ping()
+                await asyncio.sleep(0)
+
+        # The file may go out with sendfile(), which nothing else can write during.
+        with open(str(path), "rb") as source:
+            await asyncio.gather(client.write_stream(File(client), source, chunk_size=1024 * 1024), smalls())
+        for _ in range(100):
+            if len(received) == 51:
+                break
+            await asyncio.sleep(0.05)
+        client.stop()
+        await net.stop()
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(run())
+    loop.close()
+    assert sorted(received) == list(range(50)) + [8 * 1024 * 1024]
+    assert [value for value in received if value < 50] == list(range(50))